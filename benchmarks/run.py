@@ -0,0 +1,303 @@
+"""
+Benchmarks of the ifupy hot paths on synthetic cubes.
+
+Every benchmark runs in a fresh process, so that its peak resident
+memory is its own, and reports the best wall time over a few repeats and
+the throughput over the cube's size. Results are written as JSON and can
+be compared against a saved baseline:
+
+    python benchmarks/run.py --size small --output results.json
+    python benchmarks/run.py --size small --baseline results.json
+
+The comparison exits with status 1 if any benchmark got slower, or
+needed more memory, than the baseline by more than the tolerance.
+"""
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import timeit
+from collections import OrderedDict
+
+import numpy as np
+
+# Run as a script, only benchmarks/ is on the path; ifupy lives above it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from synthetic import LINES, SIZES, cals, cube_file
+
+
+def _cube(path, lazy=False):
+    """
+    The synthetic cube's data and spectral calibration.
+    """
+    from ifupy.core import read_data
+    cube = read_data(path, lazy=lazy)[1][0]()
+
+    return cube, cals(cube.shape)
+
+
+def _read(lazy):
+    def setup(path):
+        from ifupy.core import read_data
+
+        # Lazy reads are only timed once every byte has been touched
+        return lambda: np.sum(read_data(path, lazy=lazy)[1][0](),
+                              dtype=np.float64)
+
+    return setup
+
+
+def _collapse(method, sigma=False, lazy=False, **kwargs):
+    def setup(path):
+        from ifupy.arithmetic import collapse_slice
+        cube = _cube(path, lazy)[0]
+
+        return lambda: collapse_slice(cube, method=method, sigma=sigma,
+                                      **kwargs)
+
+    return setup
+
+
+def _extract_spectrum(iscontinuum):
+    def setup(path):
+        from ifupy.arithmetic import extract_spectrum
+        cube, cube_cals = _cube(path)
+        spaxel = [cube.shape[2] // 2, cube.shape[1] // 2]
+
+        return lambda: extract_spectrum(cube, spaxel, cube_cals,
+                                        iscontinuum=iscontinuum)
+
+    return setup
+
+
+def _extract_spectra(iscontinuum):
+    def setup(path):
+        from ifupy.arithmetic import extract_spectra
+        cube, cube_cals = _cube(path)
+
+        # Every spaxel in the central quarter of the field
+        mask = np.zeros(cube.shape[1:], dtype=bool)
+        ny, nx = mask.shape
+        mask[ny // 4:3 * ny // 4, nx // 4:3 * nx // 4] = True
+
+        return lambda: extract_spectra(cube, cube_cals, mask=mask,
+                                       iscontinuum=iscontinuum)
+
+    return setup
+
+
+def _line_measure(path):
+    from ifupy.arithmetic import extract_spectra, line_measure
+    cube, cube_cals = _cube(path)
+    wave, spectra = extract_spectra(cube, cube_cals, spaxels=[
+        cube.shape[2] // 2, cube.shape[1] // 2])
+    region = [LINES['Ha'] - 10., LINES['Ha'] + 10.]
+
+    return lambda: line_measure(wave, spectra[0], region=region)
+
+
+def _fit_continuum(path):
+    from ifupy.arithmetic import fit_continuum
+    cube, cube_cals = _cube(path)
+    windows = [[rest - 10., rest + 10.] for rest in LINES.values()]
+
+    return lambda: fit_continuum(cube, order=2, line_windows=windows,
+                                 sigma=3., cals=cube_cals)
+
+
+def _moment_maps(path):
+    from ifupy.arithmetic import moment_maps
+    cube, cube_cals = _cube(path)
+    region = [LINES['Ha'] - 10., LINES['Ha'] + 10.]
+
+    return lambda: moment_maps(cube, region=region, cals=cube_cals,
+                               rest_wavelength=LINES['Ha'])
+
+
+def _line_maps(path):
+    from ifupy.arithmetic import line_maps
+    cube, cube_cals = _cube(path)
+    lines = [(name, [rest - 6., rest + 6.], [[rest - 20., rest - 12.],
+                                             [rest + 12., rest + 20.]])
+             for name, rest in sorted(LINES.items())]
+
+    return lambda: line_maps(cube, lines, ratios=[('NII_6583', 'Ha')],
+                             cals=cube_cals)
+
+
+def _fit_lines(path):
+    from ifupy.analysis import fit_lines
+    cube, cube_cals = _cube(path)
+    region = [LINES['Ha'] - 8., LINES['Ha'] + 8.]
+
+    return lambda: fit_lines(cube, cube_cals, region, continuum=True)
+
+
+# Name -> setup(path), returning the call to time
+BENCHMARKS = OrderedDict([
+    ('read_data', _read(lazy=False)),
+    ('read_data_lazy', _read(lazy=True)),
+    ('collapse_sum', _collapse('sum')),
+    ('collapse_median', _collapse('median')),
+    ('collapse_mean_sigma', _collapse('mean', sigma=3.)),
+    ('collapse_sum_streamed', _collapse('sum', lazy=True,
+                                        max_memory=2**26)),
+    ('collapse_median_parallel', _collapse('median', lazy=True,
+                                           n_workers=4)),
+    ('extract_spectrum', _extract_spectrum(iscontinuum=False)),
+    ('extract_spectrum_continuum', _extract_spectrum(iscontinuum=True)),
+    ('extract_spectra_continuum', _extract_spectra(iscontinuum=True)),
+    ('line_measure', _line_measure),
+    ('fit_continuum', _fit_continuum),
+    ('moment_maps', _moment_maps),
+    ('line_maps', _line_maps),
+    ('fit_lines', _fit_lines),
+])
+
+
+def run_benchmark(name, path, repeat):
+    """
+    Time one benchmark in a fresh process.
+
+    Returns a dict of the best wall time (s), peak RSS (MB) of the
+    process, and throughput over the cube's size (MB/s).
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_child,
+                                      args=(queue, name, path, repeat))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    if 'error' in result:
+        raise RuntimeError('Benchmark {} failed:\n{}'.format(
+            name, result['error']))
+
+    return result
+
+
+def _child(queue, name, path, repeat):
+    import traceback
+
+    # The library reports its progress on stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    try:
+        call = BENCHMARKS[name](path)
+        times = []
+
+        for _ in range(repeat):
+            start = timeit.default_timer()
+            call()
+            times.append(timeit.default_timer() - start)
+
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_mb = peak / 2.**20 if sys.platform == 'darwin' else peak / 2.**10
+        size_mb = os.path.getsize(path) / 2.**20
+
+        queue.put({'wall_time': min(times), 'times': times,
+                   'peak_rss_mb': peak_mb,
+                   'throughput_mb_s': size_mb / max(min(times), 1e-9)})
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print how results compare with a baseline, and return the names of
+    the benchmarks that regressed in time or memory.
+    """
+    regressions = []
+    print('\n{:<40} {:>10} {:>10} {:>8} {:>8}'.format(
+        'benchmark', 'time (s)', 'base (s)', 'time', 'rss'))
+
+    for key, result in results.items():
+        base = baseline.get(key)
+
+        if base is None:
+            print('{:<40} {:>10.4f} {:>10}'.format(key, result['wall_time'],
+                                                   'new'))
+            continue
+
+        time_ratio = result['wall_time'] / base['wall_time']
+        rss_ratio = result['peak_rss_mb'] / base['peak_rss_mb']
+        flag = ''
+
+        if time_ratio > 1 + tolerance or rss_ratio > 1 + tolerance:
+            regressions.append(key)
+            flag = '  REGRESSION'
+
+        print('{:<40} {:>10.4f} {:>10.4f} {:>7.2f}x {:>7.2f}x{}'.format(
+            key, result['wall_time'], base['wall_time'], time_ratio,
+            rss_ratio, flag))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', action='append', choices=sorted(SIZES),
+                        help='cube size(s) to run (default: small)')
+    parser.add_argument('--only', action='append', choices=list(BENCHMARKS),
+                        help='benchmark(s) to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed repeats per benchmark (default: 3)')
+    parser.add_argument('--data-dir',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'ifupy-benchmarks'),
+                        help='where synthetic cubes are kept')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown before a regression is '
+                             'reported (default: 0.2, i.e. 20%%)')
+    args = parser.parse_args(argv)
+
+    results = OrderedDict()
+
+    for size in args.size or ['small']:
+        path = cube_file(size, args.data_dir)
+
+        for name in args.only or BENCHMARKS:
+            key = '{}[{}]'.format(name, size)
+            results[key] = run_benchmark(name, path, args.repeat)
+            print('{:<40} {:>9.4f} s {:>9.1f} MB {:>9.1f} MB/s'.format(
+                key, results[key]['wall_time'], results[key]['peak_rss_mb'],
+                results[key]['throughput_mb_s']))
+
+    report = OrderedDict([
+        ('meta', OrderedDict([
+            ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('python', platform.python_version()),
+            ('numpy', np.__version__),
+            ('platform', platform.platform()),
+            ('cpus', multiprocessing.cpu_count()),
+        ])),
+        ('results', results),
+    ])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
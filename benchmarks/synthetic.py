@@ -0,0 +1,110 @@
+"""
+Synthetic datacubes for the benchmarks: a sloped continuum, a few
+emission lines whose velocity and strength vary across the field, and
+Gaussian noise, written to FITS one chunk of planes at a time.
+"""
+from __future__ import print_function
+import os
+
+import numpy as np
+from astropy.io import fits
+
+# Named (nz, ny, nx) float32 cube sizes
+SIZES = {'tiny': (256, 32, 32),
+         'small': (2048, 100, 100),
+         'large': (4096, 300, 300)}
+
+# Wavelength range covered by every synthetic cube, whatever its depth
+WAVE_RANGE = (6500., 6780.)
+
+# Rest wavelengths of the emission lines put in the cubes
+LINES = {'NII_6548': 6548.1, 'Ha': 6562.8, 'NII_6583': 6583.4,
+         'SII_6716': 6716.4, 'SII_6731': 6730.8}
+
+
+def cals(shape):
+    """
+    Spectral calibration of a synthetic cube of `shape`; (crpix, crval,
+    crdelt).
+    """
+    return (0., WAVE_RANGE[0], (WAVE_RANGE[1] - WAVE_RANGE[0]) / shape[0])
+
+
+def header(shape):
+    """
+    Primary header of a synthetic cube of `shape`.
+    """
+    nz, ny, nx = shape
+    hdr = fits.Header()
+    hdr['SIMPLE'] = True
+    hdr['BITPIX'] = -32
+    hdr['NAXIS'] = 3
+    hdr['NAXIS1'] = nx
+    hdr['NAXIS2'] = ny
+    hdr['NAXIS3'] = nz
+    crpix, crval, crdelt = cals(shape)
+    hdr['CRPIX3'] = crpix + 1
+    hdr['CRVAL3'] = crval
+    hdr['CDELT3'] = crdelt
+    hdr['OBJECT'] = 'SYNTHETIC'
+
+    return hdr
+
+
+def make_cube(shape, seed=0, chunk_planes=64):
+    """
+    Yield a synthetic cube of `shape` in chunks of `chunk_planes` planes,
+    so that even the largest sizes never sit in memory at once.
+    """
+    nz, ny, nx = shape
+    rng = np.random.RandomState(seed)
+    crpix, crval, crdelt = cals(shape)
+    wave = crval + crdelt * (np.arange(nz) - crpix)
+
+    y, x = np.mgrid[:ny, :nx]
+    r = np.hypot((x - nx / 2.) / nx, (y - ny / 2.) / ny)
+    strength = 20. * np.exp(-r / 0.15)
+    shift = 3. * (x - nx / 2.) / nx
+    width = 1.2 + r
+    continuum = 1. + 0.5 * np.exp(-r / 0.3)
+
+    for start in range(0, nz, chunk_planes):
+        w = wave[start:start + chunk_planes, np.newaxis, np.newaxis]
+        chunk = continuum * (1. + 1e-4 * (w - crval))
+
+        for i, rest in enumerate(sorted(LINES.values())):
+            amplitude = strength / (1. + i)
+            chunk = chunk + amplitude * np.exp(
+                -0.5 * ((w - rest - shift) / width)**2)
+
+        chunk += rng.normal(0., 0.1, chunk.shape)
+
+        yield chunk.astype(np.float32)
+
+
+def cube_file(size, directory, seed=0):
+    """
+    Path of the synthetic FITS cube of a named size in `directory`,
+    writing it first if needed.
+    """
+    shape = SIZES[size]
+    path = os.path.join(directory, 'synthetic_{}_{}.fits'.format(size, seed))
+
+    if os.path.exists(path):
+        return path
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    print('Writing {} cube {} to {} ...'.format(size, shape, path))
+    scratch = path + '.tmp'
+    hdu = fits.StreamingHDU(scratch, header(shape))
+
+    for chunk in make_cube(shape, seed):
+        # FITS is big-endian
+        hdu.write(chunk.astype('>f4'))
+
+    hdu.close()
+    os.rename(scratch, path)
+
+    return path
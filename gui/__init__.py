@@ -6,7 +6,12 @@ import pyqtgraph as pg
 import numpy as np
 from astropy.io import fits
 from ifupy.core import Cube
-from ifupy.core import read_data
+from ifupy.core import read_handles
+from ifupy.analysis import fit_lines
+from ifupy.arithmetic import collapse_slice, extract_spectra
+from data_model import DataTreeModel
+from image_view import ProgressiveImageView
+from workers import JobManager
 
 
 class Main(QtGui.QMainWindow):
@@ -14,7 +19,7 @@ class Main(QtGui.QMainWindow):
     def __init__(self):
         super(Main, self).__init__()
         self.init_ui()
-        self.data = {}
+        self.jobs = JobManager(self.statusBar(), parent=self)
 
     def init_ui(self):
         # Set up menu bars and tool bars
@@ -56,9 +61,9 @@ class Main(QtGui.QMainWindow):
         # --------------------
         # Set up data tree widget
         # --------------------
-        self.tree_view = QtGui.QTreeWidget()
-        self.tree_view.setColumnCount(2)
-        self.tree_view.setHeaderLabels(QtCore.QStringList(["Name", "Shape"]))
+        self.data_model = DataTreeModel(self)
+        self.tree_view = QtGui.QTreeView()
+        self.tree_view.setModel(self.data_model)
         data_dock.setWidget(self.tree_view)
 
         # --------------------
@@ -79,6 +84,18 @@ class Main(QtGui.QMainWindow):
         select_tool.setCheckable(True)
         select_tool.clicked[bool].connect(self.add_plot)
 
+        collapse_tool = QtGui.QPushButton('Collapse', image_tools)
+        collapse_tool.clicked.connect(self.collapse_current)
+        image_tools.layout().addWidget(collapse_tool)
+
+        extract_tool = QtGui.QPushButton('Extract', spec_tools)
+        extract_tool.clicked.connect(self.extract_current)
+        spec_tools.layout().addWidget(extract_tool, 0, 0)
+
+        fit_tool = QtGui.QPushButton('Fit Line', spec_tools)
+        fit_tool.clicked.connect(self.fit_current)
+        spec_tools.layout().addWidget(fit_tool, 1, 0)
+
         tool_box.addItem(basic_tools, "Basic")
         tool_box.addItem(image_tools, "Imaging")
         tool_box.addItem(spec_tools, "Spectroscopy")
@@ -100,8 +117,13 @@ class Main(QtGui.QMainWindow):
         exitAction.setStatusTip('Exit application')
         exitAction.triggered.connect(QtGui.qApp.quit)
 
+        closeAction = QtGui.QAction('&Close Data Set', self)
+        closeAction.setStatusTip('Remove the selected data set')
+        closeAction.triggered.connect(self.close_current)
+
         menubar = self.menuBar()
         fileMenu = menubar.addMenu('&File')
+        fileMenu.addAction(closeAction)
         fileMenu.addAction(exitAction)
 
     def init_toolbar(self):
@@ -118,36 +140,172 @@ class Main(QtGui.QMainWindow):
     def _file_dialog(self):
         fname = QtGui.QFileDialog.getOpenFileName(self, 'Open file',
                                                   '/Users/nearl/Downloads/ForRaymond')
-        name, data_list = read_data(fname)
-        self.data[name] = data_list
-        self.update_tree_data()
+        if not fname:
+            return
 
-    def add_plot(self):
-        current_limb = self.tree_view.currentItem()
-        plot_data = current_limb.data(2, QtCore.Qt.UserRole).toPyObject()()
-        plot_title = current_limb.data(0, QtCore.Qt.UserRole)
+        # Reading headers of large multi-extension files can still take a
+        # while, so keep it off the GUI thread.
+        self.jobs.submit('Loading {}'.format(fname), read_handles, str(fname),
+                         on_result=self._add_data)
+
+    def _add_data(self, result):
+        name, handles = result
+        self.data_model.add_data_set(name, handles)
+
+    def current_handle(self):
+        return self.data_model.handle(self.tree_view.currentIndex())
+
+    def close_current(self):
+        index = self.tree_view.currentIndex()
+
+        if index.isValid():
+            self.data_model.remove_data_set(self.data_model.data_set_row(index))
+
+    def collapse_current(self):
+        handle = self.current_handle()
+
+        if handle is None:
+            return
+
+        title = '{} (sum)'.format(handle.name)
+
+        self.jobs.submit('Collapsing {}'.format(handle.name), _collapse,
+                         handle, with_job=True,
+                         on_result=lambda image: self._show_image(image, title))
+
+    def extract_current(self):
+        handle = self.current_handle()
+
+        if handle is None:
+            return
+
+        spaxel = self._ask_numbers('Extract Spectrum', 'Spaxel (x, y):', int)
+
+        if spaxel is None:
+            return
+
+        title = '{} [{}, {}]'.format(handle.name, *spaxel)
+
+        self.jobs.submit('Extracting {}'.format(title), _extract, handle,
+                         spaxel, with_job=True,
+                         on_result=lambda result: self._show_spectrum(result,
+                                                                      title))
+
+    def fit_current(self):
+        handle = self.current_handle()
+
+        if handle is None:
+            return
+
+        region = self._ask_numbers('Fit Line', 'Wavelength window (begin, '
+                                   'end):', float)
+
+        if region is None:
+            return
+
+        # Amplitude, mean, stddev and flux maps, one per frame
+        title = '{} (line fit)'.format(handle.name)
+
+        self.jobs.submit('Fitting {}'.format(handle.name), _fit, handle,
+                         region, with_job=True,
+                         on_result=lambda maps: self._show_image(maps, title))
+
+    def _ask_numbers(self, title, label, kind):
+        """
+        Ask for a pair of comma separated numbers, or None if cancelled.
+        """
+        text, ok = QtGui.QInputDialog.getText(self, title, label)
 
-        win = pg.ImageView()
-        win.setImage(plot_data)
+        if not ok:
+            return None
+
+        try:
+            first, second = [kind(value) for value in str(text).split(',')]
+        except ValueError:
+            self.statusBar().showMessage('Expected two numbers, got '
+                                         '{!r}'.format(str(text)))
+            return None
+
+        return first, second
+
+    def _show_image(self, image, title):
+        # The window holds the only reference to the image (or cube)
+        # data, so its memory goes away when the window is closed.
+        win = ProgressiveImageView()
+        win.set_cube(image)
 
         sub_win = self.mdiarea.addSubWindow(win)
-        sub_win.setWindowTitle(plot_title)
-        # p1 = win.plot(y=np.random.normal(size=100))
+        sub_win.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        sub_win.setWindowTitle(title)
         win.show()
 
-    def update_tree_data(self):
-        self.tree_view.clear()
+    def _show_spectrum(self, result, title):
+        spec_wave, spectra = result
+
+        win = pg.PlotWidget()
+        win.plot(spec_wave, spectra[0])
+        win.setLabel('bottom', 'Wavelength')
+        win.setLabel('left', 'Counts')
+
+        sub_win = self.mdiarea.addSubWindow(win)
+        sub_win.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        sub_win.setWindowTitle(title)
+        win.show()
+
+    def add_plot(self):
+        handle = self.current_handle()
+
+        if handle is None:
+            return
+
+        self.jobs.submit('Opening {}'.format(handle.name), _open, handle,
+                         with_job=True,
+                         on_result=lambda data: self._show_image(data,
+                                                                 handle.name))
+
+
+# Jobs run on worker threads. Opening a cube, even lazily, reads its file
+# and may decode it, so that happens here too rather than on the GUI
+# thread, and `job.report` is handed to the computations as their
+# progress callback, which is also how cancelling reaches them.
+
+def _load(job, handle):
+    job.report(0., 'Reading {} ...'.format(handle.name))
+
+    return handle.load()
+
+
+def _open(job, handle):
+    return _load(job, handle)()
+
+
+def _collapse(job, handle):
+    return collapse_slice(_open(job, handle), max_memory=2**28,
+                          progress=job.report)
+
+
+def _extract(job, handle, spaxel):
+    cube = _load(job, handle)
+
+    return extract_spectra(cube(), _cals(cube), spaxels=[spaxel])
+
+
+def _fit(job, handle, region):
+    cube = _load(job, handle)
+    maps = fit_lines(cube(), _cals(cube), region, progress=job.report)
+
+    return np.array([maps[name] for name in ('amplitude', 'mean', 'stddev',
+                                             'flux')])
 
-        for key, val in self.data.items():
-            new_item = QtGui.QTreeWidgetItem(self.tree_view)
-            new_item.setText(0, key)
 
-            for v in val:
-                new_data = QtGui.QTreeWidgetItem(new_item)
-                new_data.setText(0, v.name)
-                new_data.setText(1, str(v.shape()))
-                new_data.setData(2, QtCore.Qt.UserRole, v)
+def _cals(cube):
+    """
+    The spectral calibration of a cube, or frames if it has none.
+    """
+    if cube.spectral_axis is not None:
+        return cube.spectral_axis
 
+    return [0, 0., 1.]
 
 
 def main():
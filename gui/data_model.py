@@ -0,0 +1,132 @@
+from __future__ import print_function
+from PyQt4 import QtCore
+
+
+class DataSet(object):
+    """
+    An opened file in the data browser, and the handles of its cubes.
+    """
+    def __init__(self, name, handles):
+        self.name = name
+        self.handles = list(handles)
+
+
+class DataTreeModel(QtCore.QAbstractItemModel):
+    """
+    Two-level (file, cube) model for the data browser, backed by a
+    registry of `CubeHandle` objects.
+
+    Files are inserted and removed incrementally, and cube metadata such
+    as the shape is only queried (from the header) when a view asks to
+    display it.
+    """
+    headers = ["Name", "Shape"]
+
+    def __init__(self, parent=None):
+        super(DataTreeModel, self).__init__(parent)
+        self.data_sets = []
+
+        # Handle -> data set, for parent lookups
+        self._owners = {}
+
+    def add_data_set(self, name, handles):
+        data_set = DataSet(name, handles)
+        row = len(self.data_sets)
+
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self.data_sets.append(data_set)
+
+        for handle in data_set.handles:
+            self._owners[id(handle)] = data_set
+
+        self.endInsertRows()
+
+        return data_set
+
+    def remove_data_set(self, row):
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+        data_set = self.data_sets.pop(row)
+
+        for handle in data_set.handles:
+            self._owners.pop(id(handle), None)
+
+        self.endRemoveRows()
+
+    def handle(self, index):
+        """
+        The `CubeHandle` at `index`, or None for file rows.
+        """
+        if not index.isValid():
+            return None
+
+        node = index.internalPointer()
+
+        return None if isinstance(node, DataSet) else node
+
+    def data_set_row(self, index):
+        """
+        Row of the data set `index` belongs to.
+        """
+        node = index.internalPointer()
+
+        if not isinstance(node, DataSet):
+            node = self._owners[id(node)]
+
+        return self.data_sets.index(node)
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QtCore.QModelIndex()
+
+        if not parent.isValid():
+            return self.createIndex(row, column, self.data_sets[row])
+
+        return self.createIndex(row, column,
+                                parent.internalPointer().handles[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+
+        node = index.internalPointer()
+
+        if isinstance(node, DataSet):
+            return QtCore.QModelIndex()
+
+        data_set = self._owners[id(node)]
+
+        return self.createIndex(self.data_sets.index(data_set), 0, data_set)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0:
+            return 0
+
+        if not parent.isValid():
+            return len(self.data_sets)
+
+        node = parent.internalPointer()
+
+        return len(node.handles) if isinstance(node, DataSet) else 0
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.headers)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
+            return QtCore.QVariant()
+
+        node = index.internalPointer()
+
+        if index.column() == 0:
+            return QtCore.QVariant(node.name)
+
+        if isinstance(node, DataSet):
+            return QtCore.QVariant()
+
+        return QtCore.QVariant(str(node.shape))
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return QtCore.QVariant(self.headers[section])
+
+        return QtCore.QVariant()
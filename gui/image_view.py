@@ -0,0 +1,138 @@
+from __future__ import print_function
+from PyQt4 import QtCore
+import pyqtgraph as pg
+import numpy as np
+
+from workers import Job
+
+
+def block_average(array, factors):
+    """
+    Downsample the trailing two axes of an array by averaging blocks of
+    `factors` = (fy, fx) pixels, trimming any remainder.
+    """
+    fy, fx = factors
+    ny, nx = array.shape[-2] // fy * fy, array.shape[-1] // fx * fx
+    array = np.asarray(array[..., :ny, :nx], dtype=np.float32)
+
+    return array.reshape(array.shape[:-2] + (ny // fy, fy, nx // fx, fx)
+                         ).mean(axis=(-3, -1))
+
+
+class ProgressiveImageView(pg.ImageView):
+    """
+    Image view that displays a cube progressively.
+
+    A decimated preview is shown first: only every few wavelength planes
+    are read, and those are block-averaged in space. Levels are computed
+    on the preview alone. Afterwards, and whenever the frame or the view
+    changes, the visible part of the current frame is redrawn at full
+    resolution on top of it, reading only that region of the cube.
+    """
+    def __init__(self, parent=None, preview_size=512, preview_bytes=2**26,
+                 refine_delay=100):
+        super(ProgressiveImageView, self).__init__(parent)
+        self.preview_size = preview_size
+        self.preview_bytes = preview_bytes
+
+        self._cube = None
+        self._factors = (1, 1, 1)
+        self._refine_job = None
+        self._running = set()
+
+        # Full resolution overlay of the visible region
+        self._full_item = pg.ImageItem()
+        self._full_item.setZValue(1)
+        self.getView().addItem(self._full_item)
+
+        # Refinement is deferred so that it never delays the preview, and
+        # is coalesced while the user is still panning or scrubbing.
+        self._refine_timer = QtCore.QTimer(self)
+        self._refine_timer.setSingleShot(True)
+        self._refine_timer.setInterval(refine_delay)
+        self._refine_timer.timeout.connect(self.refine)
+
+        self.sigTimeChanged.connect(self._schedule_refine)
+        self.getView().sigRangeChanged.connect(self._schedule_refine)
+        self.getHistogramWidget().sigLevelsChanged.connect(self._update_levels)
+
+    def set_cube(self, cube):
+        """
+        Show a (possibly memory-mapped) cube, preview first.
+        """
+        if cube.ndim == 2:
+            cube = cube[np.newaxis]
+
+        self._cube = cube
+        nz, ny, nx = cube.shape
+
+        # Skip whole wavelength planes to stay within the preview's I/O
+        # budget, and average spatial blocks down to the preview size.
+        plane_bytes = ny * nx * cube.dtype.itemsize
+        fz = max(1, int(np.ceil(nz * plane_bytes / float(self.preview_bytes))))
+        fy = max(1, int(np.ceil(ny / float(self.preview_size))))
+        fx = max(1, int(np.ceil(nx / float(self.preview_size))))
+        self._factors = (fz, fy, fx)
+
+        preview = block_average(cube[::fz], (fy, fx))
+
+        self._full_item.clear()
+        self.setImage(preview, xvals=np.arange(preview.shape[0]) * fz,
+                      scale=(fy, fx))
+        self._schedule_refine()
+
+    def refine(self):
+        """
+        Draw the visible part of the current frame at full resolution,
+        reading it on a worker thread.
+        """
+        if self._cube is None:
+            return
+
+        nz, ny, nx = self._cube.shape
+        frame = min(self.currentIndex * self._factors[0], nz - 1)
+
+        # View coordinates run along the cube's axes 1 (x) and 2 (y)
+        (x0, x1), (y0, y1) = self.getView().viewRange()
+        x0, x1 = max(int(np.floor(x0)), 0), min(int(np.ceil(x1)), ny)
+        y0, y1 = max(int(np.floor(y0)), 0), min(int(np.ceil(y1)), nx)
+
+        if x1 <= x0 or y1 <= y0:
+            self._full_item.clear()
+            return
+
+        # Only the latest request matters; drop any still being read
+        if self._refine_job is not None:
+            self._refine_job.cancel()
+
+        bounds = (x0, x1, y0, y1)
+        job = Job(_read_region, self._cube, frame, bounds)
+        job.signals.result.connect(
+            lambda region: self._show_region(job, region, bounds))
+        job.signals.finished.connect(lambda: self._running.discard(job))
+        self._refine_job = job
+        self._running.add(job)
+
+        QtCore.QThreadPool.globalInstance().start(job)
+
+    def _show_region(self, job, region, bounds):
+        if job is not self._refine_job:
+            return
+
+        x0, x1, y0, y1 = bounds
+        self._refine_job = None
+        self._full_item.setImage(region, autoLevels=False,
+                                 levels=self.getHistogramWidget().getLevels())
+        self._full_item.setRect(QtCore.QRectF(x0, y0, x1 - x0, y1 - y0))
+
+    def _schedule_refine(self, *args):
+        self._refine_timer.start()
+
+    def _update_levels(self, *args):
+        self._full_item.setLevels(self.getHistogramWidget().getLevels())
+
+
+def _read_region(cube, frame, bounds):
+    x0, x1, y0, y1 = bounds
+
+    return np.asarray(cube[frame, x0:x1, y0:y1], dtype=np.float32)
@@ -0,0 +1,181 @@
+from __future__ import print_function
+import threading
+import traceback
+
+from PyQt4 import QtGui, QtCore
+
+
+class CancelledError(Exception):
+    """
+    Raised inside a job (by `Job.report`) once it has been cancelled.
+    """
+    pass
+
+
+class JobSignals(QtCore.QObject):
+    """
+    Signals of a `Job`. They are emitted from the worker thread and
+    delivered, queued, to slots on the GUI thread.
+    """
+    progress = QtCore.pyqtSignal(float, str)
+    result = QtCore.pyqtSignal(object)
+    error = QtCore.pyqtSignal(object, str)
+    finished = QtCore.pyqtSignal()
+
+
+class Job(QtCore.QRunnable):
+    """
+    A function call run on a `QThreadPool` thread.
+
+    If `with_job` is set the job itself is passed as the first argument,
+    so that long computations can call `report` to publish progress,
+    which also stops them (by raising `CancelledError`) once the job is
+    cancelled. Results of cancelled jobs are never delivered.
+    """
+    def __init__(self, func, *args, **kwargs):
+        super(Job, self).__init__()
+        self.with_job = kwargs.pop('with_job', False)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = JobSignals()
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def report(self, fraction, message=''):
+        """
+        Publish progress, as a fraction between 0 and 1.
+        """
+        if self.cancelled:
+            raise CancelledError()
+
+        self.signals.progress.emit(fraction, message)
+
+    def run(self):
+        args = ((self,) + self.args) if self.with_job else self.args
+
+        try:
+            result = self.func(*args, **self.kwargs)
+        except CancelledError:
+            pass
+        except Exception as e:
+            if not self.cancelled:
+                self.signals.error.emit(e, traceback.format_exc())
+        else:
+            if not self.cancelled:
+                self.signals.result.emit(result)
+        finally:
+            self.signals.finished.emit()
+
+
+class JobManager(QtCore.QObject):
+    """
+    Runs jobs for the main window on a thread pool, showing what is
+    running, and how far along it is, in the status bar.
+    """
+    def __init__(self, status_bar, max_threads=None, parent=None):
+        super(JobManager, self).__init__(parent)
+        self.status_bar = status_bar
+        self.pool = QtCore.QThreadPool(self)
+
+        if max_threads:
+            self.pool.setMaxThreadCount(max_threads)
+
+        # Python-side references keep running jobs alive
+        self.jobs = {}
+        self._error_shown = False
+
+        self.progress_bar = QtGui.QProgressBar()
+        self.progress_bar.setMaximumWidth(150)
+        self.progress_bar.hide()
+
+        self.cancel_button = QtGui.QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.cancel_all)
+        self.cancel_button.hide()
+
+        status_bar.addPermanentWidget(self.progress_bar)
+        status_bar.addPermanentWidget(self.cancel_button)
+
+    def submit(self, message, func, *args, **kwargs):
+        """
+        Run `func(*args, **kwargs)` in the background.
+
+        Parameters
+        ----------
+        message : string
+                  Status bar text while the job runs.
+
+        func : callable
+               The work to do. Any `on_result` and `on_error` keyword
+               arguments are taken as callbacks for its result and
+               errors, run on the GUI thread, and `with_job` is passed on
+               to `Job`.
+
+        Returns
+        -------
+        job : Job
+              The submitted job, e.g. to cancel it.
+        """
+        on_result = kwargs.pop('on_result', None)
+        on_error = kwargs.pop('on_error', self._show_error)
+
+        job = Job(func, *args, **kwargs)
+        self.jobs[id(job)] = (job, message)
+        self._error_shown = False
+
+        if on_result is not None:
+            job.signals.result.connect(on_result)
+
+        job.signals.error.connect(on_error)
+        job.signals.progress.connect(self._show_progress)
+        job.signals.finished.connect(lambda: self._finish(job))
+
+        self.pool.start(job)
+        self._show_status()
+
+        return job
+
+    def cancel_all(self):
+        for job, _ in list(self.jobs.values()):
+            job.cancel()
+
+    def _finish(self, job):
+        self.jobs.pop(id(job), None)
+        self._show_status()
+
+    def _show_status(self):
+        if not self.jobs:
+            self.progress_bar.hide()
+            self.cancel_button.hide()
+
+            # Leave the last error up until something else happens
+            if not self._error_shown:
+                self.status_bar.showMessage('Ready')
+
+            return
+
+        messages = [message for _, message in self.jobs.values()]
+        self.status_bar.showMessage('; '.join(messages) + ' ...')
+
+        # Busy indicator until a job reports how far along it is
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.show()
+        self.cancel_button.show()
+
+    def _show_progress(self, fraction, message):
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(int(100 * fraction))
+
+        if message:
+            self.status_bar.showMessage(message)
+
+    def _show_error(self, error, details):
+        print(details)
+        self._error_shown = True
+        self.status_bar.showMessage('Error: {}'.format(error))
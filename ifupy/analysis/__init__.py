@@ -1 +1,3 @@
 __author__ = 'nearl'
+
+from line_fit import fit_lines, fit_gaussians
@@ -0,0 +1,286 @@
+# Global imports
+from __future__ import print_function
+import numpy as np
+
+from ifupy.arithmetic import extract_spectra
+from ifupy.arithmetic.utils import wave_convert
+from ifupy.core.parallel import map_tiles
+from ifupy.core.profiling import profiled, stage
+
+_MAP_NAMES = ['amplitude', 'mean', 'stddev', 'flux']
+
+
+@profiled()
+def fit_lines(array_in, cals, region, mask=None, continuum=False,
+              max_iter=50, tol=1e-8, chunk_size=10000, n_workers=None,
+              progress=None):
+    """
+    Fit a single Gaussian emission line to every spaxel of a datacube at
+    once, producing kinematic maps.
+
+    All spectra are fit simultaneously with a vectorized Levenberg-Marquardt
+    solver, started from moment-based (flux-weighted) initial guesses.
+
+    Parameters
+    ----------
+    array_in : numpy.ndarray
+               Input datacube.
+
+    cals : list of floats
+           Calibration values for the input datacube;
+           (crpix, crval, crdelt).
+
+    region : list of floats, [begin, end]
+             The wavelength window containing the line.
+
+    mask : numpy.ndarray of bool, optional
+           Spatial (y, x) mask of the spaxels to fit (default is None, every
+           spaxel is fit).
+
+    continuum : bool, optional
+                Subtract a linear continuum across the window before
+                fitting (default is False).
+
+    max_iter : int, optional
+               Maximum number of solver iterations (default is 50).
+
+    tol : float, optional
+          Relative change in chi-squared below which a spaxel is
+          considered converged (default is 1e-8).
+
+    chunk_size : int, optional
+                 Number of spaxels fit together, which bounds the memory
+                 used by the solver (default is 10000).
+
+    n_workers : int, optional
+                Fit spatial tiles of the cube in this many worker
+                processes (default is None, everything is fit in the
+                calling process).
+
+    progress : callable, optional
+               Called as ``progress(fraction)`` as chunks of spaxels (or
+               tiles, with `n_workers`) are fit. Raising from it (e.g. to
+               cancel) stops the fit.
+
+    Returns
+    -------
+    maps : dict of numpy.ndarray
+           Spatial maps of 'amplitude', 'mean', 'stddev' and 'flux', and
+           their uncertainties ('amplitude_err', ...). Spaxels that were
+           not fit, or whose fit failed, are NaN.
+    """
+    ny, nx = array_in.shape[1:]
+
+    if mask is None:
+        mask = np.ones((ny, nx), dtype=bool)
+
+    if n_workers:
+        stack = map_tiles(_fit_tile, array_in, n_workers=n_workers,
+                          spatial=[mask],
+                          args=(cals, region, continuum, max_iter, tol,
+                                chunk_size),
+                          progress=progress)
+
+        return dict((key, stack[i]) for i, key in enumerate(_map_keys()))
+
+    # Frames covering the requested wavelength window
+    begin = wave_convert(region[0], cals)
+    end = wave_convert(region[1], cals) + 1
+
+    maps = dict((key, np.full((ny, nx), np.nan)) for key in _map_keys())
+
+    y, x = np.nonzero(mask)
+
+    for start in range(0, len(y), chunk_size):
+        chunk = np.zeros((ny, nx), dtype=bool)
+        chunk[y[start:start + chunk_size], x[start:start + chunk_size]] = True
+
+        spec_wave, spectra = extract_spectra(array_in, cals, mask=chunk,
+                                             region=[begin, end],
+                                             iscontinuum=continuum)
+        with stage('fit', nbytes=spectra.nbytes):
+            params, errors = fit_gaussians(spec_wave, spectra,
+                                           max_iter=max_iter, tol=tol)
+
+        for i, name in enumerate(_MAP_NAMES):
+            maps[name][chunk] = params[:, i]
+            maps[name + '_err'][chunk] = errors[:, i]
+
+        if progress is not None:
+            progress(min(1., float(start + chunk_size) / len(y)))
+
+    return maps
+
+
+def _fit_tile(tile, mask, cals, region, continuum, max_iter, tol,
+              chunk_size):
+    """
+    Fit one spatial tile of a cube, returning its maps stacked in
+    `_map_keys` order.
+    """
+    maps = fit_lines(tile, cals, region, mask=mask, continuum=continuum,
+                     max_iter=max_iter, tol=tol, chunk_size=chunk_size)
+
+    return np.array([maps[key] for key in _map_keys()])
+
+
+def _map_keys():
+    return [key for name in _MAP_NAMES for key in (name, name + '_err')]
+
+
+def fit_gaussians(x, y, max_iter=50, tol=1e-8):
+    """
+    Fit a Gaussian to each of a stack of spectra simultaneously.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        The wavelength array shared by all spectra.
+
+    y : numpy.ndarray
+        The spectra, with shape (n_spectra, n_wave).
+
+    max_iter : int, optional
+               Maximum number of solver iterations (default is 50).
+
+    tol : float, optional
+          Relative change in chi-squared below which a spectrum is
+          considered converged (default is 1e-8).
+
+    Returns
+    -------
+    params : numpy.ndarray
+             The (n_spectra, 4) best-fit amplitude, mean, stddev and
+             integrated flux; NaN where the fit failed, including fits
+             whose covariance has non-positive variances.
+
+    errors : numpy.ndarray
+             The (n_spectra, 4) one-sigma uncertainties of `params`.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n, m = y.shape
+
+    p = _moment_guess(x, y)
+    chi2 = _chi2(x, y, p)
+    lam = np.full(n, 1e-3)
+    active = np.isfinite(chi2)
+
+    for _ in range(max_iter):
+        index, = np.nonzero(active)
+
+        if len(index) == 0:
+            break
+
+        jac, resid = _jacobian(x, y[index], p[index])
+        jtj = np.einsum('nmi,nmj->nij', jac, jac)
+        jtr = np.einsum('nmi,nm->ni', jac, resid)
+
+        # Marquardt damping, with a small floor so that degenerate
+        # (e.g. zero amplitude) spectra stay solvable.
+        diag = np.einsum('nii->ni', jtj)
+        floor = diag.sum(axis=1)
+        floor[floor == 0] = 1.
+        damp = lam[index, None] * diag + 1e-12 * floor[:, None]
+        hess = jtj.copy()
+        hess[:, np.arange(3), np.arange(3)] += damp
+
+        step = np.linalg.solve(hess, jtr[..., None])[..., 0]
+        trial = p[index] + step
+        trial[:, 2] = np.abs(trial[:, 2])
+        trial_chi2 = _chi2(x, y[index], trial)
+
+        better = trial_chi2 < chi2[index]
+        improved = index[better]
+        change = (chi2[improved] - trial_chi2[better]) / chi2[improved]
+
+        p[improved] = trial[better]
+        chi2[improved] = trial_chi2[better]
+        lam[improved] /= 10.
+        lam[index[~better]] *= 10.
+
+        # Stop once the improvement is negligible, or the damping has
+        # grown so large that no step can help.
+        active[improved[change < tol]] = False
+        active[index[~better & (lam[index] > 1e10)]] = False
+
+    jac, resid = _jacobian(x, y, p)
+    jtj = np.einsum('nmi,nmj->nij', jac, jac)
+    dof = max(m - 3, 1)
+
+    params = np.empty((n, 4))
+    errors = np.empty((n, 4))
+    params[:, :3] = p
+    params[:, 3] = p[:, 0] * p[:, 2] * np.sqrt(2 * np.pi)
+
+    cov = np.full((n, 3, 3), np.nan)
+    # Spectra with NaNs have a NaN chi2 (and jacobian); leave them out
+    good = np.zeros(n, bool)
+    finite = np.isfinite(chi2)
+    good[finite] = np.abs(np.linalg.det(jtj[finite])) > 0
+    cov[good] = (np.linalg.inv(jtj[good]) *
+                 (chi2[good] / dof)[:, None, None])
+
+    variance = np.empty((n, 4))
+    variance[:, :3] = np.einsum('nii->ni', cov)
+
+    # Propagate amplitude and width errors (and their covariance) to flux
+    grad = np.sqrt(2 * np.pi) * np.stack([p[:, 2], p[:, 0]], axis=1)
+    sub = cov[:, ::2, ::2]
+    variance[:, 3] = np.einsum('ni,nij,nj->n', grad, sub, grad)
+
+    # Nearly singular fits can leave non-positive (or NaN) variances;
+    # those fits failed. Variances are only 0 for exact fits.
+    with np.errstate(invalid='ignore'):
+        positive = np.all((variance > 0) |
+                          ((variance == 0) & (chi2 == 0)[:, None]), axis=1)
+
+    failed = ~(good & positive)
+    params[failed] = np.nan
+    errors[failed] = np.nan
+    errors[~failed] = np.sqrt(variance[~failed])
+
+    return params, errors
+
+
+def _moment_guess(x, y):
+    """
+    Amplitude, mean and stddev initial guesses from the moments of the
+    positive part of each spectrum.
+    """
+    weight = np.clip(y, 0, None)
+    total = weight.sum(axis=1)
+    total[total == 0] = 1.
+
+    mean = np.dot(weight, x) / total
+    var = np.einsum('nm,nm->n', weight, (x[None, :] - mean[:, None])**2) / total
+    stddev = np.maximum(np.sqrt(var), np.abs(x[1] - x[0]))
+
+    return np.stack([y.max(axis=1), mean, stddev], axis=1)
+
+
+def _jacobian(x, y, p):
+    """
+    Jacobian of the Gaussian model with respect to (amplitude, mean,
+    stddev), and the residuals, for a stack of spectra.
+    """
+    amp, mean, stddev = p[:, 0, None], p[:, 1, None], p[:, 2, None]
+    z = (x[None, :] - mean) / stddev
+    g = np.exp(-0.5 * z**2)
+
+    jac = np.empty(y.shape + (3,))
+    jac[..., 0] = g
+    jac[..., 1] = amp * g * z / stddev
+    jac[..., 2] = amp * g * z**2 / stddev
+
+    return jac, y - amp * g
+
+
+def _chi2(x, y, p):
+    """
+    Sum of squared residuals of the Gaussian model for each spectrum.
+    """
+    z = (x[None, :] - p[:, 1, None]) / p[:, 2, None]
+    resid = y - p[:, 0, None] * np.exp(-0.5 * z**2)
+
+    return np.einsum('nm,nm->n', resid, resid)
@@ -1,3 +1,6 @@
 from collapse import collapse_slice
-from extract import extract_spectrum
+from continuum import fit_continuum, subtract_continuum
+from extract import extract_spectrum, extract_spectra, extract_apertures
+from line_ratio import line_maps
 from measure import line_measure
+from moments import moment_maps
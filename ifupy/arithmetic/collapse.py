@@ -1,7 +1,14 @@
 # Import necessary modules
 from __future__ import print_function
+import warnings
+
 import numpy as np
 
+from ifupy.core.cache import disk_cached
+from ifupy.core.parallel import map_tiles
+from ifupy.core.profiling import log, profiled, stage
+from ifupy.core.spectral_axis import SpectralAxis
+
 
 def _arrayCollapse(array_in, method):
     """
@@ -25,71 +32,305 @@ def _arrayCollapse(array_in, method):
                       The collapsed array with the desired method.
     """
 
-    # Perform an numpy.array collapse along the z-axis
-    if method == 'sum':
-        print('(3d_collapse): Sum collapse of extracted slices ...')
-        collapsed_array = np.sum(array_in, axis=0)
+    # Perform an numpy.array collapse along the z-axis. This also runs on
+    # every tile of a parallel collapse, so progress is logged by callers.
+    with stage('reduce', nbytes=array_in.nbytes, method=method):
+        if method == 'sum':
+            collapsed_array = np.sum(array_in, axis=0)
 
-    elif method == 'mean':
-        print('(3d_collapse): Mean collapse of extracted slices ...')
-        collapsed_array = np.mean(array_in, axis=0)
+        elif method == 'mean':
+            collapsed_array = np.mean(array_in, axis=0)
 
-    elif method == 'median':
-        print('(3d_collapse): Median collapse of extracted slices ...')
-        collapsed_array = np.median(array_in, axis=0)
+        elif method == 'median':
+            collapsed_array = np.median(array_in, axis=0)
 
     # Returns an array of type numpy.array    
     return collapsed_array
 
 
-def _maskedCollapse(array_in, method):
+def _tiledCollapse(array_in, method, sigma, max_memory, progress=None):
     """
-    Collapse a slice of a datacube, with a given mode, along the 
-    wavelength (z) slice.
-    
+    Collapse a slice of a datacube along the wavelength (z) axis while
+    holding at most roughly `max_memory` bytes of it in memory at once.
+
+    This is an internal function meant for memory-mapped cubes larger
+    than the available RAM. Sums and means are accumulated exactly (in
+    float64) over tiles of whole wavelength planes. Medians and sigma
+    clipping need every frame of a spaxel at once, so those are computed
+    over tiles of whole image rows instead, or of parts of a row when a
+    single row does not fit.
+
+    Parameters
+    ----------
+    array_in : numpy.ndarray
+               Input array over which to calculate the collapse, usually
+               a memory-mapped view.
+
+    method : string
+             Passed from the main function call.
+
+    sigma : bool or float
+            Passed from the main function call.
+
+    max_memory : int
+                 Approximate peak memory, in bytes, to use for the data
+                 being reduced.
+
+    progress : callable, optional
+               Passed from the main function call.
+
+    Returns
+    -------
+    collapsed_array : numpy.ndarray
+                      The collapsed array with the desired method.
+
+    rejected : numpy.ndarray or None
+               Number of frames clipped from each spaxel, if clipping.
+    """
+    nz, ny, nx = array_in.shape
+    itemsize = max(array_in.dtype.itemsize, np.dtype(np.float64).itemsize)
+
+    if method in ('sum', 'mean') and not sigma:
+        # Walk the cube in wavelength tiles, which are contiguous on disk
+        plane_bytes = ny * nx * itemsize
+        n_planes = int(max(1, max_memory // plane_bytes - 1))
+        log('3d_collapse', 'Streaming {} collapse in tiles of {} '
+            'slices ...'.format(method, n_planes))
+
+        collapsed_array = np.zeros((ny, nx), dtype=np.float64)
+
+        for start in range(0, nz, n_planes):
+            tile = array_in[start:start + n_planes]
+
+            with stage('reduce', nbytes=tile.nbytes, method=method):
+                collapsed_array += np.sum(tile, axis=0, dtype=np.float64)
+
+            if progress is not None:
+                progress(min(1., float(start + n_planes) / nz))
+
+        if method == 'mean':
+            collapsed_array /= nz
+
+        return collapsed_array, None
+
+    if sigma:
+        log('3d_collapse', 'Clipping data ...')
+
+    n_rows, n_cols = _tileShape(array_in, sigma, max_memory)
+    log('3d_collapse', 'Streaming {} collapse in tiles of {} rows x {} '
+        'columns ...'.format(method, n_rows, n_cols))
+
+    collapsed_array = np.empty((ny, nx), dtype=np.float64)
+    rejected = np.zeros((ny, nx), dtype=int) if sigma else None
+    tiles = [(y, x) for y in range(0, ny, n_rows)
+             for x in range(0, nx, n_cols)]
+
+    for done, (y, x) in enumerate(tiles, 1):
+        window = (slice(y, y + n_rows), slice(x, x + n_cols))
+
+        with stage('read') as read:
+            tile = np.asarray(array_in[(slice(None),) + window])
+            read.nbytes = tile.nbytes
+
+        if sigma:
+            collapsed_array[window], rejected[window] = _sigmaCollapse(
+                tile, method, sigma)
+        else:
+            with stage('reduce', nbytes=tile.nbytes, method=method):
+                collapsed_array[window] = np.median(tile, axis=0)
+
+        if progress is not None:
+            progress(float(done) / len(tiles))
+
+    return collapsed_array, rejected
+
+
+def _tileShape(array_in, sigma, max_memory):
+    """
+    The (rows, columns) of the largest spatial tiles of whole spectra
+    that median and sigma clipped collapses can reduce in about
+    `max_memory` bytes: whole rows where they fit, parts of a single row
+    otherwise. Warns if even a single spectrum does not fit.
+    """
+    nz, ny, nx = array_in.shape
+    itemsize = max(array_in.dtype.itemsize, np.dtype(np.float64).itemsize)
+
+    # Medians and sigma clipping copy the data they work on, and clipping
+    # carries its masks around as well.
+    overhead = 4 if sigma else 2
+    spaxel_bytes = nz * itemsize * overhead
+
+    if spaxel_bytes > max_memory:
+        warnings.warn('Collapsing a single spaxel takes about {} bytes, '
+                      'more than max_memory ({})'.format(spaxel_bytes,
+                                                         max_memory),
+                      RuntimeWarning)
+
+    n_cols = int(min(nx, max(1, max_memory // spaxel_bytes)))
+
+    if n_cols < nx:
+        return 1, n_cols
+
+    return int(max(1, max_memory // (spaxel_bytes * nx))), nx
+
+
+def _parallelCollapse(array_in, method, sigma, max_memory, n_workers,
+                      progress=None):
+    """
+    Collapse a slice of a datacube along the wavelength (z) axis, in
+    spatial tiles spread over a pool of worker processes.
+
+    This is an internal function; every tile is collapsed independently
+    with the in-memory methods.
+
+    Parameters
+    ----------
+    array_in : numpy.ndarray
+               Input array over which to calculate the collapse.
+
+    method : string
+             Passed from the main function call.
+
+    sigma : bool or float
+            Passed from the main function call.
+
+    max_memory : int or None
+                 Approximate peak memory, in bytes, of each worker.
+
+    n_workers : int
+                Number of worker processes.
+
+    progress : callable, optional
+               Passed from the main function call.
+
+    Returns
+    -------
+    collapsed_array : numpy.ndarray
+                      The collapsed array with the desired method.
+
+    rejected : numpy.ndarray or None
+               Number of frames clipped from each spaxel, if clipping.
+    """
+    tile_shape = None
+
+    if max_memory:
+        tile_shape = _tileShape(array_in, sigma, max_memory)
+
+    log('3d_collapse', 'Parallel {} collapse over {} '
+        'workers ...'.format(method, n_workers))
+
+    if sigma:
+        log('3d_collapse', 'Clipping data ...')
+
+    if sigma:
+        collapsed_array, rejected = map_tiles(
+            _sigmaTile, array_in, tile_shape=tile_shape,
+            n_workers=n_workers, args=(method, sigma), progress=progress)
+
+        return collapsed_array, rejected.astype(int)
+
+    return map_tiles(_arrayCollapse, array_in, tile_shape=tile_shape,
+                     n_workers=n_workers, args=(method,),
+                     progress=progress), None
+
+
+def _sigmaCollapse(array_in, method, sigma, iters=None):
+    """
+    Sigma clip a slice of a datacube along the wavelength (z) axis and
+    collapse what remains with the given method.
+
     This is an internal function that will handle the actual cube
-    collapse with a given method, for numpy.ma (MaskedArray) types. 
-    Specifically for computed collapse with sigma clipping.
+    collapse with a given method, with sigma clipping. Clipping works on
+    a single working copy, in which rejected values are replaced by NaN;
+    each iteration rejects values further than `sigma` standard
+    deviations from the median of what is left, until nothing changes.
 
     Parameters
     ----------
-    array_in : numpy array
+    array_in : numpy.ndarray
                Input array over which to calculate the collapse.
-    
+
     method : string
              Passed from the main function call.
-             
+
+    sigma : float
+            Passed from the main function call.
+
+    iters : int, optional
+            Maximum number of clipping iterations (default is None,
+            clip until convergence).
+
     Returns
     -------
-    collapsed_array.data : numpy array
-                           The collapsed array with the desired method.
+    collapsed_array : numpy.ndarray
+                      The collapsed array with the desired method.
+
+    rejected : numpy.ndarray
+               Number of frames clipped from each spaxel.
     """
-    import numpy.ma as ma
+    with stage('read') as read:
+        work = np.array(array_in, dtype=np.result_type(array_in.dtype,
+                                                       np.float32))
+        read.nbytes = work.nbytes
 
-    # Perform an numpy.ma array collapse along the z-axis
-    if method == 'sum':
-        print('(3d_collapse): Masked sum collapse of extracted slices ...')
-        collapsed_array = ma.sum(array_in, axis=0)
+    deviation = np.empty_like(work)
+    rejected = np.zeros(work.shape[1:], dtype=int)
+    iteration = 0
 
-    elif method == 'mean':
-        print('(3d_collapse): Masked mean of extracted slices:')
-        collapsed_array = ma.mean(array_in, axis=0)
+    with warnings.catch_warnings():
+        # Spaxels that are entirely NaN are expected here
+        warnings.simplefilter('ignore', RuntimeWarning)
 
-    elif method == 'median':
-        print('(3d_collapse): Masked median of extracted slices:')
-        collapsed_array = ma.extras.median(array_in, axis=0)
+        with stage('clip', nbytes=work.nbytes, sigma=sigma):
+            while iters is None or iteration < iters:
+                np.subtract(work, np.nanmedian(work, axis=0), out=deviation)
+                np.abs(deviation, out=deviation)
 
-    # Returns an array of type numpy.array    
-    return collapsed_array.data
+                with np.errstate(invalid='ignore'):
+                    clip = deviation > sigma * np.nanstd(work, axis=0)
+
+                n_clipped = clip.sum(axis=0)
+
+                if not n_clipped.any():
+                    break
+
+                work[clip] = np.nan
+                rejected += n_clipped
+                iteration += 1
+
+        del deviation
+
+        with stage('reduce', nbytes=work.nbytes, method=method):
+            if method == 'sum':
+                collapsed_array = np.nansum(work, axis=0)
+
+            elif method == 'mean':
+                collapsed_array = np.nanmean(work, axis=0)
+
+            elif method == 'median':
+                collapsed_array = np.nanmedian(work, axis=0)
 
+    return collapsed_array, rejected
 
-def collapse_slice(array_in, region=None, method='sum', sigma=False):
+
+def _sigmaTile(array_in, method, sigma):
+    """
+    `_sigmaCollapse` for `map_tiles`, with both outputs in one array.
+    """
+    return np.array(_sigmaCollapse(array_in, method, sigma))
+
+
+@profiled()
+@disk_cached(uncached=('progress',))
+def collapse_slice(array_in, region=None, method='sum', sigma=False,
+                   max_memory=None, n_workers=None, return_rejected=False,
+                   cals=None, progress=None):
     """
     Collapse a slice of a datacube, with a given mode, along the 
     wavelength slice.
     
-    This function handles both numpy.array (with no sigma clipping) 
-    and numpy.ma masked arrays (with sigma clipping, from astropy.stast.funcs)
+    Sigma clipping is iterative along the wavelength axis; clipped values
+    are left out of the collapse.
     
     Parameters
     ----------
@@ -104,11 +345,42 @@ def collapse_slice(array_in, region=None, method='sum', sigma=False):
              
     sigma : bool, optional
             Flag for wether to perform sigma clipping or not (default is False).
+
+    max_memory : int, optional
+                 Stream the collapse in tiles so that no more than roughly
+                 this many bytes of the cube are held in memory at once
+                 (default is None, the whole slice is reduced in one go).
+                 Use with memory-mapped cubes larger than the available
+                 RAM, e.g. from `read_data(..., lazy=True)`.
+
+    n_workers : int, optional
+                Collapse spatial tiles of the cube in this many worker
+                processes (default is None, the collapse runs in the
+                calling process). Combined with `max_memory`, the limit
+                applies to each worker.
+
+    return_rejected : bool, optional
+                      Also return the number of frames sigma clipped from
+                      each spaxel (default is False).
+
+    cals : list of floats or SpectralAxis, optional
+           Calibration values for the input datacube; (crpix, crval,
+           crdelt). If given, `region` is in wavelength instead of frames,
+           and includes both ends.
+
+    progress : callable, optional
+               Called as ``progress(fraction)`` as the tiles of a streamed
+               (`max_memory`) or parallel (`n_workers`) collapse are done.
+               Raising from it (e.g. to cancel) stops the collapse.
                 
     Returns
     -------
     collapsedArray : numpy.ndarray
                      Collapsed image.
+
+    rejected : numpy.ndarray
+               Per-spaxel count of clipped frames; only returned if
+               `return_rejected` is set.
     
     Example usage:
     
@@ -120,35 +392,48 @@ def collapse_slice(array_in, region=None, method='sum', sigma=False):
         
         Mean collapse a cube along the entire z-axis, performing a sigma
         clipping of 2.5.
+
+        3. >> result = collapse_slice(cube, method='median', max_memory=2**30)
+
+        Median collapse a (memory-mapped) cube using about 1 GB of memory.
     """
 
+    if region and cals is not None:
+        region = SpectralAxis.from_cals(cals).region_to_frames(region)
+
     # Extract the desired slice...
-    if not region:
-        print('(3d_collapse): Entire z-axis will be collapsed!')
-        slice_array = array_in
-    else:
-        print('(3d_collapse): z-axis collapse limits: ', region)
-        slice_array = array_in[region[0]:region[1], :, :]
+    with stage('slice'):
+        if not region:
+            log('3d_collapse', 'Entire z-axis will be collapsed!')
+            slice_array = array_in
+        else:
+            log('3d_collapse', 'z-axis collapse limits:', region)
+            slice_array = array_in[region[0]:region[1], :, :]
 
-    # ... and perform the desired operation, based on input mode.
-    collapsed_array = _arrayCollapse(slice_array, method=method)
+    if n_workers:
+        collapsed_array, rejected = _parallelCollapse(
+            slice_array, method, sigma, max_memory, n_workers, progress)
 
-    if sigma:
-        # Import sigma_clip from astropy
-        from astropy.stats.funcs import sigma_clip
+    elif max_memory:
+        collapsed_array, rejected = _tiledCollapse(slice_array, method, sigma,
+                                                   max_memory, progress)
 
-        # Perform sigma clipping on input cube
-        print('(3d_collapse): Clipping data ...')
-        clipped = sigma_clip(slice_array, sigma, iters=None, axis=0, copy=True)
+    # ... and perform the desired operation, based on input mode.
+    elif sigma:
+        log('3d_collapse', 'Clipping data ...')
+        collapsed_array, rejected = _sigmaCollapse(slice_array, method, sigma)
 
+    else:
+        log('3d_collapse', method.capitalize(),
+            'collapse of extracted slices ...')
+        collapsed_array, rejected = _arrayCollapse(slice_array,
+                                                   method=method), None
 
-        # Compare the clipped sample to determine wether we need to 
-        # recalculate the collapse        
-        if np.array_equal(clipped.compressed(), slice_array.flatten()):
-            print('Arrays are exactly the same, no clipping required.')
-        else:
-            # Now that we have the sigma mask, recalculate the collapse...            
-            collapsed_array = _maskedCollapse(clipped, method)
+    if return_rejected:
+        if rejected is None:
+            rejected = np.zeros(collapsed_array.shape, dtype=int)
+
+        return collapsed_array, rejected
 
     # Returns the collapsed array
     # print('(3d_collapse): Shape of returned array:', collapsed_array.shape)
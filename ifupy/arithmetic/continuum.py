@@ -0,0 +1,257 @@
+# Import necessary modules
+from __future__ import print_function
+
+import numpy as np
+
+from ifupy.core.cache import disk_cached
+from ifupy.core.profiling import log, profiled, stage
+from ifupy.core.spectral_axis import SpectralAxis
+
+
+@profiled()
+@disk_cached()
+def fit_continuum(array_in, order=1, region=None, line_windows=None,
+                  sigma=False, iters=5, cals=None, chunk_size=2**16):
+    """
+    Fit a polynomial continuum to every spectrum of a datacube.
+
+    All spectra are fitted at once: the (pseudo-)inverse of the
+    Vandermonde matrix of the fitted frames is computed a single time, and
+    the coefficients of every spaxel follow from one matrix product.
+    Only spaxels with NaNs or clipped frames are re-solved individually,
+    through small weighted normal equations.
+
+    Parameters
+    ----------
+    array_in : numpy.ndarray
+               The input datacube, or any array with the wavelength along
+               its first axis (e.g. a single spectrum).
+
+    order : int, optional
+            Order of the continuum polynomial (default is 1, linear).
+
+    region : list, [a, b], optional
+             Spectral window to fit, in frames (end-exclusive), or in
+             wavelength (both ends included) if `cals` is given. Can be
+             omitted to fit the entire z-axis.
+
+    line_windows : list of [a, b], optional
+                   Windows left out of the fit, e.g. around emission
+                   lines, in the same units as `region`.
+
+    sigma : bool or float, optional
+            Iteratively reject frames further than this many standard
+            deviations from the continuum (default is False, no rejection).
+            `True` rejects at 3 sigma.
+
+    iters : int, optional
+            Most rejection iterations (default is 5).
+
+    cals : list of floats or SpectralAxis, optional
+           Calibration values for the input datacube; (crpix, crval,
+           crdelt). If given, the polynomial is fitted in wavelength and
+           `region` and `line_windows` are in wavelength.
+
+    chunk_size : int, optional
+                 Spaxels fitted per chunk, bounding the memory used on
+                 large (e.g. memory-mapped) cubes.
+
+    Returns
+    -------
+    continuum : numpy.ndarray
+                The continuum, with the shape of the fitted window.
+
+    Example usage:
+
+        1. >> continuum = fit_continuum(cube, order=2,
+                                        line_windows=[[6555., 6570.]],
+                                        cals=cals)
+
+        Quadratic continuum of every spaxel, leaving out H-alpha.
+    """
+    slice_array, x, fit_mask = _window(array_in, region, line_windows, cals)
+    log('continuum', 'Fitting order {} continuum to {} frames ...'.format(
+        order, np.count_nonzero(fit_mask)))
+
+    continuum = np.empty(slice_array.shape,
+                         dtype=np.result_type(slice_array.dtype, np.float32))
+
+    for index, chunk in _chunks(slice_array, chunk_size):
+        with stage('fit', nbytes=chunk.nbytes):
+            continuum[index] = continuum_model(
+                x, chunk, order=order, fit_mask=fit_mask, sigma=sigma,
+                iters=iters).reshape(chunk.shape)
+
+    return continuum
+
+
+def subtract_continuum(array_in, order=1, region=None, line_windows=None,
+                       sigma=False, iters=5, cals=None, chunk_size=2**16):
+    """
+    Continuum-subtract a datacube over a spectral window.
+
+    Takes the same parameters as `fit_continuum`, and returns the window
+    of `array_in` minus its continuum.
+    """
+    continuum = fit_continuum(array_in, order=order, region=region,
+                              line_windows=line_windows, sigma=sigma,
+                              iters=iters, cals=cals, chunk_size=chunk_size)
+    slice_array = _window(array_in, region, None, cals)[0]
+
+    continuum = np.subtract(slice_array, continuum, out=continuum)
+
+    return continuum
+
+
+def continuum_model(x, spectra, order=1, fit_mask=None, sigma=False,
+                    iters=5):
+    """
+    Polynomial continua of a stack of spectra, solved together.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Abscissa (frames or wavelengths) of the n_wave frames.
+
+    spectra : numpy.ndarray
+              Spectra with shape (n_wave, ...).
+
+    order : int, optional
+            Order of the polynomial (default is 1, linear).
+
+    fit_mask : numpy.ndarray of bool, optional
+               Frames used in the fit (default is None, all of them).
+
+    sigma, iters : optional
+                   Iterative rejection; see `fit_continuum`.
+
+    Returns
+    -------
+    continuum : numpy.ndarray
+                The continua, with shape (n_wave, n_spectra). Spectra with
+                fewer usable frames than coefficients are all NaN.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(spectra, dtype=np.float64).reshape(len(x), -1)
+
+    if fit_mask is None:
+        fit_mask = np.ones(len(x), dtype=bool)
+
+    if sigma is True:
+        sigma = 3.
+
+    design = _design(x, order)
+    fit_design = design[fit_mask]
+    fit_y = y[fit_mask]
+
+    # NaNs are simply left out, at the cost of a spaxel-specific solve
+    weights = np.isfinite(fit_y)
+    fit_y = np.where(weights, fit_y, 0.)
+
+    coeffs = np.empty((order + 1, y.shape[1]))
+    clean = np.all(weights, axis=0)
+    coeffs[:, clean] = np.dot(np.linalg.pinv(fit_design), fit_y[:, clean])
+    coeffs[:, ~clean] = _weighted_solve(fit_design, fit_y[:, ~clean],
+                                        weights[:, ~clean])
+
+    for _ in range(iters if sigma else 0):
+        residuals = fit_y - np.dot(fit_design, coeffs)
+        n_good = np.maximum(weights.sum(axis=0), 1)
+        std = np.sqrt(np.sum(weights * residuals**2, axis=0) / n_good)
+
+        rejected = weights & (np.abs(residuals) > sigma * std)
+        changed = np.any(rejected, axis=0)
+
+        if not np.any(changed):
+            break
+
+        weights &= ~rejected
+        coeffs[:, changed] = _weighted_solve(fit_design, fit_y[:, changed],
+                                             weights[:, changed])
+
+    return np.dot(design, coeffs)
+
+
+def _design(x, order, scale_x=None):
+    """
+    Vandermonde matrix of `x`, with the abscissa rescaled to [-1, 1] (over
+    the range of `scale_x`, by default `x` itself) to keep it well
+    conditioned for wavelengths and higher orders.
+    """
+    scale_x = x if scale_x is None else scale_x
+    span = np.ptp(scale_x) / 2. or 1.
+    centre = (np.max(scale_x) + np.min(scale_x)) / 2.
+
+    return np.vander((x - centre) / span, order + 1)
+
+
+def _weighted_solve(design, y, weights):
+    """
+    Per-spectrum polynomial coefficients with 0/1 weights on the frames,
+    through batched (n_coeffs x n_coeffs) normal equations.
+    """
+    n_coeffs = design.shape[1]
+    coeffs = np.full((n_coeffs, y.shape[1]), np.nan)
+    solvable = weights.sum(axis=0) >= n_coeffs
+
+    if not np.any(solvable):
+        return coeffs
+
+    w = weights[:, solvable].astype(np.float64)
+    normal = np.einsum('fi,fn,fj->nij', design, w, design)
+    rhs = np.einsum('fi,fn->ni', design, w * y[:, solvable])
+
+    coeffs[:, solvable] = np.linalg.solve(normal, rhs[..., np.newaxis])[..., 0].T
+
+    return coeffs
+
+
+def _window(array_in, region, line_windows, cals):
+    """
+    The fitted slice of `array_in`, the abscissa of its frames, and which
+    of them are left to fit once the line windows are masked.
+    """
+    nz = array_in.shape[0]
+
+    if cals is not None:
+        axis = SpectralAxis.from_cals(cals, size=nz)
+
+        if region:
+            region = axis.region_to_frames(region)
+
+    begin, end = region if region else (0, nz)
+    slice_array = array_in[begin:end]
+    frames = np.arange(slice_array.shape[0]) + begin
+
+    if cals is not None:
+        x = axis.wavelengths[frames]
+    else:
+        x = frames.astype(np.float64)
+
+    fit_mask = np.ones(len(x), dtype=bool)
+
+    for a, b in (line_windows or []):
+        if cals is not None:
+            fit_mask &= (x < a) | (x > b)
+        else:
+            fit_mask &= (x < a) | (x >= b)
+
+    return slice_array, x, fit_mask
+
+
+def _chunks(array_in, chunk_size):
+    """
+    Spatial chunks of about `chunk_size` spaxels, as (index, chunk) pairs,
+    split along the second axis so that cube tiles stay contiguous.
+    """
+    if array_in.ndim == 1:
+        yield Ellipsis, array_in
+        return
+
+    row_size = int(np.prod(array_in.shape[2:]))
+    n_rows = max(1, chunk_size // max(row_size, 1))
+
+    for start in range(0, array_in.shape[1], n_rows):
+        index = (slice(None), slice(start, start + n_rows))
+
+        yield index, np.asarray(array_in[index])
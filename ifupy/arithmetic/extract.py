@@ -4,8 +4,15 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 
+from continuum import continuum_model
 from utils import frame_convert, wave_convert
+from ifupy.core.apertures import Aperture, spaxel_index
+from ifupy.core.cache import disk_cached
+from ifupy.core.profiling import profiled, stage
+from ifupy.core.spectral_axis import SpectralAxis
 
+@profiled()
+@disk_cached(uncached=('display',))
 def extract_spectrum(array_in, spaxel, cals, region=None, iscontinuum=False, display=False):
     """
     Extract the spectrum of a gixen spaxel from a given datacube.
@@ -45,60 +52,24 @@ def extract_spectrum(array_in, spaxel, cals, region=None, iscontinuum=False, dis
                spectrum_out[2, :] is the counts (in D/N).
     """
         
-    # Convert spaxel(s) to numpy arrays to evaluate how many are input, 
-    # and unpack into seperate values
-    spaxelList = np.array(spaxel)
-    if spaxelList.shape[1] > 2:
-        print('Input spaxels not in the right form. Resizing....')
-        npSpaxels = spaxelList.T
-        print('Resizing done!')
-        print()
-    else:
-        npSpaxels = spaxelList
-    
-    x, y = [], []
-    for (ii, jj) in npSpaxels:
-        x.append(ii)
-        y.append(jj)
-    
-    # If too many spaxels entered, display a message (limit x)
-    specLimit = 3
-    if npSpaxels.shape[0] > specLimit:
-        print('Too many spectra entered! Maximum of 3 will be processed...')
-
     # If an initial region is input then set the begin/end...
-    if region:
-        begin, end = region
-    else:
+    if not region:
         # ...else extract the entire spectrum w/o trimming
-        begin, end = [0, -1]
-        
-    # Extract spectrum at given spaxel, trimming from beginning/end of spectrum
-    spectrum = array_in[begin:end, y[:specLimit], x[:specLimit]]
-    
+        region = [0, -1]
+
+    spec_wave, spectra = extract_spectra(array_in, cals, spaxels=spaxel,
+                                         region=region,
+                                         iscontinuum=iscontinuum)
+    npSpaxels = _spaxel_array(spaxel)
+    x, y = npSpaxels[:, 0], npSpaxels[:, 1]
+
+    spectrum = spectra.T
+
     if spectrum.shape[1] == 1:
         spectrum = spectrum[:, 0]
-    
-    spec_frame = np.arange(len(spectrum)) + begin    
-    spec_wave = frame_convert(spec_frame, cals)
-            
-    # If a continuum-subtracted spectrum is required, calculate
-    # and return...
-    if iscontinuum:                
-        pTemp = np.polyfit(spec_wave, spectrum, 1)
-        
-        if spectrum.ndim == 1:
-            p = pTemp
-            continuum = p[0] * spec_wave + p[1]
-        else:
-            p = pTemp.T
-            continuum = np.zeros(spectrum.shape)
-            for rec, pfit in enumerate(p):
-                continuum[:, rec] = pfit[0] * spec_wave + pfit[1]
 
-        # Compute continuum-subtracted spectrum
-        spectrum = spectrum - continuum
-        
+    spec_frame = np.arange(len(spectrum)) + region[0]
+
     # Display spectrum if keyword set
     if display:
         
@@ -143,5 +114,263 @@ def extract_spectrum(array_in, spaxel, cals, region=None, iscontinuum=False, dis
                 
     return spectrum_out
 
+
+def extract_spectra(array_in, cals, spaxels=None, mask=None, weights=None,
+                    region=None, iscontinuum=False):
+    """
+    Extract many spectra from a given datacube at once.
+
+    Spectra are selected either as individual spaxels (by index list or
+    boolean mask) or as weighted sums over apertures. Every spectrum is
+    gathered with a single fancy-indexing (or matrix product) step, so
+    there is no limit on how many spaxels can be extracted.
+
+    Parameters
+    ----------
+    array_in : numpy.ndarray
+               Input datacube.
+
+    cals : list of floats or SpectralAxis
+           Calibration values for the input datacube;
+           (crpix, crval, crdelt).
+
+    spaxels : array_like of ints, optional
+              The [x, y] spaxel locations to extract, either as
+              [[x1, y1], ... [xn, yn]] or [[x1, ... xn], [y1, ... yn]].
+
+    mask : numpy.ndarray of bool, optional
+           Spatial (y, x) mask; every True spaxel is extracted, in
+           row-major order.
+
+    weights : numpy.ndarray, optional
+              Spatial (y, x) aperture weights, or a stack of them with
+              shape (n_apertures, y, x). Each aperture gives the weighted
+              sum of its spaxels' spectra.
+
+    region : list of int, [begin, end]
+             Region of datacube to extract (default is None, the entire
+             spectrum).
+
+    iscontinuum : bool, optional
+                  Subtract a linear continuum from every spectrum
+                  (default is False).
+
+    Returns
+    -------
+    spec_wave : numpy.ndarray
+                The wavelength of every extracted frame.
+
+    spectra : numpy.ndarray
+              The extracted spectra, with shape (n_spaxels, n_wave).
+    """
+    if region:
+        begin, end = region
+    else:
+        begin, end = 0, None
+
+    ny, nx = array_in.shape[-2:]
+
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        weights = weights.reshape(-1, weights.shape[-2] * weights.shape[-1])
+
+        # Only gather the spaxels that contribute to some aperture
+        index, = np.nonzero(np.any(weights != 0, axis=0))
+        y, x = np.unravel_index(index, (ny, nx))
+        weights = weights[:, index]
+    else:
+        if mask is not None:
+            y, x = np.nonzero(mask)
+        else:
+            npSpaxels = _spaxel_array(spaxels)
+            x, y = npSpaxels[:, 0], npSpaxels[:, 1]
+
+        x, y = np.where(x < 0, x + nx, x), np.where(y < 0, y + ny, y)
+
+    # Read just the box around the spaxels, so that chunked or
+    # memory-mapped cubes only load the part that is used
+    y0, y1 = (y.min(), y.max() + 1) if len(y) else (0, 0)
+    x0, x1 = (x.min(), x.max() + 1) if len(x) else (0, 0)
+    slice_array = array_in[begin:end, y0:y1, x0:x1]
+    nz = slice_array.shape[0]
+
+    with stage('extract') as extract:
+        spectra = np.asarray(slice_array[:, y - y0, x - x0]).T
+
+        if weights is not None:
+            spectra = np.dot(weights, spectra)
+
+        extract.nbytes = nz * len(y) * slice_array.dtype.itemsize
+
+    # Spectral axes cache their wavelength grid, so this is a lookup
+    spec_frame = np.arange(nz) + begin
+    spec_wave = SpectralAxis.from_cals(
+        cals, size=array_in.shape[0]).wavelengths[spec_frame]
+
+    # Fit and remove all continua in one least-squares solve
+    if iscontinuum:
+        with stage('continuum', nbytes=spectra.nbytes):
+            spectra = spectra - _linear_continuum(spec_wave, spectra)
+
+    return spec_wave, spectra
+
+
+@profiled()
+def extract_apertures(array_in, cals, apertures, sky=None, region=None,
+                      sky_method='median', subsample=5):
+    """
+    Sum the spectra inside apertures, optionally minus the sky measured
+    in surrounding apertures (e.g. annuli).
+
+    Apertures are rasterized once (see `spaxel_index`) and cached, so each
+    extraction is a gather of the covered spaxels from the box around all
+    apertures, followed by one weighted sum per aperture.
+
+    Parameters
+    ----------
+    array_in : numpy.ndarray
+               Input datacube.
+
+    cals : list of floats or SpectralAxis
+           Calibration values for the input datacube;
+           (crpix, crval, crdelt). If None, frames are returned instead
+           of wavelengths.
+
+    apertures : Aperture or list of Aperture
+                Regions to sum over.
+
+    sky : Aperture or list of Aperture, optional
+          Sky regions, one for all apertures or one per aperture. Their
+          per-spaxel sky level, times the aperture area, is subtracted.
+
+    region : list of int, [begin, end], optional
+             Region of datacube to extract (default is None, the entire
+             spectrum).
+
+    sky_method : {'median', 'mean'}, optional
+                 Sky level per frame, ignoring NaNs (default is 'median').
+
+    subsample : int, optional
+                Points per spaxel side used to weigh partly covered
+                spaxels (default is 5).
+
+    Returns
+    -------
+    spec_wave : numpy.ndarray
+                The wavelength of every extracted frame.
+
+    spectra : numpy.ndarray
+              The extracted spectra, with shape (n_apertures, n_wave).
+
+    Example usage:
+
+        1. >> wave, spectra = extract_apertures(
+                  cube, cals, CircularAperture(40, 42, 3.),
+                  sky=AnnulusAperture(40, 42, 6., 9.))
+
+        Sky-subtracted spectrum of a point source.
+    """
+    if isinstance(apertures, Aperture):
+        apertures = [apertures]
+
+    if sky is None:
+        skies = []
+    elif isinstance(sky, Aperture):
+        skies = [sky]
+    else:
+        skies = list(sky)
+
+    if skies and len(skies) not in (1, len(apertures)):
+        raise ValueError('Give one sky aperture, or one per aperture')
+
+    if region:
+        begin, end = region
+    else:
+        begin, end = 0, None
+
+    shape = array_in.shape[-2:]
+    indexes = [spaxel_index(aperture, shape, subsample)
+               for aperture in list(apertures) + skies]
+
+    # One gather from the box around every aperture serves them all
+    bounds = np.array([index.bounds() for index in indexes if len(index)])
+
+    if len(bounds):
+        y0, x0 = bounds[:, 0].min(), bounds[:, 2].min()
+        y1, x1 = bounds[:, 1].max(), bounds[:, 3].max()
+    else:
+        y0 = y1 = x0 = x1 = 0
+
+    slice_array = array_in[begin:end, y0:y1, x0:x1]
+    nz = slice_array.shape[0]
+
+    with stage('extract') as extract:
+        gathered = [np.asarray(slice_array[:, index.y - y0, index.x - x0])
+                    for index in indexes]
+        extract.nbytes = sum(g.nbytes for g in gathered)
+
+    spectra = np.array([np.dot(g, index.weights) for g, index in
+                        zip(gathered[:len(apertures)], indexes)])
+    spectra = spectra.reshape(len(apertures), nz)
+
+    if skies:
+        with stage('sky'):
+            levels = [_sky_level(g, index.weights, sky_method) for g, index
+                      in zip(gathered[len(apertures):],
+                             indexes[len(apertures):])]
+            areas = np.array([index.area for index in
+                              indexes[:len(apertures)]])
+
+            spectra -= areas[:, None] * np.array(levels)
+
+    spec_frame = np.arange(nz) + begin
+
+    if cals is not None:
+        spec_wave = SpectralAxis.from_cals(
+            cals, size=array_in.shape[0]).wavelengths[spec_frame]
+    else:
+        spec_wave = spec_frame.astype(float)
+
+    return spec_wave, spectra
+
+
+def _sky_level(gathered, weights, method):
+    """
+    Per-frame sky level of the (n_frames, n_spaxels) spectra of a sky
+    aperture, ignoring NaNs.
+    """
+    with np.errstate(invalid='ignore'):
+        if method == 'median':
+            # Spaxels mostly outside the sky region would bias the median
+            return np.nanmedian(gathered[:, weights >= 0.5], axis=1)
+
+        if method == 'mean':
+            valid = np.isfinite(gathered)
+            total = np.dot(np.where(valid, gathered, 0.), weights)
+
+            return total / np.dot(valid, weights)
+
+    raise ValueError("Unknown sky method '{}'".format(method))
+
+
+def _spaxel_array(spaxel):
+    """
+    Normalize spaxel input to an (n, 2) integer array of [x, y] pairs.
+    """
+    spaxelList = np.atleast_2d(np.asarray(spaxel, dtype=int))
+
+    if spaxelList.shape[1] > 2:
+        spaxelList = spaxelList.T
+
+    return spaxelList
+
+
+def _linear_continuum(spec_wave, spectra):
+    """
+    Linear continua for a stack of (n_spectra, n_wave) spectra, solved
+    together with a single pseudo-inverse.
+    """
+    return continuum_model(spec_wave, np.transpose(spectra)).T
+
 if __name__ == "__main__":
     extract_spectrum(array_in, spaxel, cals, region=None, continuum=False, display=False)
\ No newline at end of file
@@ -0,0 +1,175 @@
+# Import necessary modules
+from __future__ import print_function
+
+import numpy as np
+
+from continuum import _design
+from ifupy.core.profiling import log, profiled, stage
+from ifupy.core.spectral_axis import SpectralAxis
+
+
+@profiled()
+def line_maps(array_in, lines, ratios=None, cals=None, continuum_order=1,
+              max_memory=None):
+    """
+    Flux maps of many emission lines, and ratio maps between them, from a
+    single pass along the wavelength slice of a datacube.
+
+    Every line flux (minus its continuum, fitted across its sidebands) is
+    a fixed linear combination of the frames of a spectrum. These are
+    gathered into one (n_lines, n_frames) weight matrix, so the cube is
+    read once, chunk by chunk, however many lines are measured.
+
+    Parameters
+    ----------
+    array_in : numpy.ndarray
+               The input datacube array.
+
+    lines : list of (name, window, sidebands)
+            The lines to measure. `window` is the [a, b] range integrated
+            over, and `sidebands` an optional list of [a, b] ranges either
+            side of it, across which the continuum is fitted and then
+            subtracted. Ranges are in frames (end-exclusive), or in
+            wavelength (both ends included) if `cals` is given.
+
+    ratios : list of (numerator, denominator), optional
+             Line names to compute flux ratio maps for.
+
+    cals : list of floats or SpectralAxis, optional
+           Calibration values for the input datacube; (crpix, crval,
+           crdelt). If given, ranges are in wavelength and fluxes are
+           integrated over wavelength instead of frames.
+
+    continuum_order : int, optional
+                      Order of the continuum polynomial fitted across the
+                      sidebands (default is 1, linear). It is lowered for
+                      sidebands with too few frames.
+
+    max_memory : int, optional
+                 Stream the cube in chunks of wavelength planes so that no
+                 more than roughly this many bytes of it are held in
+                 memory at once (default is None, the whole span of the
+                 lines is read in one go).
+
+    Returns
+    -------
+    labels : list of strings
+             The line names, followed by 'numerator/denominator' for every
+             ratio.
+
+    maps : numpy.ndarray
+           The flux and ratio maps, with shape (n_labels, y, x). Spaxels
+           with NaNs in any frame a line uses are NaN.
+
+    Example usage:
+
+        1. >> labels, maps = line_maps(
+                  cube, [('Ha', [6558., 6568.], [[6530., 6545.], [6590., 6600.]]),
+                         ('NII', [6579., 6588.], [[6530., 6545.], [6590., 6600.]])],
+                  ratios=[('NII', 'Ha')], cals=cals)
+
+        H-alpha and [NII] 6583 fluxes and their ratio, in one cube read.
+    """
+    nz, ny, nx = array_in.shape
+
+    if cals is not None:
+        x = SpectralAxis.from_cals(cals, size=nz).wavelengths
+    else:
+        x = np.arange(nz, dtype=np.float64)
+
+    width = np.gradient(x) if nz > 1 else np.ones(1)
+    weights = np.zeros((len(lines), nz))
+
+    for row, line in zip(weights, lines):
+        name, window = line[:2]
+        sidebands = line[2] if len(line) > 2 else None
+
+        in_window = _frames(x, window, cals)
+
+        if not np.any(in_window):
+            raise ValueError('Line {} lies outside the cube'.format(name))
+
+        row[in_window] = width[in_window]
+
+        if sidebands:
+            in_sides = np.zeros(nz, dtype=bool)
+
+            for sideband in sidebands:
+                in_sides |= _frames(x, sideband, cals)
+
+            n_sides = np.count_nonzero(in_sides)
+
+            if n_sides == 0:
+                raise ValueError('Sidebands of line {} lie outside the '
+                                 'cube'.format(name))
+
+            # The continuum under the window is a fixed linear combination
+            # of the sideband frames, so its integral is too.
+            order = min(continuum_order, n_sides - 1)
+            side_x = x[in_sides]
+            inverse = np.linalg.pinv(_design(side_x, order))
+            window_design = _design(x[in_window], order, scale_x=side_x)
+
+            row[in_sides] -= np.dot(np.dot(width[in_window], window_design),
+                                    inverse)
+
+    used = np.any(weights != 0, axis=0)
+    first, last = np.nonzero(used)[0][[0, -1]]
+
+    plane_bytes = ny * nx * np.dtype(np.float64).itemsize * 2
+
+    if max_memory:
+        n_planes = int(max(1, max_memory // plane_bytes))
+    else:
+        n_planes = last + 1 - first
+
+    log('line_maps', 'Measuring {} lines over slices {}-{}, in chunks of '
+        '{} slices ...'.format(len(lines), first, last, n_planes))
+
+    fluxes = np.zeros((len(lines), ny, nx), dtype=np.float64)
+    invalid = np.zeros((len(lines), ny, nx), dtype=bool)
+
+    for start in range(first, last + 1, n_planes):
+        stop = min(start + n_planes, last + 1)
+
+        with stage('read') as read:
+            chunk = np.array(array_in[start:stop], dtype=np.float64)
+            read.nbytes = chunk.nbytes
+
+        # A NaN only spoils the lines that use its frame
+        bad = ~np.isfinite(chunk)
+        chunk[bad] = 0.
+
+        with stage('reduce', nbytes=chunk.nbytes):
+            fluxes += np.tensordot(weights[:, start:stop], chunk,
+                                   axes=(1, 0))
+            invalid |= np.tensordot(weights[:, start:stop] != 0, bad,
+                                    axes=(1, 0)) > 0
+
+    fluxes[invalid] = np.nan
+
+    labels = [line[0] for line in lines]
+    maps = [fluxes]
+
+    if ratios:
+        index = dict((name, i) for i, name in enumerate(labels))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            maps.append(np.array([fluxes[index[a]] / fluxes[index[b]]
+                                  for a, b in ratios]))
+
+        labels += ['{}/{}'.format(a, b) for a, b in ratios]
+
+    return labels, np.concatenate(maps)
+
+
+def _frames(x, window, cals):
+    """
+    Which frames fall in a window, following the convention of its units.
+    """
+    a, b = window
+
+    if cals is not None:
+        return (x >= a) & (x <= b)
+
+    return (x >= a) & (x < b)
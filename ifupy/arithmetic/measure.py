@@ -6,8 +6,12 @@ import matplotlib.cm as cm
 
 from astropy.modeling import models, fitting
 from utils import frame_convert, wave_convert
+from ifupy.core.cache import disk_cached
+from ifupy.core.profiling import log, profiled, stage
 
 
+@profiled()
+@disk_cached(uncached=('display',))
 def line_measure(x, y, f=None, region=None, continuum=None, display=False):
     """
     Measure the line (if present) in a given region of an 
@@ -50,20 +54,22 @@ def line_measure(x, y, f=None, region=None, continuum=None, display=False):
     # If zero, then something went wrong!
     line, inSpectrum = [], []
     
-    index, = np.where((x >= region[0]) & (x <= region[1]))
+    # The wavelength array is sorted, so bisect rather than scan it
+    index = [np.searchsorted(x, region[0], side='left'),
+             np.searchsorted(x, region[1], side='right') - 1]
 
     if region[0] >= x[0] and region[1] <= x[-1]:
-        print('Indeces: ', index[0], index[-1])
-        print('Wavelength range: ', x[index[0]], x[index[-1]])
+        log('line_measure', 'Indices:', index[0], index[-1])
+        log('line_measure', 'Wavelength range:', x[index[0]], x[index[-1]])
         inWave = x[index[0]:index[-1]]
         inSpectrum = y[index[0]:index[-1]]
         
         # If a frame array is available, assign range as well
-        if f != None: inFrame = f[index[0]:index[-1]]
+        if f is not None: inFrame = f[index[0]:index[-1]]
         
     else:    
-        print('Wavelength range is outside that available:')
-        print('Input spectrum range: ', x[index[0]], x[index[-1]])
+        log('line_measure', 'Wavelength range is outside that available:')
+        log('line_measure', 'Input spectrum range:', x[0], x[-1])
         return line
 
 #    #if continuum == 'linear':
@@ -94,9 +100,11 @@ def line_measure(x, y, f=None, region=None, continuum=None, display=False):
     # Fit the data using a Gaussian
     g_init = models.Gaussian1D(amplitude=0., mean=mean_0, stddev=3.)
     fit_g = fitting.LevMarLSQFitter()
-    g = fit_g(g_init, inWave, inSpectrum)
 
-    print(g)    
+    with stage('fit', nbytes=inSpectrum.nbytes):
+        g = fit_g(g_init, inWave, inSpectrum)
+
+    log('line_measure', g)
     
     # Display spectrum if set (DEBUG)
     if display:
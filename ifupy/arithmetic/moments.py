@@ -0,0 +1,140 @@
+# Import necessary modules
+from __future__ import print_function
+
+import numpy as np
+
+from ifupy.core.cache import disk_cached
+from ifupy.core.profiling import log, profiled, stage
+from ifupy.core.spectral_axis import SpectralAxis
+
+# Speed of light, in km/s
+C_KMS = 299792.458
+
+
+@profiled()
+@disk_cached()
+def moment_maps(array_in, region=None, cals=None, threshold=None,
+                rest_wavelength=None, max_memory=None):
+    """
+    Moment 0, 1 and 2 maps of a slice of a datacube, computed together in
+    a single pass along the wavelength slice.
+
+    Each chunk of wavelength planes is read once and accumulated into the
+    weighted sums of 1, x and x**2 of every spaxel, from which all three
+    moments follow.
+
+    Parameters
+    ----------
+    array_in : numpy.ndarray
+               The input datacube array.
+
+    region : list, [a, b], optional
+             The region of the datacube to use, in frames where a is the
+             1st slice boundary, and b is the 2nd + 1 slice boundary, or in
+             wavelength (both ends included) if `cals` is given. Can be
+             omitted to use the entire z-axis.
+
+    cals : list of floats or SpectralAxis, optional
+           Calibration values for the input datacube; (crpix, crval,
+           crdelt). If given, moments are in wavelength instead of frames.
+
+    threshold : float, optional
+                Only include values above this in the moments (default is
+                None, every finite value is included).
+
+    rest_wavelength : float, optional
+                      Rest wavelength of the line. If given (with `cals`),
+                      moments 1 and 2 are velocities and dispersions in
+                      km/s.
+
+    max_memory : int, optional
+                 Stream the cube in chunks of wavelength planes so that no
+                 more than roughly this many bytes of it are held in
+                 memory at once (default is None, the whole slice is read
+                 in one go).
+
+    Returns
+    -------
+    moments : numpy.ndarray
+              The moment 0 (integrated flux), 1 (mean) and 2 (dispersion)
+              maps, with shape (3, y, x). Moments 1 and 2 are NaN where the
+              integrated flux is not positive.
+
+    Example usage:
+
+        1. >> m0, m1, m2 = moment_maps(cube, region=[6555., 6570.],
+                                       cals=cals, threshold=0.,
+                                       rest_wavelength=6562.8)
+
+        Flux, velocity and velocity dispersion maps of H-alpha.
+    """
+    nz = array_in.shape[0]
+
+    if cals is not None:
+        axis = SpectralAxis.from_cals(cals, size=nz)
+
+        if region:
+            region = axis.region_to_frames(region)
+
+    begin, end = region if region else (0, nz)
+    slice_array = array_in[begin:end]
+    frames = np.arange(slice_array.shape[0]) + begin
+
+    if cals is not None:
+        x = axis.wavelengths[frames]
+    else:
+        x = frames.astype(np.float64)
+
+    # Width of every frame, for the integral, and abscissa taken about the
+    # window's centre so that x**2 sums do not lose precision.
+    width = np.gradient(x) if len(x) > 1 else np.ones(1)
+    centre = x.mean() if len(x) else 0.
+    x = x - centre
+
+    nz, ny, nx = slice_array.shape
+    plane_bytes = ny * nx * np.dtype(np.float64).itemsize * 2
+
+    if max_memory:
+        n_planes = int(max(1, max_memory // plane_bytes))
+    else:
+        n_planes = max(nz, 1)
+
+    log('moments', 'Moment maps of {} slices, in chunks of {} '
+        'slices ...'.format(nz, n_planes))
+
+    sums = np.zeros((3, ny, nx), dtype=np.float64)
+
+    for start in range(0, nz, n_planes):
+        with stage('read') as read:
+            chunk = np.array(slice_array[start:start + n_planes],
+                             dtype=np.float64)
+            read.nbytes = chunk.nbytes
+
+        keep = np.isfinite(chunk)
+
+        if threshold is not None:
+            keep &= chunk > threshold
+
+        chunk[~keep] = 0.
+        chunk *= width[start:start + n_planes, np.newaxis, np.newaxis]
+
+        # Weighted sums of 1, x and x**2 in one sweep of the chunk
+        with stage('reduce', nbytes=chunk.nbytes):
+            powers = np.vander(x[start:start + n_planes], 3,
+                               increasing=True)
+            sums += np.tensordot(powers, chunk, axes=(0, 0))
+
+    moments = np.full((3, ny, nx), np.nan)
+    moments[0] = sums[0]
+    good = sums[0] > 0
+
+    mean = sums[1][good] / sums[0][good]
+    variance = sums[2][good] / sums[0][good] - mean**2
+    moments[1][good] = mean + centre
+    moments[2][good] = np.sqrt(np.maximum(variance, 0.))
+
+    if rest_wavelength is not None:
+        moments[1] = C_KMS * (moments[1] - rest_wavelength) / rest_wavelength
+        moments[2] = C_KMS * moments[2] / rest_wavelength
+
+    return moments
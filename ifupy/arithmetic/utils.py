@@ -1,6 +1,8 @@
 # Global imports
 import numpy as np
 
+from ifupy.core.spectral_axis import SpectralAxis
+
 def frame_convert(frame, cals):
     """ 
     Convert the frame to a wavelength using a starting value and 
@@ -8,16 +10,16 @@ def frame_convert(frame, cals):
     
     Parameters
     ----------
-    frame : int
-        Datacube frame to convert to a wavelength.
+    frame : int or array of ints
+        Datacube frame(s) to convert to a wavelength.
     
-    cals : list of floats
+    cals : list of floats or SpectralAxis
            Calibration values for the input datacube; 
            (crpix, crval, crdelt).
         
     Returns
     -------
-    wavelength : float
+    wavelength : float or array of floats
         The converted wavelength of the datacube frame.
         
     Raises
@@ -26,7 +28,7 @@ def frame_convert(frame, cals):
     """
     
     # Calculate the frame conversion
-    wavelength = (frame - cals[0]) * cals[2] + cals[1]
+    wavelength = SpectralAxis.from_cals(cals).to_wave(frame)
     
     return wavelength
 
@@ -37,28 +39,24 @@ def wave_convert(wavelength, cals):
     
     Parameters
     ----------
-    wavelength : float
-        The wavelength to convert to a datacube frame.
+    wavelength : float or array of floats
+        The wavelength(s) to convert to a datacube frame.
     
-    cals : list of floats
+    cals : list of floats or SpectralAxis
            Calibration values for the input datacube; 
            (crpix, crval, crdelt).
         
     Returns
     -------
-    frame : int
+    frame : int or array of ints
         Datacube frame to converted from the input wavelength.
         
     Raises
     ------
     Not yet implemented.
     """
-    
-    from numpy import round
-    from numpy import int
 
     # Calculate the wavelength conversion
-    frame = cals[0] + ((wavelength - cals[1]) / cals[2])
-    
-    frame = np.int(np.round(frame))
+    frame = SpectralAxis.from_cals(cals).to_index(wavelength)
+
     return frame
\ No newline at end of file
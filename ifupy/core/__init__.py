@@ -1,2 +1,8 @@
-from data_cube import Cube
-from process_data import read_data
+from data_cube import Cube, CubeHandle, CubeCollection
+from process_data import read_data, read_handles
+from spectral_axis import SpectralAxis
+from cache import enable_cache, disable_cache
+from profiling import Trace, profile, enable_profiling, disable_profiling, set_verbose
+from cube_cache import cache_cube, clear_cube_cache
+from chunked import ChunkedArray, write_chunked
+from apertures import CircularAperture, EllipticalAperture, AnnulusAperture, PolygonAperture, spaxel_index
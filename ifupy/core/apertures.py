@@ -0,0 +1,245 @@
+from __future__ import print_function
+
+import numpy as np
+from matplotlib.path import Path
+
+from cache import MemoryCache, memoized
+
+# Rasterized apertures, shared by every cube of the same spatial shape
+aperture_cache = MemoryCache(max_bytes=2**26)
+
+
+class Aperture(object):
+    """
+    A region of the sky plane of a cube, in pixel coordinates (spaxel
+    centres at integers, as in ``cube[:, y, x]``).
+
+    Subclasses define `contains` for arrays of points and `bounds`, the
+    box the region fits in; `spaxel_index` rasterizes them.
+    """
+    def contains(self, x, y):
+        raise NotImplementedError
+
+    def bounds(self):
+        """
+        The (x0, x1, y0, y1) extent of the aperture.
+        """
+        raise NotImplementedError
+
+    def _params(self):
+        return ()
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, value) for name, value in self._params()))
+
+    def __eq__(self, other):
+        return repr(self) == repr(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(repr(self))
+
+
+class CircularAperture(Aperture):
+    """
+    Circle of radius `r` centred on (`x`, `y`).
+    """
+    def __init__(self, x, y, r):
+        self.x, self.y, self.r = float(x), float(y), float(r)
+
+    def contains(self, x, y):
+        return (x - self.x)**2 + (y - self.y)**2 <= self.r**2
+
+    def bounds(self):
+        return (self.x - self.r, self.x + self.r,
+                self.y - self.r, self.y + self.r)
+
+    def _params(self):
+        return (('x', self.x), ('y', self.y), ('r', self.r))
+
+
+class EllipticalAperture(Aperture):
+    """
+    Ellipse with semi-axes `a` and `b` centred on (`x`, `y`), with `a`
+    rotated `theta` radians counter-clockwise from the x axis.
+    """
+    def __init__(self, x, y, a, b, theta=0.):
+        self.x, self.y = float(x), float(y)
+        self.a, self.b, self.theta = float(a), float(b), float(theta)
+
+    def contains(self, x, y):
+        cos, sin = np.cos(self.theta), np.sin(self.theta)
+        dx, dy = x - self.x, y - self.y
+        u = (dx * cos + dy * sin) / self.a
+        v = (dy * cos - dx * sin) / self.b
+
+        return u**2 + v**2 <= 1.
+
+    def bounds(self):
+        cos, sin = np.cos(self.theta), np.sin(self.theta)
+        half_x = np.hypot(self.a * cos, self.b * sin)
+        half_y = np.hypot(self.a * sin, self.b * cos)
+
+        return (self.x - half_x, self.x + half_x,
+                self.y - half_y, self.y + half_y)
+
+    def _params(self):
+        return (('x', self.x), ('y', self.y), ('a', self.a), ('b', self.b),
+                ('theta', self.theta))
+
+
+class AnnulusAperture(Aperture):
+    """
+    Ring between radii `r_in` (excluded) and `r_out` centred on (`x`,
+    `y`), e.g. for sky around a `CircularAperture`.
+    """
+    def __init__(self, x, y, r_in, r_out):
+        if r_out <= r_in:
+            raise ValueError('The outer radius of an annulus must be larger '
+                             'than the inner one')
+
+        self.x, self.y = float(x), float(y)
+        self.r_in, self.r_out = float(r_in), float(r_out)
+
+    def contains(self, x, y):
+        distance = (x - self.x)**2 + (y - self.y)**2
+
+        return (distance > self.r_in**2) & (distance <= self.r_out**2)
+
+    def bounds(self):
+        return (self.x - self.r_out, self.x + self.r_out,
+                self.y - self.r_out, self.y + self.r_out)
+
+    def _params(self):
+        return (('x', self.x), ('y', self.y), ('r_in', self.r_in),
+                ('r_out', self.r_out))
+
+
+class PolygonAperture(Aperture):
+    """
+    Polygon through `vertices`, a sequence of (x, y) pairs.
+    """
+    def __init__(self, vertices):
+        self.vertices = np.asarray(vertices, dtype=float).reshape(-1, 2)
+        self._path = Path(self.vertices)
+
+    def contains(self, x, y):
+        x, y = np.broadcast_arrays(x, y)
+        points = np.column_stack([x.ravel(), y.ravel()])
+
+        return self._path.contains_points(points).reshape(x.shape)
+
+    def bounds(self):
+        (x0, y0), (x1, y1) = self.vertices.min(0), self.vertices.max(0)
+
+        return x0, x1, y0, y1
+
+    def _params(self):
+        return (('vertices', [tuple(v) for v in self.vertices.tolist()]),)
+
+
+class SpaxelIndex(object):
+    """
+    Sparse raster of an aperture: the (`y`, `x`) spaxels it covers and
+    the fraction of each that lies inside it (`weights`).
+    """
+    def __init__(self, y, x, weights, shape):
+        self.y = y
+        self.x = x
+        self.weights = weights
+        self.shape = tuple(shape)
+
+    def __len__(self):
+        return len(self.y)
+
+    @property
+    def nbytes(self):
+        return self.y.nbytes + self.x.nbytes + self.weights.nbytes
+
+    @property
+    def area(self):
+        """
+        Area of the aperture inside the image, in spaxels.
+        """
+        return self.weights.sum()
+
+    def bounds(self):
+        """
+        The (y0, y1, x0, x1) box around the covered spaxels,
+        end-exclusive.
+        """
+        if not len(self):
+            return 0, 0, 0, 0
+
+        return (self.y.min(), self.y.max() + 1,
+                self.x.min(), self.x.max() + 1)
+
+    def mask(self):
+        """
+        Boolean image of the covered spaxels.
+        """
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[self.y, self.x] = True
+
+        return mask
+
+
+@memoized(aperture_cache)
+def spaxel_index(aperture, shape, subsample=5):
+    """
+    Rasterize an aperture onto an image of `shape` (ny, nx).
+
+    Only the box around the aperture is sampled, at `subsample` x
+    `subsample` points per spaxel, and results are cached, so repeated
+    extractions with the same aperture reuse the same index.
+
+    Parameters
+    ----------
+    aperture : Aperture
+               The region to rasterize.
+
+    shape : tuple of ints
+            (ny, nx) shape of the image.
+
+    subsample : int, optional
+                Points per spaxel side used to estimate the covered
+                fraction of edge spaxels (default is 5; 1 tests spaxel
+                centres only).
+
+    Returns
+    -------
+    index : SpaxelIndex
+            The covered spaxels and their weights.
+
+    Example usage:
+
+        1. >> index = spaxel_index(CircularAperture(40, 42, 3.5), (82, 82))
+           >> spectrum = np.dot(cube[:, index.y, index.x], index.weights)
+    """
+    ny, nx = shape[-2:]
+    x0, x1, y0, y1 = aperture.bounds()
+
+    # Spaxel i covers [i - 0.5, i + 0.5)
+    ix0 = max(int(np.floor(x0 + 0.5)), 0)
+    iy0 = max(int(np.floor(y0 + 0.5)), 0)
+    ix1 = min(int(np.floor(x1 + 0.5)) + 1, nx)
+    iy1 = min(int(np.floor(y1 + 0.5)) + 1, ny)
+
+    if ix1 <= ix0 or iy1 <= iy0:
+        empty = np.zeros(0, dtype=np.intp)
+
+        return SpaxelIndex(empty, empty.copy(), np.zeros(0), (ny, nx))
+
+    offsets = (np.arange(subsample) + 0.5) / subsample - 0.5
+    y = (np.arange(iy0, iy1)[:, None] + offsets).ravel()
+    x = (np.arange(ix0, ix1)[:, None] + offsets).ravel()
+    inside = aperture.contains(x[None, :], y[:, None])
+
+    fraction = inside.reshape(iy1 - iy0, subsample, ix1 - ix0,
+                              subsample).mean(axis=(1, 3))
+    yy, xx = np.nonzero(fraction)
+
+    return SpaxelIndex(yy + iy0, xx + ix0, fraction[yy, xx], (ny, nx))
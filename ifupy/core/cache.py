@@ -0,0 +1,409 @@
+from __future__ import print_function
+import functools
+import hashlib
+import inspect
+import itertools
+import os
+import tempfile
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+from data_cube import Cube
+from parallel import file_view
+from spectral_axis import SpectralAxis
+
+# The active on-disk result cache, if any
+_disk_cache = None
+
+# Serial numbers of the objects `identity` has seen, by id(), dropped as
+# the objects are collected so that reused ids get new numbers
+_serials = {}
+_counter = itertools.count()
+
+
+class DiskCache(object):
+    """
+    Content-addressed store of array results, kept as `.npy` files in a
+    local directory and bounded in size by least-recently-used eviction.
+    """
+    def __init__(self, directory=None, max_bytes=2**30):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.ifupy',
+                                     'cache')
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        """
+        The array stored under `key`, or None.
+        """
+        path = self._path(key)
+
+        try:
+            result = np.load(path)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Modification times double as the recency record for eviction
+        os.utime(path, None)
+
+        return result
+
+    def set(self, key, value):
+        """
+        Store an array under `key`, then evict down to the size limit.
+        """
+        handle, scratch = tempfile.mkstemp(dir=self.directory,
+                                           suffix='.tmp')
+
+        # Write aside and rename, so readers never see partial files
+        with os.fdopen(handle, 'wb') as f:
+            np.save(f, value)
+
+        os.rename(scratch, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in
+        `max_bytes`.
+        """
+        entries = []
+
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                os.remove(os.path.join(self.directory, name))
+
+
+class MemoryCache(object):
+    """
+    In-memory least-recently-used store of results, bounded by the number
+    of bytes of array data it holds.
+    """
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
+
+        # Re-insert to mark as most recently used
+        value, size = self._entries.pop(key)
+        self._entries[key] = (value, size)
+
+        return value
+
+    def set(self, key, value):
+        size = _nbytes(value)
+
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+
+        # Never let one oversized result flush everything else
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = (value, size)
+        self.nbytes += size
+
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+
+def enable_cache(directory=None, max_bytes=2**30):
+    """
+    Start caching the results of the decorated ifupy functions on disk.
+
+    Parameters
+    ----------
+    directory : string, optional
+                Cache directory (default is ~/.ifupy/cache).
+
+    max_bytes : int, optional
+                Size the cache is evicted down to (default is 1 GB).
+
+    Returns
+    -------
+    cache : DiskCache
+            The now active cache.
+    """
+    global _disk_cache
+    _disk_cache = DiskCache(directory, max_bytes)
+
+    return _disk_cache
+
+
+def disable_cache():
+    global _disk_cache
+    _disk_cache = None
+
+
+def disk_cached(uncached=()):
+    """
+    Decorator caching a function's array results in the active
+    `DiskCache`, keyed on the function and all of its arguments.
+
+    Parameters
+    ----------
+    uncached : tuple of strings, optional
+               Arguments (e.g. 'display') whose truth means the call has
+               side effects and must not be served from the cache.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _disk_cache is None:
+                return func(*args, **kwargs)
+
+            call_args = inspect.getcallargs(func, *args, **kwargs)
+
+            if any(call_args.get(name) for name in uncached):
+                return func(*args, **kwargs)
+
+            key = _key(func, call_args)
+            result = _disk_cache.get(key)
+
+            if result is None:
+                result = func(*args, **kwargs)
+
+                if isinstance(result, np.ndarray):
+                    _disk_cache.set(key, result)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def memoized(cache):
+    """
+    Decorator keeping a function's results in a `MemoryCache`, keyed on
+    the function and the `identity` of every argument.
+
+    Keys are built without reading any data, so a cache hit costs next
+    to nothing however large the cube; this is meant for interactive
+    callbacks that are handed the same data over and over. Edits made
+    through a `Cube` are seen, but in-place edits of plain arrays are not
+    (see `identity`).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            call_args = inspect.getcallargs(func, *args, **kwargs)
+            key = (func.__module__, func.__name__) + tuple(
+                (name, identity(call_args[name]))
+                for name in sorted(call_args))
+
+            result = cache.get(key)
+
+            if result is None:
+                result = func(*args, **kwargs)
+                cache.set(key, result)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _nbytes(value):
+    """
+    Bytes of array data held by a result.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+
+    # Other containers of arrays can report their own size
+    return getattr(value, 'nbytes', 0)
+
+
+def _key(func, call_args):
+    """
+    Hash of a function and its (bound) arguments.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((func.__module__, func.__name__)).encode('utf-8'))
+
+    for name in sorted(call_args):
+        digest.update(repr((name, token(call_args[name]))).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def token(value):
+    """
+    A cheap, hashable summary that changes whenever `value` does.
+
+    Data is never read to build it where that can be avoided: unedited
+    lazy cubes are summarized by their file's path, size and
+    modification time and the extension and section they map, chunked
+    stores by their metadata (see `ChunkedArray.token`), and read-only
+    memory maps of a file (e.g. ``np.load(path, mmap_mode='r')``) by the
+    file and the location of the view. Every other array is hashed by
+    content, a bounded block at a time.
+    """
+    if isinstance(value, Cube):
+        if value.source is not None:
+            return ('file',) + value.source
+
+        if value._store is not None:
+            return token(value._store)
+
+        value = value.data
+
+    if isinstance(value, np.ndarray):
+        source = file_view(value)
+
+        if source is not None:
+            stat = os.stat(source[0])
+
+            return ('file', os.path.abspath(source[0]), stat.st_size,
+                    stat.st_mtime) + source[1:]
+
+        return ('array', value.dtype.str, value.shape, _digest(value))
+
+    if isinstance(value, SpectralAxis):
+        if value.is_linear:
+            return ('axis', value.cals, value.size)
+
+        return ('axis', token(value.wavelengths))
+
+    if isinstance(value, (list, tuple)):
+        return tuple(token(v) for v in value)
+
+    if isinstance(value, dict):
+        return tuple((k, token(value[k])) for k in sorted(value))
+
+    # Stores (e.g. a `ChunkedArray`) summarize themselves
+    if callable(getattr(value, 'token', None)):
+        return value.token()
+
+    return repr(value)
+
+
+def identity(value):
+    """
+    A hashable key telling objects apart without reading their data, for
+    in-memory caches that live no longer than the session.
+
+    Cubes are keyed on the object itself and the number of writes made
+    through it (and through the cubes it is a view of), read-only file
+    maps as in `token`, and other arrays on the memory they view: the
+    object owning it, and the offset, shape, strides and type of the
+    view. In-place edits of plain arrays, or of a cube's `data` directly,
+    are therefore not seen. Anything else is keyed by its `token`.
+    """
+    if isinstance(value, Cube):
+        key = ('cube', _serial(value), value._generation)
+
+        if value._parent is not None:
+            key += identity(value._parent[0])
+
+        return key
+
+    if isinstance(value, np.ndarray):
+        if file_view(value) is not None:
+            return token(value)
+
+        root = value
+
+        while isinstance(root.base, np.ndarray):
+            root = root.base
+
+        offset = (value.__array_interface__['data'][0] -
+                  root.__array_interface__['data'][0])
+
+        return ('array', _serial(root), offset, value.shape, value.strides,
+                value.dtype.str)
+
+    if isinstance(value, (list, tuple)):
+        return tuple(identity(v) for v in value)
+
+    if isinstance(value, dict):
+        return tuple((k, identity(value[k])) for k in sorted(value))
+
+    return token(value)
+
+
+def _serial(value):
+    """
+    A number unique to `value` for as long as it is alive.
+    """
+    key = id(value)
+    entry = _serials.get(key)
+
+    if entry is None or entry[0]() is not value:
+        ref = weakref.ref(value, lambda _, key=key: _serials.pop(key, None))
+        entry = _serials[key] = (ref, next(_counter))
+
+    return entry[1]
+
+
+def _digest(array_in, block_bytes=2**24):
+    """
+    SHA1 of an array's contents. Contiguous arrays are hashed in place;
+    others are copied to contiguous blocks of about `block_bytes` along
+    the first axis, never whole.
+    """
+    digest = hashlib.sha1()
+
+    if array_in.ndim == 0 or array_in.flags.c_contiguous:
+        digest.update(np.ascontiguousarray(array_in).view(np.uint8))
+
+        return digest.hexdigest()
+
+    rows = max(1, block_bytes // max(array_in[0].nbytes, 1))
+
+    for start in range(0, len(array_in), rows):
+        block = np.ascontiguousarray(array_in[start:start + rows])
+        digest.update(block.view(np.uint8))
+
+    return digest.hexdigest()
@@ -0,0 +1,528 @@
+from __future__ import print_function
+import bz2
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+from astropy.io import fits
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import MemoryCache
+from data_cube import Cube
+from profiling import log, stage
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Name -> (compress(data, level), decompress(data)); all from the
+# standard library, and all release the GIL while they work.
+CODECS = {
+    'zlib': (lambda data, level: zlib.compress(data, level),
+             zlib.decompress),
+    'bz2': (lambda data, level: bz2.compress(data, level),
+            bz2.decompress),
+    'none': (lambda data, level: data, lambda data: data),
+}
+
+if lzma is not None:
+    CODECS['lzma'] = (lambda data, level: lzma.compress(data, preset=level),
+                      lzma.decompress)
+
+# Bumped whenever the layout of chunked stores changes
+_FORMAT_VERSION = 1
+
+
+class ChunkedArray(object):
+    """
+    Read-only, array-like view of a chunked store written by
+    `write_chunked`.
+
+    The array is cut into a regular grid of chunks, each compressed on its
+    own. Indexing with integers and slices only decompresses the chunks
+    the selection touches, spread over a pool of threads, and recently
+    used chunks are kept decompressed in memory. Integer (or boolean)
+    arrays, e.g. ``cube[:, index.y, index.x]``, read the box around the
+    elements they select and gather them from it, as numpy would.
+
+    Parameters
+    ----------
+    path : string
+           Directory of the store.
+
+    n_threads : int, optional
+                Threads decompressing chunks (default is None, one per
+                CPU).
+
+    cache_bytes : int, optional
+                  Decompressed chunks kept in memory (default is 64 MB).
+    """
+    def __init__(self, path, n_threads=None, cache_bytes=2**26):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        if meta.get('version') != _FORMAT_VERSION:
+            raise ValueError('Unsupported chunked store version in '
+                             '{}'.format(path))
+
+        if meta['codec'] not in CODECS:
+            raise ValueError("Codec '{}' is not available".format(
+                meta['codec']))
+
+        self.path = path
+        self.shape = tuple(meta['shape'])
+        self.dtype = np.dtype(str(meta['dtype']))
+        self.chunks = tuple(meta['chunks'])
+        self.codec = meta['codec']
+        self.header = (fits.Header.fromstring(meta['header'])
+                       if meta.get('header') else None)
+        self.n_threads = n_threads or multiprocessing.cpu_count()
+        self._decompress = CODECS[self.codec][1]
+        self._cache = MemoryCache(max_bytes=cache_bytes)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return '<ChunkedArray {} {} in {} chunks of {}>'.format(
+            self.shape, self.dtype, self.codec, self.chunks)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+
+        return data if dtype is None else data.astype(dtype)
+
+    def section(self, section):
+        """
+        A lazy view of the (step 1) slices `section`, indexed like the
+        array itself and sharing its decompressed chunks.
+        """
+        return ChunkedSection(self, section)
+
+    def token(self):
+        """
+        Summary of the store for `ifupy.core.cache.token`, from its
+        metadata alone. Stores are rewritten whole by `write_chunked`, so
+        their metadata file changes whenever their data does.
+        """
+        stat = os.stat(os.path.join(self.path, 'meta.json'))
+
+        return ('chunked', os.path.abspath(self.path), stat.st_size,
+                stat.st_mtime, self.shape, self.dtype.str, self.chunks,
+                self.codec)
+
+    def __getitem__(self, key):
+        fancy = _split_fancy(key, self.shape)
+
+        if fancy is not None:
+            box, gather = fancy
+
+            return self[box][gather]
+
+        slices, drop = _normalize_key(key, self.shape)
+        ranges = [s.indices(n) for s, n in zip(slices, self.shape)]
+
+        # Read with positive steps, then flip the axes asked for reversed
+        flip = []
+
+        for axis, (start, stop, step) in enumerate(ranges):
+            if step < 0:
+                count = len(range(start, stop, step))
+                start = start + step * (count - 1) if count else 0
+                ranges[axis] = (start, start - step * count, -step)
+                flip.append(axis)
+
+        out_shape = tuple(len(range(*r)) for r in ranges)
+        out = np.empty(out_shape, dtype=self.dtype)
+
+        if out.size:
+            touched = [self._touched(axis, r) for axis, r in
+                       enumerate(ranges)]
+            ids = list(itertools.product(*[list(t) for t in touched]))
+            chunks = self._get_chunks(ids)
+
+            for index in ids:
+                source, target = [], []
+
+                for axis, (start, stop, step) in enumerate(ranges):
+                    c0 = index[axis] * self.chunks[axis]
+                    c1 = min(c0 + self.chunks[axis], self.shape[axis])
+                    k0 = max(0, -(-(c0 - start) // step))
+                    k1 = min(out_shape[axis], -(-(c1 - start) // step))
+                    first = start + step * k0 - c0
+                    source.append(slice(first, first + step * (k1 - k0),
+                                        step))
+                    target.append(slice(k0, k1))
+
+                out[tuple(target)] = chunks[index][tuple(source)]
+
+        for axis in flip:
+            out = np.flip(out, axis) if hasattr(np, 'flip') else \
+                out[(slice(None),) * axis + (slice(None, None, -1),)]
+
+        if drop:
+            out = out[tuple(0 if axis in drop else slice(None)
+                            for axis in range(out.ndim))]
+
+        return out
+
+    def _touched(self, axis, bounds):
+        """
+        Indices of the chunks along `axis` that a (positive step) range
+        selects elements of.
+        """
+        start, stop, step = bounds
+        size = self.chunks[axis]
+        last = start + step * (len(range(start, stop, step)) - 1)
+
+        if step <= size:
+            return range(start // size, last // size + 1)
+
+        return sorted(set(i // size for i in range(start, stop, step)))
+
+    def _get_chunks(self, ids):
+        """
+        The decompressed chunks `ids`, decompressing those not in memory
+        in the thread pool.
+        """
+        chunks = dict((index, self._cache.get(index)) for index in ids)
+        missing = [index for index, chunk in chunks.items() if chunk is None]
+
+        if missing:
+            with stage('decompress', chunks=len(missing)) as decompress:
+                if len(missing) == 1 or self.n_threads == 1:
+                    decoded = [self._read_chunk(i) for i in missing]
+                else:
+                    with ThreadPoolExecutor(self.n_threads) as executor:
+                        decoded = list(executor.map(self._read_chunk,
+                                                    missing))
+
+                decompress.nbytes = sum(chunk.nbytes for chunk in decoded)
+
+            for index, chunk in zip(missing, decoded):
+                chunks[index] = chunk
+                self._cache.set(index, chunk)
+
+        return chunks
+
+    def _read_chunk(self, index):
+        with open(os.path.join(self.path, _chunk_name(index)), 'rb') as f:
+            data = self._decompress(f.read())
+
+        shape = tuple(min(c, n - i * c)
+                      for i, c, n in zip(index, self.chunks, self.shape))
+
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+
+class ChunkedSection(object):
+    """
+    Rectangular part of a `ChunkedArray`, e.g. a `read_data` cutout.
+
+    Indexing it reads only the chunks under the requested part of the
+    section; converting it to an array reads the whole section.
+    """
+    def __init__(self, store, section):
+        slices, _ = _normalize_key(section, store.shape)
+        self.store = store
+        self.dtype = store.dtype
+        self.header = store.header
+        self._bounds = [s.indices(n) for s, n in zip(slices, store.shape)]
+
+        if any(step != 1 for _, _, step in self._bounds):
+            raise ValueError('Chunked sections must have a step of 1')
+
+        self.shape = tuple(max(stop - start, 0)
+                           for start, stop, _ in self._bounds)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return '<ChunkedSection {} of {!r}>'.format(self.shape, self.store)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+
+        return data if dtype is None else data.astype(dtype)
+
+    def token(self):
+        return self.store.token() + (tuple(self._bounds),)
+
+    def __getitem__(self, key):
+        fancy = _split_fancy(key, self.shape)
+
+        if fancy is not None:
+            box, gather = fancy
+
+            return self[box][gather]
+
+        slices, drop = _normalize_key(key, self.shape)
+        outer = []
+
+        # Shift the key into the coordinates of the whole array
+        for axis, (s, n, bounds) in enumerate(zip(slices, self.shape,
+                                                  self._bounds)):
+            offset = bounds[0]
+            start, stop, step = s.indices(n)
+
+            if axis in drop:
+                outer.append(offset + start)
+            elif stop < 0:
+                # A reversed slice running up to the section's first element
+                outer.append(slice(offset + start,
+                                   offset - 1 if offset else None, step))
+            else:
+                outer.append(slice(offset + start, offset + stop, step))
+
+        return self.store[tuple(outer)]
+
+
+def write_chunked(path, array_in, chunks=None, codec='zlib', level=6,
+                  header=None, n_threads=None):
+    """
+    Write an array (or `Cube`) as a store of independently compressed
+    chunks.
+
+    Parameters
+    ----------
+    path : string
+           Directory to write the store to; replaced if it exists.
+
+    array_in : numpy.ndarray or Cube
+               The data. Memory-mapped arrays are read one chunk at a
+               time.
+
+    chunks : tuple of ints, optional
+             Chunk shape (default is None, up to 128 frames by 64 x 64
+             spaxels for cubes).
+
+    codec : {'zlib', 'bz2', 'lzma', 'none'}, optional
+            Compression of every chunk (default is 'zlib'). 'lzma' needs
+            Python 3, or backports.lzma.
+
+    level : int, optional
+            Compression level (default is 6).
+
+    header : astropy.io.fits.Header, optional
+             Header to keep with the data (default is the `Cube`'s).
+
+    n_threads : int, optional
+                Threads compressing chunks (default is None, one per
+                CPU).
+
+    Returns
+    -------
+    chunked : ChunkedArray
+              The written store.
+    """
+    if codec not in CODECS:
+        raise ValueError("Codec '{}' is not available".format(codec))
+
+    if isinstance(array_in, Cube):
+        header = array_in.header if header is None else header
+        array_in = array_in.data
+
+    shape = array_in.shape
+
+    if chunks is None:
+        chunks = tuple(min(n, c) for n, c in zip(
+            shape, (128, 64, 64)[-len(shape):] if len(shape) <= 3
+            else (1,) * (len(shape) - 3) + (128, 64, 64)))
+
+    chunks = tuple(max(1, int(c)) for c in chunks)
+    dtype = array_in.dtype.newbyteorder('=')
+    compress = CODECS[codec][0]
+
+    def write(index):
+        block = array_in[tuple(slice(i * c, (i + 1) * c)
+                               for i, c in zip(index, chunks))]
+        data = np.ascontiguousarray(block, dtype=dtype)
+
+        with open(os.path.join(scratch, _chunk_name(index)), 'wb') as f:
+            f.write(compress(data.tobytes(), level))
+
+        return data.nbytes
+
+    grid = [range(-(-n // c)) for n, c in zip(shape, chunks)]
+
+    parent = os.path.dirname(os.path.abspath(path))
+    scratch = tempfile.mkdtemp(dir=parent, prefix='.chunked-')
+
+    try:
+        with stage('compress', codec=codec) as compressing:
+            with ThreadPoolExecutor(n_threads or
+                                    multiprocessing.cpu_count()) as executor:
+                compressing.nbytes = sum(executor.map(
+                    write, itertools.product(*grid)))
+
+        with open(os.path.join(scratch, 'meta.json'), 'w') as f:
+            json.dump({'version': _FORMAT_VERSION, 'shape': list(shape),
+                       'dtype': dtype.str, 'chunks': list(chunks),
+                       'codec': codec,
+                       'header': header.tostring() if header else None}, f)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+        os.rename(scratch, path)
+    except Exception:
+        shutil.rmtree(scratch, ignore_errors=True)
+        raise
+
+    log('chunked', 'Wrote', path, 'in', codec, 'chunks of', chunks)
+
+    return ChunkedArray(path, n_threads=n_threads)
+
+
+def is_chunked(path):
+    """
+    Whether `path` is a store written by `write_chunked`.
+    """
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+def _chunk_name(index):
+    return '.'.join(str(i) for i in index)
+
+
+def _normalize_key(key, shape):
+    """
+    Turn an index of integers, slices and an Ellipsis into one slice per
+    axis, and the axes given as integers (to drop afterwards).
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+
+    if any(k is Ellipsis for k in key):
+        at = [i for i, k in enumerate(key) if k is Ellipsis][0]
+        key = (key[:at] + (slice(None),) * (len(shape) - len(key) + 1) +
+               key[at + 1:])
+
+    if len(key) > len(shape):
+        raise IndexError('Too many indices for a {}-d array'.format(
+            len(shape)))
+
+    key = key + (slice(None),) * (len(shape) - len(key))
+    slices, drop = [], []
+
+    for axis, (k, n) in enumerate(zip(key, shape)):
+        if isinstance(k, slice):
+            slices.append(k)
+        elif isinstance(k, (int, np.integer)):
+            k = int(k) + n if k < 0 else int(k)
+
+            if not 0 <= k < n:
+                raise IndexError('Index {} is out of bounds for axis {} '
+                                 'with size {}'.format(k, axis, n))
+
+            slices.append(slice(k, k + 1))
+            drop.append(axis)
+        else:
+            raise IndexError('ChunkedArray only supports integers, slices, '
+                             'integer or boolean arrays and Ellipsis')
+
+    return slices, drop
+
+
+def _split_fancy(key, shape):
+    """
+    Split an index holding integer (or boolean) arrays into the box of
+    the array they select from, as integers and slices, and the numpy
+    index gathering the selection from that box. None if the index has
+    no arrays.
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+
+    expanded = []
+
+    for k in key:
+        if isinstance(k, (list, np.ndarray)):
+            k = np.asarray(k)
+
+            if k.dtype == bool:
+                # A mask stands for the indices of its True elements
+                expanded.extend(np.nonzero(k))
+                continue
+
+            if k.size == 0:
+                k = k.astype(int)
+            elif not np.issubdtype(k.dtype, np.integer):
+                raise IndexError('Arrays used as indices must be of '
+                                 'integer or boolean type')
+
+        expanded.append(k)
+
+    if not any(isinstance(k, np.ndarray) for k in expanded):
+        return None
+
+    if any(k is Ellipsis for k in expanded):
+        at = [i for i, k in enumerate(expanded) if k is Ellipsis][0]
+        expanded = (expanded[:at] +
+                    [slice(None)] * (len(shape) - len(expanded) + 1) +
+                    expanded[at + 1:])
+
+    if len(expanded) > len(shape):
+        raise IndexError('Too many indices for a {}-d array'.format(
+            len(shape)))
+
+    expanded += [slice(None)] * (len(shape) - len(expanded))
+    box, gather = [], []
+
+    for axis, (k, n) in enumerate(zip(expanded, shape)):
+        if isinstance(k, np.ndarray):
+            k = np.where(k < 0, k + n, k)
+
+            if k.size and (k.min() < 0 or k.max() >= n):
+                raise IndexError('Index out of bounds for axis {} with '
+                                 'size {}'.format(axis, n))
+
+            low = int(k.min()) if k.size else 0
+            box.append(slice(low, int(k.max()) + 1 if k.size else 0))
+            gather.append(k - low)
+        elif isinstance(k, (int, np.integer)):
+            # Integers stay in the gather, so that they combine with the
+            # arrays exactly as numpy combines them
+            k = int(k) + n if k < 0 else int(k)
+            box.append(slice(k, k + 1))
+            gather.append(0)
+        else:
+            box.append(k)
+            gather.append(slice(None))
+
+    return tuple(box), tuple(gather)
@@ -0,0 +1,215 @@
+from __future__ import print_function
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+from data_cube import header_shape
+from profiling import log, stage
+
+# Where converted cubes are kept by default
+CUBE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ifupy', 'cubes')
+
+# Bumped whenever the layout of converted cubes changes
+_FORMAT_VERSION = 1
+
+# Planes converted at a time, bounding memory for large cubes
+_CHUNK_BYTES = 2**26
+
+
+def cache_cube(data_file, directory=None):
+    """
+    Convert a FITS file into the binary cube cache, which `read_data`
+    then reads instead of the FITS file for as long as it is unchanged.
+
+    Every non-empty HDU is stored decoded (BZERO/BSCALE applied) and in
+    native byte order as a `.npy` file, so that re-opening it is a plain
+    memory map, with a JSON sidecar holding the headers and the source
+    file's size and modification time.
+
+    Parameters
+    ----------
+    data_file : string
+                Path to the FITS file.
+
+    directory : string, optional
+                Cache directory (default is `CUBE_CACHE_DIR`).
+
+    Returns
+    -------
+    path : string
+           The directory the cube was converted into.
+    """
+    path = _cache_path(data_file, directory)
+    parent = os.path.dirname(path)
+
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    # Convert aside and rename, so readers never see a partial cube
+    scratch = tempfile.mkdtemp(dir=parent, prefix='.convert-')
+    stat = os.stat(data_file)
+    hdus = []
+
+    try:
+        # Raw, memory-mapped data is scaled here a chunk at a time, rather
+        # than decoded whole by astropy
+        hdulist = fits.open(str(data_file), memmap=True,
+                            do_not_scale_image_data=True)
+
+        try:
+            for i, hdu in enumerate(hdulist):
+                shape = header_shape(hdu.header)
+
+                if len(shape) == 0 or 0 in shape:
+                    continue
+
+                with stage('convert', extension=i) as convert:
+                    convert.nbytes = _convert_hdu(
+                        hdu, os.path.join(scratch, '{}.npy'.format(i)))
+
+                header = hdu.header.copy()
+
+                for key in ('BSCALE', 'BZERO'):
+                    header.remove(key, ignore_missing=True)
+
+                hdus.append({'index': i, 'name': header.get('EXTNAME'),
+                             'file': '{}.npy'.format(i),
+                             'header': header.tostring()})
+        finally:
+            hdulist.close()
+
+        with open(os.path.join(scratch, 'cube.json'), 'w') as f:
+            json.dump({'version': _FORMAT_VERSION,
+                       'source': os.path.abspath(data_file),
+                       'size': stat.st_size, 'mtime': stat.st_mtime,
+                       'hdus': hdus}, f)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+        os.rename(scratch, path)
+    except Exception:
+        shutil.rmtree(scratch, ignore_errors=True)
+        raise
+
+    log('cube_cache', 'Cached', data_file, 'in', path)
+
+    return path
+
+
+def cached_hdus(data_file, directory=None):
+    """
+    The cached HDUs of a FITS file, as a list of (index, header, path)
+    tuples, or None if it is not cached or has changed since.
+    """
+    path = _cache_path(data_file, directory)
+
+    try:
+        with open(os.path.join(path, 'cube.json')) as f:
+            sidecar = json.load(f)
+
+        stat = os.stat(data_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if (sidecar.get('version') != _FORMAT_VERSION or
+            sidecar['size'] != stat.st_size or
+            sidecar['mtime'] != stat.st_mtime):
+        return None
+
+    return [(hdu['index'], fits.Header.fromstring(hdu['header']),
+             os.path.join(path, hdu['file'])) for hdu in sidecar['hdus']]
+
+
+def clear_cube_cache(directory=None):
+    """
+    Remove every converted cube.
+    """
+    shutil.rmtree(directory or CUBE_CACHE_DIR, ignore_errors=True)
+
+
+def _cache_path(data_file, directory):
+    """
+    Directory holding the converted copy of `data_file`, named after a
+    hash of its absolute path.
+    """
+    key = hashlib.sha1(os.path.abspath(data_file).encode('utf-8'))
+
+    return os.path.join(directory or CUBE_CACHE_DIR, key.hexdigest())
+
+
+def _convert_hdu(hdu, path):
+    """
+    Write the decoded, native-endian data of an HDU to a `.npy` file, a
+    chunk of planes at a time. Returns the number of bytes written.
+    """
+    header = hdu.header
+    raw = hdu.data
+    dtype = decoded_dtype(raw.dtype, header)
+
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                    shape=raw.shape)
+
+    plane_bytes = max(1, out[0].nbytes if out.ndim > 1 else out.nbytes)
+    n_planes = int(max(1, _CHUNK_BYTES // plane_bytes))
+
+    for start in range(0, len(out), n_planes):
+        out[start:start + n_planes] = decode(raw[start:start + n_planes],
+                                             header)
+
+    out.flush()
+    nbytes = out.nbytes
+    del out
+
+    return nbytes
+
+
+def decoded_dtype(raw_dtype, header):
+    """
+    The type raw FITS data of `raw_dtype` decodes to, as in astropy:
+    integers offset by BZERO to unsigned integers, other scaled data to
+    floats, and unscaled data to its native-endian self.
+    """
+    bscale, bzero = header.get('BSCALE', 1), header.get('BZERO', 0)
+
+    if (raw_dtype.kind == 'i' and bscale == 1 and
+            bzero == 2**(8 * raw_dtype.itemsize - 1)):
+        return np.dtype('u{}'.format(raw_dtype.itemsize))
+
+    if bscale != 1 or bzero != 0:
+        return np.dtype(np.float32 if raw_dtype.itemsize <= 2
+                        else np.float64)
+
+    return raw_dtype.newbyteorder('=')
+
+
+def decode(raw, header):
+    """
+    Apply the BZERO/BSCALE/BLANK keywords of `header` to (a chunk of)
+    raw FITS data, returning a new native-endian array.
+    """
+    bscale, bzero = header.get('BSCALE', 1), header.get('BZERO', 0)
+    blank = header.get('BLANK')
+    dtype = decoded_dtype(raw.dtype, header)
+
+    if dtype.kind == 'u' and raw.dtype.kind == 'i':
+        # Flipping the sign bit is the same as adding the offset
+        unsigned = raw.view(dtype.newbyteorder(raw.dtype.byteorder))
+
+        return (unsigned ^ np.array(bzero, dtype=unsigned.dtype)).astype(
+            dtype)
+
+    if bscale != 1 or bzero != 0:
+        scaled = raw * dtype.type(bscale) + dtype.type(bzero)
+
+        if blank is not None and raw.dtype.kind == 'i':
+            scaled[raw == blank] = np.nan
+
+        return scaled.astype(dtype, copy=False)
+
+    return np.array(raw, dtype=dtype)
@@ -1,44 +1,582 @@
 from __future__ import print_function
+import multiprocessing
+import weakref
+from collections import deque
+
 import numpy as np
 from astropy.io import fits
+from numpy.lib.mixins import NDArrayOperatorsMixin
+
+from concurrent.futures import ProcessPoolExecutor
+
+from parallel import _open_shared, file_view
+from spectral_axis import SpectralAxis
 
 
 class CubeCollection(object):
-    pass
+    """
+    A set of cubes, typically the same extension of many files, held as
+    lazy `CubeHandle` objects.
+
+    Members are indexed by shared header metadata (target, filter and
+    extension, or any other keyword), and batch operations stream the
+    members through a bounded pool of worker processes, loading each
+    cube only while it is being worked on.
+    """
+    # Friendly names for commonly indexed header keywords
+    keywords = {'target': 'OBJECT', 'filter': 'FILTER', 'extension': 'EXTNAME'}
+
+    def __init__(self, handles=()):
+        self.handles = list(handles)
+        self._primary_headers = {}
+
+    @classmethod
+    def from_files(cls, files, extensions=None):
+        """
+        Collect the non-empty HDUs of many FITS files, optionally only
+        those with the given EXTNAMEs.
+        """
+        from process_data import read_handles
+
+        handles = []
+
+        for data_file in files:
+            for handle in read_handles(data_file)[1]:
+                if (extensions is None or
+                        handle.header.get('EXTNAME') in extensions):
+                    handles.append(handle)
+
+        return cls(handles)
+
+    def __len__(self):
+        return len(self.handles)
+
+    def __iter__(self):
+        return iter(self.handles)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return CubeCollection(self.handles[item])
+
+        return self.handles[item]
+
+    def metadata(self, key):
+        """
+        The value of a header keyword (or one of the `keywords` names)
+        for every member, looked up in its own header first and then in
+        its file's primary header.
+        """
+        keyword = self.keywords.get(key, key)
+        values = []
+
+        for handle in self.handles:
+            value = handle.header.get(keyword)
+
+            if value is None:
+                value = self._primary_header(handle.path).get(keyword)
+
+            values.append(value)
+
+        return values
+
+    def index(self, key):
+        """
+        Map every value of `key` to the positions of the members with it.
+        """
+        index = {}
+
+        for i, value in enumerate(self.metadata(key)):
+            index.setdefault(value, []).append(i)
+
+        return index
+
+    def select(self, **criteria):
+        """
+        The members matching all criteria, e.g.
+        ``select(target='NGC 1068', extension='SCI')``.
+        """
+        keep = set(range(len(self)))
+
+        for key, value in criteria.items():
+            keep &= set(self.index(key).get(value, []))
+
+        return CubeCollection([self.handles[i] for i in sorted(keep)])
+
+    def map(self, func, n_workers=None, max_pending=None, **kwargs):
+        """
+        Apply `func(cube, **kwargs)` to every member, yielding results in
+        member order.
+
+        Parameters
+        ----------
+        func : callable
+               Module-level function taking a (lazily read) `Cube`.
+
+        n_workers : int, optional
+                    Number of worker processes (default is None, one per
+                    CPU). With a single worker, members are processed in
+                    the calling process.
+
+        max_pending : int, optional
+                      Most members submitted but not yet consumed (default
+                      is twice the number of workers). New members are only
+                      submitted as results are taken, so memory stays
+                      bounded however large the collection is.
+        """
+        n_workers = n_workers or multiprocessing.cpu_count()
+
+        if n_workers == 1:
+            for handle in self.handles:
+                yield _apply_member(handle.path, handle.extension, func,
+                                    kwargs)
+            return
+
+        max_pending = max_pending or 2 * n_workers
+        pending = deque()
+        members = iter(self.handles)
+
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            for handle in members:
+                pending.append(executor.submit(
+                    _apply_member, handle.path, handle.extension, func,
+                    kwargs))
+
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+
+    def collapse(self, n_workers=None, max_pending=None, **kwargs):
+        """
+        `collapse_slice` every member, stacked into (n_members, y, x).
+        """
+        return _stack(self.map(_collapse_member, n_workers=n_workers,
+                               max_pending=max_pending, **kwargs), len(self))
+
+    def extract(self, n_workers=None, max_pending=None, **kwargs):
+        """
+        `extract_spectra` from every member, stacked into (n_members,
+        n_spaxels, n_wave). Each member's own spectral axis is used unless
+        `cals` is given.
+        """
+        self._check_cals(kwargs.get('cals'))
 
+        return _stack(self.map(_extract_member, n_workers=n_workers,
+                               max_pending=max_pending, **kwargs), len(self))
 
-class Cube(object):
+    def fit(self, region, n_workers=None, max_pending=None, **kwargs):
+        """
+        `fit_lines` on every member, giving a dict of (n_members, y, x)
+        maps. Each member's own spectral axis is used unless `cals` is
+        given.
+        """
+        self._check_cals(kwargs.get('cals'))
+
+        return _stack(self.map(_fit_member, n_workers=n_workers,
+                               max_pending=max_pending, region=region,
+                               **kwargs), len(self))
+
+    def _check_cals(self, cals):
+        """
+        Fail before any work if `cals` is not given and a member has no
+        spectral calibration of its own.
+        """
+        if cals is not None:
+            return
+
+        for handle in self.handles:
+            if 'CRVAL3' not in handle.header:
+                raise ValueError('{}[{}] has no spectral calibration; pass '
+                                 'cals'.format(handle.path, handle.extension))
+
+    def _primary_header(self, path):
+        if path not in self._primary_headers:
+            self._primary_headers[path] = fits.getheader(path, 0)
+
+        return self._primary_headers[path]
+
+
+class Cube(NDArrayOperatorsMixin):
     """
     Core data object. A consistent format for all data-cube-style data. To
     be used with all IFU functionality.
+
+    `data` may also be a callable returning the array, in which case the
+    cube is lazy: nothing is read until the data is first accessed, and
+    `shape` is answered from the header. It may also be an indexable
+    store with a `shape` and `dtype` (e.g. a `ChunkedArray`): indexing the
+    cube then reads just the requested part from the store, and only
+    accessing `data` reads all of it.
+
+    Cubes take part in numpy arithmetic directly: operators and ufuncs act
+    on the underlying array and return new cubes, in-place operators
+    (``cube -= background``) and ``out=`` write into existing arrays
+    without allocating, and indexing returns views rather than copies
+    (except for slices read from a store).
+
+    The data of lazy cubes maps the file read-only, so that it can be
+    shared with worker processes by file. Writing through the cube (item
+    assignment, in-place operators and ``out=``) first re-maps it
+    copy-on-write: edits stay in memory and never reach the file.
     """
-    def __init__(self, name='', size=(1,), data=None):
+    def __init__(self, name='', size=(1,), data=None, header=None,
+                 copy=True):
         self.name = name
+        self.header = header
+        self._loader = None
+        self._store = None
+        self._spectral_axis = None
+        self._parent = None
+        self._generation = 0
         self._array = np.array(size)
 
-        if data is not None:
-            self._array = np.array(data)
+        # The file a lazy cube maps, as (path, size, mtime, extension,
+        # section), for as long as the cube is unedited
+        self.source = None
+
+        if callable(data):
+            self._loader = data
+            self._array = None
+        elif _is_store(data):
+            self._store = data
+            self._array = None
+        elif data is not None:
+            self._array = np.array(data) if copy else np.asarray(data)
+
+    @property
+    def data(self):
+        """
+        The underlying array. For lazy cubes this is a zero-copy
+        (memory-mapped) view; bytes are only read from disk when a slice
+        of it is accessed. It stays read-only until written through the
+        cube.
+        """
+        if self._array is None:
+            if self._store is not None:
+                self._array = np.asarray(self._store)
+                self._store = None
+            else:
+                self._array = np.asanyarray(self._loader())
+                self._loader = None
+
+        if self._parent is not None and not self._array.flags.writeable:
+            parent, item = self._parent
+
+            # The cube this view was taken from has been written to since
+            if parent.data.flags.writeable:
+                self._array = parent.data[item]
+
+        return self._array
+
+    @property
+    def is_loaded(self):
+        return self._array is not None
+
+    @property
+    def spectral_axis(self):
+        """
+        The wavelength calibration of the cube, built once from the header
+        (None for cubes without one).
+        """
+        if self._spectral_axis is None and self.header is not None:
+            if 'CRVAL3' in self.header:
+                self._spectral_axis = SpectralAxis.from_header(
+                    self.header, size=self.shape[0])
 
+        return self._spectral_axis
+
+    @property
     def shape(self):
-        return self._array.shape
+        if self._store is not None:
+            return tuple(self._store.shape)
 
-    def __add__(self, other):
-        return np.add(self, other)
+        if self._array is None and self.header is not None:
+            return header_shape(self.header)
 
-    def __sub__(self, other):
-        return np.add(self, -other)
+        return self.data.shape
 
-    def __mul__(self, other):
-        return np.multiply(self, other)
+    @property
+    def ndim(self):
+        return len(self.shape)
 
-    def __div__(self, other):
-        return np.division(self, other)
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    @property
+    def dtype(self):
+        if self._store is not None:
+            return self._store.dtype
+
+        return self.data.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        if copy:
+            return np.array(self.data, dtype=dtype)
+
+        return np.asarray(self.data, dtype=dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(x.data if isinstance(x, Cube) else x for x in inputs)
+        out = kwargs.get('out')
+
+        if out:
+            kwargs['out'] = tuple(x._writable() if isinstance(x, Cube)
+                                  else x for x in out)
+
+        result = getattr(ufunc, method)(*inputs, **kwargs)
+
+        # Results written in place are handed back as the objects given,
+        # which is what makes in-place operators work.
+        if out:
+            return out[0] if len(out) == 1 else out
+
+        if isinstance(result, tuple):
+            return tuple(self._wrap(x) for x in result)
+
+        return self._wrap(result)
+
+    def __getitem__(self, item):
+        if self._store is not None:
+            view = self._store[item]
+        else:
+            view = self.data[item]
+
+        if not isinstance(view, np.ndarray) or view.ndim == 0:
+            return view
+
+        cube = Cube(name=self.name, data=view, copy=False)
+
+        # Views write through to this cube
+        if self._store is None and np.may_share_memory(view, self.data):
+            cube._parent = (self, item)
+
+        # Keep the wavelength calibration of spectral slices
+        first = item[0] if isinstance(item, tuple) else item
+
+        if (view.ndim == self.ndim and isinstance(first, slice) and
+                self.spectral_axis is not None):
+            cube._spectral_axis = self.spectral_axis[first]
+
+        return cube
+
+    def __setitem__(self, item, value):
+        self._writable()[item] = (value.data if isinstance(value, Cube)
+                                  else value)
+
+    def _writable(self):
+        """
+        The data, about to be written to. Read-only file maps are re-mapped
+        copy-on-write, so only the pages written are copied into memory;
+        other read-only arrays are copied. Every call counts as a write
+        (to this cube and the cubes it is a view of) for `memoized`.
+        """
+        self._generation += 1
+
+        if self._parent is not None:
+            # The view's data follows its parent's once that is writable
+            self._parent[0]._writable()
+
+            return self.data
+
+        data = self.data
+
+        if data.flags.writeable:
+            return data
+
+        self.source = None
+        mapped = file_view(data)
+
+        if mapped is not None:
+            self._array = _open_shared(*mapped, mode='c')
+        else:
+            self._array = np.array(data)
 
-    def __call__(self):
         return self._array
 
+    def _wrap(self, result):
+        """
+        Wrap an array computed from this cube as a cube, keeping the
+        header and calibration when the shape is unchanged.
+        """
+        if not isinstance(result, np.ndarray) or result.ndim == 0:
+            return result
+
+        if result.shape != self.shape:
+            return Cube(name=self.name, data=result, copy=False)
+
+        cube = Cube(name=self.name, data=result, header=self.header,
+                    copy=False)
+        cube._spectral_axis = self._spectral_axis
+
+        return cube
+
+    def spaxel_index(self, aperture, subsample=5):
+        """
+        The spaxels covered by an `Aperture` and their weights, rasterized
+        once per aperture and image shape.
+        """
+        from apertures import spaxel_index
+
+        return spaxel_index(aperture, self.shape[-2:], subsample)
+
+    def extract_apertures(self, apertures, sky=None, region=None, **kwargs):
+        """
+        Sum the spectra inside apertures, optionally sky-subtracted, as in
+        `ifupy.arithmetic.extract_apertures`, using the cube's own
+        calibration.
+        """
+        from ifupy.arithmetic import extract_apertures
+
+        return extract_apertures(self.data, self.spectral_axis, apertures,
+                                 sky=sky, region=region, **kwargs)
+
+    def __call__(self):
+        return self.data
+
+
+class CubeHandle(object):
+    """
+    Lightweight reference to one HDU of a FITS file, standing in for the
+    `Cube` until its data is needed.
+
+    The header is read at most once, on demand. The loaded cube is only
+    held weakly, so its memory is released as soon as nothing else (e.g.
+    a viewer window) uses it, and is simply reloaded next time.
+    """
+    def __init__(self, path, extension, name='', header=None):
+        self.path = path
+        self.extension = extension
+        self.name = name
+        self._header = header
+        self._cube = None
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = fits.getheader(self.path, self.extension)
+
+        return self._header
+
+    @property
+    def shape(self):
+        return header_shape(self.header)
+
+    @property
+    def is_loaded(self):
+        return self._cube is not None and self._cube() is not None
+
+    def load(self):
+        """
+        The (lazily read) cube behind this handle.
+        """
+        cube = self._cube() if self._cube is not None else None
+
+        if cube is None:
+            from process_data import read_data
+
+            cube = read_data(self.path, lazy=True,
+                             extensions=[self.extension])[1][0]
+            cube.name = self.name
+            self._cube = weakref.ref(cube)
+
+        return cube
+
+    def __repr__(self):
+        return '<CubeHandle: {}[{}]>'.format(self.path, self.extension)
+
+
+def _apply_member(path, extension, func, kwargs):
+    """
+    Load one collection member (in a worker) and apply `func` to it.
+    """
+    cube = CubeHandle(path, extension).load()
+
+    return func(cube, **kwargs)
+
+
+def _collapse_member(cube, **kwargs):
+    from ifupy.arithmetic import collapse_slice
+
+    return collapse_slice(cube(), **kwargs)
+
+
+def _extract_member(cube, **kwargs):
+    from ifupy.arithmetic import extract_spectra
+
+    cals = kwargs.pop('cals', None)
+
+    if cals is None:
+        cals = cube.spectral_axis
+
+    return extract_spectra(cube(), cals, **kwargs)[1]
+
+
+def _fit_member(cube, region, **kwargs):
+    from ifupy.analysis import fit_lines
+
+    cals = kwargs.pop('cals', None)
+
+    if cals is None:
+        cals = cube.spectral_axis
+
+    return fit_lines(cube(), cals, region, **kwargs)
+
+
+def _stack(results, n):
+    """
+    Stack a stream of equally shaped results (arrays, or dicts of them)
+    into preallocated arrays with a leading member axis.
+    """
+    stacked = None
+
+    for i, result in enumerate(results):
+        if isinstance(result, dict):
+            if stacked is None:
+                stacked = dict((key, np.empty((n,) + np.shape(value)))
+                               for key, value in result.items())
+
+            for key, value in result.items():
+                stacked[key][i] = value
+        else:
+            if stacked is None:
+                stacked = np.empty((n,) + np.shape(result),
+                                   dtype=np.asarray(result).dtype)
+
+            stacked[i] = result
+
+    return stacked
+
+
+def _is_store(data):
+    """
+    Whether `data` is an array-like store that cubes index directly
+    rather than read whole, such as a `ChunkedArray`.
+    """
+    return (data is not None and hasattr(data, 'shape') and
+            hasattr(data, 'dtype') and hasattr(data, '__getitem__') and
+            not isinstance(data, (np.ndarray, np.generic, Cube)))
+
+
+def header_shape(header):
+    """
+    Shape of the data described by a FITS header, in numpy (C) order,
+    without touching the data itself.
+    """
+    naxis = header.get('NAXIS', 0)
+
+    return tuple(header['NAXIS{}'.format(i)] for i in range(naxis, 0, -1))
+
 
 if __name__ == '__main__':
     first = Cube([3,3])
     second = Cube([3,3]) * 10
-    print(first + second)
\ No newline at end of file
+    print(first + second)
@@ -0,0 +1,339 @@
+from __future__ import print_function
+import contextlib
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+def map_tiles(func, array_in, tile_shape=None, n_workers=None, args=(),
+              kwargs=None, spatial=(), progress=None):
+    """
+    Apply a per-spaxel operation to a datacube in spatial tiles, spread
+    over a pool of worker processes.
+
+    The cube is never pickled: read-only memory maps of a file (such as
+    the unedited cubes of `read_data(..., lazy=True)`) are re-opened by
+    file name in every worker, and any other cube (including lazy cubes
+    edited in memory) is written once to a temporary memory map that all
+    workers share. Results are placed by tile position, so
+    the output does not depend on the number of workers or on the order
+    in which tiles finish.
+
+    Parameters
+    ----------
+    func : callable
+           Module-level function called as
+           ``func(tile, *spatial_tiles, *args, **kwargs)``, where `tile`
+           is an (nz, ty, tx) block of the cube. It must return an array
+           whose last two axes are (ty, tx).
+
+    array_in : numpy.ndarray or Cube
+               Input datacube.
+
+    tile_shape : tuple of ints, optional
+                 The (ty, tx) size of the tiles (default is None, the cube
+                 is cut into full-width strips of rows, a few per worker).
+
+    n_workers : int, optional
+                Number of worker processes (default is None, one per CPU).
+                With a single worker the tiles are processed in the
+                calling process.
+
+    args : tuple, optional
+           Extra positional arguments passed to `func`.
+
+    kwargs : dict, optional
+             Extra keyword arguments passed to `func`.
+
+    spatial : sequence of numpy.ndarray, optional
+              Spatial (y, x) arrays, e.g. masks, cut to each tile and
+              passed to `func` after the data tile.
+
+    progress : callable, optional
+               Called as ``progress(fraction)`` in the calling process as
+               tiles are done. Raising from it (e.g. to cancel) stops the
+               computation: tiles not yet started are dropped and the
+               exception is passed on.
+
+    Returns
+    -------
+    result : numpy.ndarray
+             The tile results reassembled to (..., ny, nx).
+    """
+    if callable(array_in):
+        array_in = array_in()
+
+    kwargs = kwargs or {}
+    n_workers = n_workers or multiprocessing.cpu_count()
+    ny, nx = array_in.shape[1:]
+
+    if tile_shape is None:
+        tile_shape = (max(1, -(-ny // (4 * n_workers))), nx)
+
+    tiles = [(y, min(y + tile_shape[0], ny), x, min(x + tile_shape[1], nx))
+             for y in range(0, ny, tile_shape[0])
+             for x in range(0, nx, tile_shape[1])]
+
+    result = None
+
+    if n_workers == 1:
+        results = (_run_tile(array_in, bounds, func, spatial, args, kwargs)
+                   for bounds in tiles)
+
+        for done, (bounds, tile_result) in enumerate(results, 1):
+            result = _place_tile(result, bounds, tile_result, (ny, nx))
+            _report(progress, done, len(tiles))
+
+        return result
+
+    source, scratch = _share(array_in)
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_run_tile, source, bounds, func,
+                                       [s[bounds[0]:bounds[1],
+                                          bounds[2]:bounds[3]]
+                                        for s in spatial],
+                                       args, kwargs, True)
+                       for bounds in tiles]
+
+            with _cancelling(futures):
+                for done, future in enumerate(futures, 1):
+                    bounds, tile_result = future.result()
+                    result = _place_tile(result, bounds, tile_result,
+                                         (ny, nx))
+                    _report(progress, done, len(futures))
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    return result
+
+
+def map_chunks(func, array_in, chunk_size, n_workers=None, args=(),
+               kwargs=None, progress=None):
+    """
+    Apply a per-plane operation to a datacube in chunks of whole
+    wavelength planes, spread over a pool of worker processes.
+
+    This is the counterpart of `map_tiles` for operations that need
+    complete images, such as spatial convolution; cubes are shared with
+    the workers in the same way.
+
+    Parameters
+    ----------
+    func : callable
+           Module-level function called as ``func(chunk, *args,
+           **kwargs)``, where `chunk` is an (n, ny, nx) block of planes.
+           It must return an array whose first axis is n.
+
+    array_in : numpy.ndarray or Cube
+               Input datacube.
+
+    chunk_size : int
+                 Number of planes per chunk.
+
+    n_workers : int, optional
+                Number of worker processes (default is None, one per CPU).
+                With a single worker the chunks are processed in the
+                calling process.
+
+    args : tuple, optional
+           Extra positional arguments passed to `func`.
+
+    kwargs : dict, optional
+             Extra keyword arguments passed to `func`.
+
+    progress : callable, optional
+               Called as ``progress(fraction)`` as chunks are done, see
+               `map_tiles`.
+
+    Returns
+    -------
+    result : numpy.ndarray
+             The chunk results reassembled along the first axis.
+    """
+    if callable(array_in):
+        array_in = array_in()
+
+    kwargs = kwargs or {}
+    n_workers = n_workers or multiprocessing.cpu_count()
+    nz = array_in.shape[0]
+    chunks = [(z, min(z + chunk_size, nz)) for z in range(0, nz, chunk_size)]
+
+    result = None
+
+    if n_workers == 1:
+        for done, bounds in enumerate(chunks, 1):
+            result = _place_chunk(result, bounds, _run_chunk(
+                array_in, bounds, func, args, kwargs)[1], nz)
+            _report(progress, done, len(chunks))
+
+        return result
+
+    source, scratch = _share(array_in)
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_run_chunk, source, bounds, func, args,
+                                       kwargs, True)
+                       for bounds in chunks]
+
+            with _cancelling(futures):
+                for done, future in enumerate(futures, 1):
+                    bounds, chunk_result = future.result()
+                    result = _place_chunk(result, bounds, chunk_result, nz)
+                    _report(progress, done, len(futures))
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    return result
+
+
+def _report(progress, done, total):
+    if progress is not None:
+        progress(float(done) / total)
+
+
+@contextlib.contextmanager
+def _cancelling(futures):
+    """
+    Cancel the futures that have not started yet if the block raises, so
+    that leaving the executor only waits for the ones already running.
+    """
+    try:
+        yield
+    except BaseException:
+        for future in futures:
+            future.cancel()
+
+        raise
+
+
+def _run_chunk(source, bounds, func, args, kwargs, shared=False):
+    """
+    Cut one chunk of planes out of the cube (re-opening shared cubes) and
+    apply `func` to it.
+    """
+    z0, z1 = bounds
+    array_in = _open_shared(*source) if shared else source
+
+    return bounds, func(np.asarray(array_in[z0:z1]), *args, **kwargs)
+
+
+def _place_chunk(result, bounds, chunk_result, nz):
+    """
+    Copy a chunk result into the full output, allocating it on first use.
+    """
+    chunk_result = np.asarray(chunk_result)
+
+    if result is None:
+        result = np.empty((nz,) + chunk_result.shape[1:],
+                          dtype=chunk_result.dtype)
+
+    result[bounds[0]:bounds[1]] = chunk_result
+
+    return result
+
+
+def _run_tile(source, bounds, func, spatial, args, kwargs, shared=False):
+    """
+    Cut one tile out of the cube (re-opening shared cubes) and apply
+    `func` to it.
+    """
+    y0, y1, x0, x1 = bounds
+    array_in = _open_shared(*source) if shared else source
+    tile = np.asarray(array_in[:, y0:y1, x0:x1])
+
+    if not shared:
+        spatial = [s[y0:y1, x0:x1] for s in spatial]
+
+    return bounds, func(tile, *(list(spatial) + list(args)), **kwargs)
+
+
+def _place_tile(result, bounds, tile_result, spatial_shape):
+    """
+    Copy a tile result into the full output, allocating it on first use.
+    """
+    tile_result = np.asarray(tile_result)
+
+    if result is None:
+        result = np.empty(tile_result.shape[:-2] + spatial_shape,
+                          dtype=tile_result.dtype)
+
+    y0, y1, x0, x1 = bounds
+    result[..., y0:y1, x0:x1] = tile_result
+
+    return result
+
+
+def _share(array_in):
+    """
+    Describe a file that workers can map to see `array_in` without a
+    copy, writing the array to a scratch memory map if it does not
+    already live in one.
+
+    Returns the (filename, offset, dtype, shape, strides) description and
+    the scratch directory to remove afterwards, if any.
+    """
+    source = file_view(array_in)
+
+    if source is not None:
+        return source, None
+
+    scratch = tempfile.mkdtemp(prefix='ifupy-')
+    shared = np.lib.format.open_memmap(os.path.join(scratch, 'cube.npy'),
+                                       mode='w+', dtype=array_in.dtype,
+                                       shape=array_in.shape)
+    shared[...] = array_in
+    shared.flush()
+    del shared
+
+    readonly = np.load(os.path.join(scratch, 'cube.npy'), mmap_mode='r')
+
+    return file_view(readonly), scratch
+
+
+def file_view(array_in):
+    """
+    Locate the file bytes behind a (view of a) memory-mapped array.
+
+    Returns the (filename, offset, dtype, shape, strides) needed to map
+    the same view again, or None for arrays that are not file-backed or
+    whose memory may differ from the file: copy-on-write maps can hold
+    private edits, and writable maps can still be changed.
+    """
+    root = array_in
+
+    while isinstance(root, np.ndarray) and not isinstance(root.base, mmap.mmap):
+        root = root.base
+
+    if not isinstance(root, np.memmap) or root.filename is None:
+        return None
+
+    if root.mode != 'r':
+        return None
+
+    delta = (array_in.__array_interface__['data'][0] -
+             root.__array_interface__['data'][0])
+
+    return (root.filename, root.offset + delta, array_in.dtype.str,
+            array_in.shape, array_in.strides)
+
+
+def _open_shared(filename, offset, dtype, shape, strides, mode='r'):
+    """
+    Map the view described by `_share` (or `file_view`) again, e.g. in a
+    worker process, or copy-on-write with mode 'c'.
+    """
+    buffer = np.memmap(filename, dtype=np.uint8, mode=mode)
+
+    return np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset,
+                      strides=strides)
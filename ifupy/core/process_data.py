@@ -1,16 +1,391 @@
+import os
+
+import numpy as np
 from astropy.io import fits
-from data_cube import Cube
+from chunked import ChunkedArray, is_chunked
+from cube_cache import cached_hdus, decode
+from data_cube import Cube, CubeHandle, header_shape
+from profiling import stage
+from spectral_axis import SpectralAxis
+
+
+def read_data(data_file, lazy=False, extensions=None, region=None,
+              wave_region=None, bbox=None, use_cache=True):
+    """
+    Read the non-empty HDUs of a FITS file (or a chunked store written
+    by `write_chunked`) into a list of `Cube` objects.
+
+    Parameters
+    ----------
+    data_file : string
+                Path to the FITS file or chunked store.
+
+    lazy : bool, optional
+           Open the file memory-mapped and defer reading (default is False,
+           every extension is read into memory). Lazy cubes only hold the
+           header up front, and their data is a zero-copy view onto the
+           file that is read from disk as slices are accessed.
+
+    extensions : list of strings or ints, optional
+                 Names (EXTNAME) or indices of the HDUs to read (default is
+                 None, every non-empty HDU is read).
+
+    region : list of ints, [begin, end], optional
+             Frames of the spectral axis to read, end-exclusive.
+
+    wave_region : list of floats, [begin, end], optional
+                  Wavelength window to read, converted to frames with the
+                  header's spectral calibration. Overrides `region`.
+                  Extensions without a spectral calibration (e.g. ERR or
+                  DQ) use that of the cube read before them, and raise a
+                  ValueError if there is none.
+
+    bbox : list of ints, [x0, x1, y0, y1], optional
+           Spatial cutout to read, end-exclusive.
+
+    use_cache : bool, optional
+                Read the binary copy of the file made by `cache_cube`, if
+                there is one and the file has not changed since (default
+                is True).
+
+    Returns
+    -------
+    name : string
+           Base name of the file.
+
+    data_collection : list of Cube
+                      One cube per HDU read.
 
+    Notes
+    -----
+    Cutouts are read through FITS section access, so only the bytes they
+    cover are read from disk, and their headers' reference pixels and
+    sizes are updated to match.
+
+    Cached copies are native-endian and already decoded, so they are
+    simply memory-mapped.
+
+    Chunked stores hold a single cube; only the chunks a cutout touches
+    are decompressed, in parallel. Lazy cubes keep the store and
+    decompress only the chunks under each slice taken from them (as
+    `collapse_slice` and `extract_spectra` do); accessing their `data`
+    decompresses the whole cutout.
+    """
+    if is_chunked(data_file):
+        name = os.path.basename(os.path.normpath(data_file)).split(".")[0]
+        store = ChunkedArray(data_file)
+        header = store.header if store.header is not None else fits.Header()
+        axis = _spectral_axis(header, store.shape)
+        section = _section(header, store.shape, region, wave_region, bbox,
+                           axis)
+
+        if section is not None:
+            header = _section_header(header, section)
+
+        if lazy:
+            data = store.section(section) if section is not None else store
+        else:
+            with stage('read') as read:
+                data = store[section if section is not None else Ellipsis]
+                read.nbytes = data.nbytes
+
+        return name, [Cube(data=data, header=header, name=name + '1',
+                           copy=False)]
 
-def read_data(data_file):
     if ".fits" in data_file:
         name = data_file.split("/")[-1].split(".")[-2]
-        hdulist = fits.open(str(data_file))
         data_collection = []
 
-        for i in range(len(hdulist)):
-            if hdulist[i].data.size > 0:
-                data_cube = Cube(data=hdulist[i].data, name=name + str(i+1))
+        cached = cached_hdus(data_file) if use_cache else None
+
+        axis = None
+
+        if cached is not None:
+            for i, header, path in _select_cached(cached, extensions):
+                shape = header_shape(header)
+                axis = _spectral_axis(header, shape, axis)
+                section = _section(header, shape, region, wave_region, bbox,
+                                   axis)
+
+                if section is not None:
+                    header = _section_header(header, section)
+
+                data = _npy_loader(path, section)
+
+                if not lazy:
+                    with stage('read', extension=i) as read:
+                        data = np.array(data())
+                        read.nbytes = data.nbytes
+
+                data_cube = Cube(data=data, header=header,
+                                 name=name + str(i+1), copy=False)
+
+                # The cached copy holds the same values as the file
+                if lazy:
+                    data_cube.source = _source(data_file, i, section)
+
                 data_collection.append(data_cube)
 
+            return name, data_collection
+
+        if lazy:
+            # Image data is mapped straight from the file by _hdu_loader;
+            # scaled (BZERO/BSCALE) data is decoded from that map when the
+            # cube is first accessed, covering only the requested section.
+            hdulist = fits.open(str(data_file), memmap=True,
+                                lazy_load_hdus=True,
+                                do_not_scale_image_data=True)
+        else:
+            hdulist = fits.open(str(data_file))
+
+        for i, hdu in _select_hdus(hdulist, extensions):
+            header = hdu.header
+            shape = header_shape(header)
+
+            if len(shape) == 0 or 0 in shape:
+                continue
+
+            axis = _spectral_axis(header, shape, axis)
+            section = _section(header, shape, region, wave_region, bbox,
+                               axis)
+
+            if section is not None:
+                header = _section_header(header, section)
+
+            if lazy:
+                data = _hdu_loader(hdu, data_file, section)
+
+                # The cube holds decoded values
+                if _is_scaled(header):
+                    header = header.copy()
+
+                    for key in ('BSCALE', 'BZERO'):
+                        header.remove(key, ignore_missing=True)
+            else:
+                with stage('read', extension=i) as read:
+                    if section is not None:
+                        data = hdu.section[section]
+                    else:
+                        data = hdu.data
+
+                    read.nbytes = data.nbytes
+
+            data_cube = Cube(data=data, header=header, name=name + str(i+1))
+
+            if lazy:
+                data_cube.source = _source(data_file, i, section)
+
+            data_collection.append(data_cube)
+
         return name, data_collection
+
+
+def read_handles(data_file):
+    """
+    List the non-empty HDUs of a FITS file as `CubeHandle` objects,
+    without reading any data.
+
+    Parameters
+    ----------
+    data_file : string
+                Path to the FITS file.
+
+    Returns
+    -------
+    name : string
+           Base name of the file.
+
+    handles : list of CubeHandle
+              One handle per non-empty HDU.
+    """
+    name = data_file.split("/")[-1].split(".")[-2]
+    handles = []
+    hdulist = fits.open(str(data_file), memmap=True, lazy_load_hdus=True)
+
+    try:
+        for i, hdu in enumerate(hdulist):
+            shape = header_shape(hdu.header)
+
+            if len(shape) > 0 and 0 not in shape:
+                handles.append(CubeHandle(data_file, i, name=name + str(i+1),
+                                          header=hdu.header.copy()))
+    finally:
+        hdulist.close()
+
+    return name, handles
+
+
+def _select_hdus(hdulist, extensions):
+    """
+    The (index, HDU) pairs to read, in file order when not selected.
+    """
+    if extensions is None:
+        return enumerate(hdulist)
+
+    index = [hdulist.index_of(ext) for ext in extensions]
+
+    return [(i, hdulist[i]) for i in index]
+
+
+def _select_cached(cached, extensions):
+    """
+    The cached (index, header, path) entries to read, selected by index or
+    EXTNAME like `_select_hdus`.
+    """
+    if extensions is None:
+        return cached
+
+    by_index = dict((entry[0], entry) for entry in cached)
+    by_name = dict((str(entry[1].get('EXTNAME', '')).upper(), entry)
+                   for entry in cached)
+
+    return [by_index[ext] if isinstance(ext, int) else by_name[ext.upper()]
+            for ext in extensions]
+
+
+def _spectral_axis(header, shape, previous=None):
+    """
+    The spectral axis of a cube HDU, from its header, or else the axis of
+    the cube read before it when they have the same length (ERR and DQ
+    extensions often leave out the WCS of the SCI one).
+    """
+    if len(shape) != 3:
+        return previous
+
+    if 'CRVAL3' in header:
+        return SpectralAxis.from_header(header, size=shape[0])
+
+    if previous is not None and previous.size == shape[0]:
+        return previous
+
+    return None
+
+
+def _section(header, shape, region, wave_region, bbox, axis=None):
+    """
+    Slices selecting the requested spectral range and spatial cutout from
+    an HDU, or None to read all of it.
+    """
+    if len(shape) not in (2, 3):
+        return None
+
+    section = [slice(None)] * len(shape)
+
+    if len(shape) == 3:
+        if wave_region is not None:
+            if axis is None:
+                raise ValueError('Extension {} has no spectral calibration '
+                                 'to select wave_region with'.format(
+                                     header.get('EXTNAME', '(unnamed)')))
+
+            region = axis.region_to_frames(wave_region)
+
+        if region is not None:
+            section[0] = slice(*region)
+
+    if bbox is not None:
+        section[-1] = slice(bbox[0], bbox[1])
+        section[-2] = slice(bbox[2], bbox[3])
+
+    if all(s == slice(None) for s in section):
+        return None
+
+    return tuple(section)
+
+
+def _section_header(header, section):
+    """
+    A copy of `header` describing the cutout `section`, with the sizes
+    and reference pixels of the cut axes shifted to match.
+    """
+    header = header.copy()
+    shape = header_shape(header)
+
+    for n, (s, size) in enumerate(zip(section, shape)):
+        axis = len(shape) - n
+        start, stop, _ = s.indices(size)
+
+        header['NAXIS{}'.format(axis)] = max(stop - start, 0)
+
+        if 'CRPIX{}'.format(axis) in header:
+            header['CRPIX{}'.format(axis)] -= start
+
+    return header
+
+
+def _source(data_file, extension, section):
+    """
+    Identity of the data a lazy cube maps from a file, as of now.
+    """
+    stat = os.stat(data_file)
+
+    if section is not None:
+        section = tuple((s.start, s.stop, s.step) for s in section)
+
+    return (os.path.abspath(data_file), stat.st_size, stat.st_mtime,
+            extension, section)
+
+
+def _hdu_loader(hdu, data_file, section=None):
+    """
+    Deferred accessor for the data of a memory-mapped HDU.
+
+    Unscaled data is handed out as a read-only `numpy.memmap` of the
+    file: bytes are only read as slices are accessed, and worker
+    processes can map the same file instead of a copy. Writing through
+    the `Cube` re-maps it copy-on-write, so edits stay in memory rather
+    than reaching the file. Scaled data is decoded into memory from the
+    same map, reading just the requested section, and is read-only too.
+    """
+    def load():
+        header = hdu.header
+
+        if (isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) and
+                hdu.fileinfo() is not None):
+            data = np.memmap(str(data_file), mode='r',
+                             dtype=_BITPIX_DTYPES[header['BITPIX']],
+                             offset=hdu.fileinfo()['datLoc'],
+                             shape=header_shape(header))
+
+            if section is not None:
+                data = data[section]
+        elif section is not None:
+            # Anything else (e.g. tile-compressed data) is read by astropy
+            data = hdu.section[section]
+        else:
+            data = hdu.data
+
+        if _is_scaled(header):
+            data = decode(data, header)
+
+        # Lazy data is only ever written through its cube
+        data.flags.writeable = False
+
+        return data
+
+    return load
+
+
+def _is_scaled(header):
+    return header.get('BSCALE', 1) != 1 or header.get('BZERO', 0) != 0
+
+
+def _npy_loader(path, section=None):
+    """
+    Deferred accessor for a cached (`.npy`) HDU, memory-mapped read-only
+    like `_hdu_loader` (cubes read from it still copy on write).
+    """
+    def load():
+        data = np.load(path, mmap_mode='r')
+
+        if section is not None:
+            return data[section]
+
+        return data
+
+    return load
+
+
+# FITS stores all data big-endian
+_BITPIX_DTYPES = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8',
+                  -32: '>f4', -64: '>f8'}
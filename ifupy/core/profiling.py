@@ -0,0 +1,272 @@
+from __future__ import print_function
+import functools
+import json
+import os
+import threading
+import timeit
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory is then not recorded
+    resource = None
+
+# The active trace, if any
+_trace = None
+
+# Whether progress messages are printed (off unless asked for)
+_verbose = False
+
+
+class Trace(object):
+    """
+    Record of the stages run while profiling: their name and category,
+    start and duration, the bytes of data they touched, the peak memory
+    of the process when they finished, and the log messages in between.
+    """
+    def __init__(self):
+        self.events = []
+        self._origin = timeit.default_timer()
+
+    def _now(self):
+        return timeit.default_timer() - self._origin
+
+    def add(self, name, category, start, duration, nbytes=0, **args):
+        self.events.append({'name': name, 'cat': category, 'start': start,
+                            'duration': duration, 'bytes': nbytes,
+                            'peak_rss': _peak_rss(),
+                            'thread': threading.current_thread().ident,
+                            'args': args})
+
+    def summary(self):
+        """
+        Total calls, time (s) and bytes per stage name.
+        """
+        totals = {}
+
+        for event in self.events:
+            if event['cat'] == 'log':
+                continue
+
+            total = totals.setdefault(event['name'], {'calls': 0, 'time': 0.,
+                                                      'bytes': 0})
+            total['calls'] += 1
+            total['time'] += event['duration']
+            total['bytes'] += event['bytes']
+
+        return totals
+
+    def to_json(self, path=None):
+        """
+        The events as JSON, written to `path` if given.
+        """
+        return _dump({'events': self.events, 'summary': self.summary()},
+                     path)
+
+    def to_chrome(self, path=None):
+        """
+        The events in Chrome's trace event format, for chrome://tracing
+        or Perfetto, written to `path` if given.
+        """
+        events = []
+
+        for event in self.events:
+            args = dict(event['args'], bytes=event['bytes'],
+                        peak_rss=event['peak_rss'])
+            chrome = {'name': event['name'], 'cat': event['cat'],
+                      'ts': event['start'] * 1e6, 'pid': os.getpid(),
+                      'tid': event['thread'], 'args': args}
+
+            if event['cat'] == 'log':
+                chrome.update(ph='i', s='t')
+            else:
+                chrome.update(ph='X', dur=event['duration'] * 1e6)
+
+            events.append(chrome)
+
+        return _dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, path)
+
+
+class _Stage(object):
+    """
+    Context manager timing one stage into the active trace.
+    """
+    def __init__(self, trace, name, category, nbytes, args):
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.nbytes = nbytes
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.trace._now()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.name, self.category, self.start,
+                       self.trace._now() - self.start, self.nbytes,
+                       **self.args)
+
+
+class _NullStage(object):
+    """
+    Shared do-nothing stand-in for `_Stage` while profiling is off.
+    """
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+def enable_profiling(trace=None):
+    """
+    Start recording stages into `trace` (default is a new `Trace`).
+
+    Returns
+    -------
+    trace : Trace
+            The now active trace.
+    """
+    global _trace
+    _trace = trace if trace is not None else Trace()
+
+    return _trace
+
+
+def disable_profiling():
+    global _trace
+    _trace = None
+
+
+@contextmanager
+def profile(trace=None, verbose=None):
+    """
+    Record the stages run inside a ``with`` block.
+
+    Parameters
+    ----------
+    trace : Trace, optional
+            Trace to record into (default is a new one).
+
+    verbose : bool, optional
+              Whether to print progress messages inside the block
+              (default is None, unchanged).
+
+    Example usage:
+
+        1. >> with profile() as trace:
+           ..     collapse_slice(cube, method='median', sigma=3.)
+           >> trace.to_chrome('collapse.json')
+    """
+    global _trace, _verbose
+    previous = _trace, _verbose
+    _trace = trace if trace is not None else Trace()
+
+    if verbose is not None:
+        _verbose = verbose
+
+    try:
+        yield _trace
+    finally:
+        _trace, _verbose = previous
+
+
+def set_verbose(verbose):
+    """
+    Turn the progress messages of ifupy functions on or off (default
+    is off).
+    """
+    global _verbose
+    _verbose = verbose
+
+
+def stage(name, nbytes=0, category='stage', **args):
+    """
+    Context manager timing a stage (e.g. 'read', 'clip', 'reduce') of the
+    enclosing computation. While profiling is off it does nothing.
+
+    Parameters
+    ----------
+    name : string
+           Stage name.
+
+    nbytes : int, optional
+             Bytes of data the stage touches.
+
+    Any other keyword arguments are recorded with the stage.
+    """
+    if _trace is None:
+        return _null_stage
+
+    return _Stage(_trace, name, category, nbytes, args)
+
+
+def profiled(name=None):
+    """
+    Decorator timing every call of a function as a stage, named after
+    the function by default.
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _trace is None:
+                return func(*args, **kwargs)
+
+            with _Stage(_trace, stage_name, 'call', 0, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def log(source, *values):
+    """
+    Report progress, as ``(source): values...``.
+
+    Messages are printed once turned on with `set_verbose`, and are
+    recorded as instant events while profiling.
+    """
+    if not _verbose and _trace is None:
+        return
+
+    message = ' '.join(str(value) for value in values)
+
+    if _verbose:
+        print('({}): {}'.format(source, message))
+
+    if _trace is not None:
+        _trace.add(message, 'log', _trace._now(), 0., source=source)
+
+
+def _peak_rss():
+    """
+    Peak resident memory of the process so far, in bytes.
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Kilobytes on Linux, bytes on macOS
+    return peak if os.uname()[0] == 'Darwin' else peak * 1024
+
+
+def _dump(content, path):
+    text = json.dumps(content, indent=1, default=str)
+
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write(text)
+
+    return text
@@ -0,0 +1,143 @@
+from __future__ import print_function
+import numpy as np
+
+
+class SpectralAxis(object):
+    """
+    Wavelength calibration of a datacube's spectral (z) axis.
+
+    Linear axes are described by the same (crpix, crval, crdelt) values
+    as the `cals` used throughout `ifupy.arithmetic`, with 0-based frames.
+    Non-linear axes are described by an explicit wavelength per frame.
+    The wavelength grid is computed once and cached, and wavelengths are
+    converted to frames with vectorized arithmetic (or a binary search
+    for non-linear grids), never by scanning the grid.
+    """
+    def __init__(self, crpix=0., crval=0., crdelt=1., size=None,
+                 wavelengths=None):
+        self.crpix = float(crpix)
+        self.crval = float(crval)
+        self.crdelt = float(crdelt)
+        self._wavelengths = None
+
+        if wavelengths is not None:
+            self._wavelengths = np.asarray(wavelengths, dtype=float)
+            size = len(self._wavelengths)
+
+        self.size = size
+
+    @classmethod
+    def from_header(cls, header, size=None, axis=3):
+        """
+        Build the spectral axis from the WCS keywords of a FITS header.
+        FITS reference pixels are 1-based; frames here are 0-based.
+        """
+        crdelt = header.get('CDELT{}'.format(axis),
+                            header.get('CD{0}_{0}'.format(axis), 1.))
+
+        if size is None:
+            size = header.get('NAXIS{}'.format(axis))
+
+        return cls(crpix=header.get('CRPIX{}'.format(axis), 1.) - 1,
+                   crval=header.get('CRVAL{}'.format(axis), 0.),
+                   crdelt=crdelt, size=size)
+
+    @classmethod
+    def from_cals(cls, cals, size=None):
+        """
+        Return `cals` itself if it is already a spectral axis, otherwise
+        build one from a (crpix, crval, crdelt) sequence.
+        """
+        if isinstance(cals, cls):
+            return cals
+
+        return cls(*cals[:3], size=size)
+
+    @property
+    def is_linear(self):
+        return self._wavelengths is None
+
+    @property
+    def cals(self):
+        return (self.crpix, self.crval, self.crdelt)
+
+    @property
+    def wavelengths(self):
+        """
+        The wavelength of every frame, computed once.
+        """
+        if self._wavelengths is None:
+            self._wavelengths = self.to_wave(np.arange(self.size))
+
+        return self._wavelengths
+
+    def to_wave(self, frame):
+        """
+        Convert (arrays of) frames to wavelengths.
+        """
+        if not self.is_linear:
+            return np.interp(frame, np.arange(self.size), self._wavelengths)
+
+        return (np.asarray(frame) - self.crpix) * self.crdelt + self.crval
+
+    def to_frame(self, wavelength):
+        """
+        Convert (arrays of) wavelengths to fractional frames.
+        """
+        if not self.is_linear:
+            grid = self._wavelengths
+
+            if grid[-1] < grid[0]:
+                return np.interp(wavelength, grid[::-1],
+                                 np.arange(self.size)[::-1])
+
+            return np.interp(wavelength, grid, np.arange(self.size))
+
+        return self.crpix + (np.asarray(wavelength) - self.crval) / self.crdelt
+
+    def to_index(self, wavelength):
+        """
+        Convert (arrays of) wavelengths to the nearest integer frames.
+        """
+        frame = np.round(self.to_frame(wavelength)).astype(int)
+
+        if frame.ndim == 0:
+            return int(frame)
+
+        return frame
+
+    def region_to_frames(self, region):
+        """
+        Convert a [begin, end] wavelength region to the [begin, end) frame
+        range covering it, for slicing.
+        """
+        begin, end = sorted(self.to_index(region))
+
+        return [max(begin, 0), end + 1]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, item):
+        """
+        The spectral axis of a slice of the cube along wavelength.
+        """
+        if not isinstance(item, slice):
+            raise TypeError("Spectral axes can only be sliced.")
+
+        start, stop, step = item.indices(self.size)
+        size = len(range(start, stop, step))
+
+        if not self.is_linear:
+            return SpectralAxis(wavelengths=self._wavelengths[item])
+
+        return SpectralAxis(crpix=(self.crpix - start) / step,
+                            crval=self.crval, crdelt=self.crdelt * step,
+                            size=size)
+
+    def __repr__(self):
+        if not self.is_linear:
+            return '<SpectralAxis: {} tabulated frames>'.format(self.size)
+
+        return '<SpectralAxis: crpix={}, crval={}, crdelt={}, size={}>'.format(
+            self.crpix, self.crval, self.crdelt, self.size)
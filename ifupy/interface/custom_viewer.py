@@ -10,6 +10,76 @@ import sys
 sys.path.append('/Users/nearl/projects/ifupy/ifupy')
 from arithmetic import collapse_slice
 from arithmetic import extract_spectrum
+from ifupy.core.apertures import (CircularAperture, EllipticalAperture,
+                                  PolygonAperture, spaxel_index)
+from ifupy.core.cache import MemoryCache, memoized
+
+# Reduced products shared by all viewers, so that redraws, pans and
+# toggling back to a previous setting do not reduce the cube again.
+viewer_cache = MemoryCache(max_bytes=256 * 2**20)
+
+
+@memoized(viewer_cache)
+def _collapsed(sci, method):
+    return collapse_slice(sci, method=method)
+
+
+@memoized(viewer_cache)
+def _extracted(sci, x_pos, y_pos):
+    return extract_spectrum(sci, [[x_pos, y_pos]], [1.0, 1.0, 1.0])
+
+
+def _roi_aperture(roi):
+    """
+    The aperture matching a glue ROI, or None for kinds without one.
+    """
+    if hasattr(roi, 'radius_x'):
+        return EllipticalAperture(roi.xc, roi.yc, roi.radius_x,
+                                  roi.radius_y, getattr(roi, 'theta', 0.))
+
+    if hasattr(roi, 'radius'):
+        return CircularAperture(roi.xc, roi.yc, roi.radius)
+
+    if hasattr(roi, 'vx'):
+        return PolygonAperture(list(zip(roi.vx, roi.vy)))
+
+    if hasattr(roi, 'xmin'):
+        return PolygonAperture([(roi.xmin, roi.ymin), (roi.xmax, roi.ymin),
+                                (roi.xmax, roi.ymax), (roi.xmin, roi.ymax)])
+
+    return None
+
+
+def _is_pixel_grid(x, y):
+    """
+    Whether `x` and `y` are the pixel coordinates of an image (or cube),
+    so that a selection can be read off a rasterized aperture.
+    """
+    if x.ndim < 2 or x.shape != y.shape:
+        return False
+
+    row = x[(0,) * (x.ndim - 1)]
+    column = y[(0,) * (y.ndim - 2) + (slice(None), 0)]
+
+    return (np.array_equal(row, np.arange(len(row))) and
+            np.array_equal(column, np.arange(len(column))))
+
+
+def _roi_select(roi, x, y):
+    """
+    Pixels inside a ROI, from the cached raster of the matching aperture
+    instead of testing every pixel.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    aperture = _roi_aperture(roi)
+
+    if aperture is None or not _is_pixel_grid(x, y):
+        return roi.contains(x, y)
+
+    mask = spaxel_index(aperture, x.shape[-2:], subsample=1).mask()
+
+    return np.broadcast_to(mask, x.shape).copy()
+
 
 collapse = custom_viewer('Collapse Plot',
                          sci='att',
@@ -22,16 +92,14 @@ collapse = custom_viewer('Collapse Plot',
 @collapse.plot_data
 def collapse_show_data(axes, sci, method):
     if len(sci) > 0:
-        vmin = np.log10(np.min(sci))
-        vmax = np.log10(np.max(sci))
-        axes.imshow(collapse_slice(sci, method=method),
+        axes.imshow(_collapsed(sci, method),
                     interpolation='nearest',
                     norm=LogNorm())
 
 
 @collapse.select
 def collapse_select(roi, x, y):
-    return roi.contains(x, y)
+    return _roi_select(roi, x, y)
 
 
 extract = custom_viewer('Extract Plot',
@@ -44,13 +112,13 @@ extract = custom_viewer('Extract Plot',
 @extract.plot_data
 def extract_show_data(axes, sci, x_pos, y_pos):
     if len(sci) > 0:
-        extspec = extract_spectrum(sci, [[x_pos, y_pos]], [1.0, 1.0, 1.0])
+        extspec = _extracted(sci, x_pos, y_pos)
         axes.plot(extspec[0, :], extspec[2, :])
 
 
 @extract.select
 def extract_select(roi, x, y):
-    return roi.contains(x, y)
+    return _roi_select(roi, x, y)
 
 
 line_measure = custom_viewer('Line Measure Plot',
@@ -1 +1,4 @@
 __author__ = 'nearl'
+
+from convolve import convolve_cube, gaussian_kernel, match_resolution
+from resample import Resampler, resample
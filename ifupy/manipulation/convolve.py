@@ -0,0 +1,206 @@
+# Import necessary modules
+from __future__ import print_function
+
+import numpy as np
+
+from ifupy.core.parallel import map_chunks
+from ifupy.core.profiling import log, profiled
+
+# Conversion from a Gaussian's FWHM to its standard deviation
+FWHM_TO_SIGMA = 1. / np.sqrt(8. * np.log(2.))
+
+
+def gaussian_kernel(fwhm, size=None):
+    """
+    Normalized, circular 2D Gaussian kernel.
+
+    Parameters
+    ----------
+    fwhm : float
+           Full width at half maximum, in pixels.
+
+    size : int, optional
+           Width of the (square) kernel, made odd (default is None, wide
+           enough to hold +/- 4 sigma).
+
+    Returns
+    -------
+    kernel : numpy.ndarray
+             The kernel, summing to 1.
+    """
+    sigma = fwhm * FWHM_TO_SIGMA
+
+    if size is None:
+        size = 2 * int(np.ceil(4 * sigma)) + 1
+
+    half = size // 2
+    y, x = np.mgrid[-half:half + 1, -half:half + 1]
+    kernel = np.exp(-0.5 * (x**2 + y**2) / max(sigma, 1e-6)**2)
+
+    return kernel / kernel.sum()
+
+
+@profiled()
+def convolve_cube(array_in, kernel, max_memory=2**27, n_workers=None,
+                  preserve_nan=True):
+    """
+    Convolve every wavelength plane of a datacube with the same 2D kernel,
+    through FFTs.
+
+    The kernel is transformed once. Planes are then transformed in chunks,
+    as a batch of real FFTs padded to sizes that numpy's FFT handles
+    quickly, multiplied by the kernel's transform and transformed back.
+
+    NaNs (and everything beyond the edges of the image) are treated as
+    missing: they are left out of the convolution and the result is
+    renormalized by the convolved weight of the valid pixels.
+
+    Parameters
+    ----------
+    array_in : numpy.ndarray
+               The input datacube array.
+
+    kernel : numpy.ndarray
+             2D convolution kernel; it is normalized to sum to 1.
+
+    max_memory : int, optional
+                 Approximate memory, in bytes, used by each chunk of planes
+                 and its transforms (default is 128 MB).
+
+    n_workers : int, optional
+                Convolve chunks in this many worker processes (default is
+                None, the convolution runs in the calling process).
+
+    preserve_nan : bool, optional
+                   Set pixels that were NaN in the input back to NaN
+                   (default is True). Otherwise they are interpolated from
+                   their neighbours.
+
+    Returns
+    -------
+    convolved : numpy.ndarray
+                The convolved cube, with the shape of `array_in`.
+
+    Example usage:
+
+        1. >> matched = convolve_cube(cube, gaussian_kernel(2.5))
+
+        Degrade a cube's spatial resolution by a 2.5 pixel FWHM Gaussian.
+    """
+    if callable(array_in):
+        array_in = array_in()
+
+    kernel = np.asarray(kernel, dtype=np.float64)
+    kernel = kernel / kernel.sum()
+
+    nz, ny, nx = array_in.shape
+    ky, kx = kernel.shape
+    shape = (_fast_length(ny + ky - 1), _fast_length(nx + kx - 1))
+
+    # The kernel's transform, and the weights of a plane without NaNs, are
+    # shared by every chunk.
+    kernel_fft = np.fft.rfft2(kernel, s=shape)
+    crop = (slice(ky // 2, ky // 2 + ny), slice(kx // 2, kx // 2 + nx))
+    norm = np.fft.irfft2(np.fft.rfft2(np.ones((ny, nx)), s=shape) *
+                         kernel_fft, s=shape)[crop]
+
+    # Input, padded planes and their transforms, in float64
+    plane_bytes = 4 * shape[0] * shape[1] * np.dtype(np.float64).itemsize
+    chunk_size = int(max(1, max_memory // plane_bytes))
+    log('convolve', 'Convolving {} slices, in chunks of {} slices '
+        '...'.format(nz, chunk_size))
+
+    dtype = np.result_type(array_in.dtype, np.float32)
+
+    return map_chunks(_convolve_chunk, array_in, chunk_size,
+                      n_workers=n_workers or 1,
+                      args=(kernel_fft, norm, shape, crop, preserve_nan,
+                            dtype))
+
+
+def match_resolution(array_in, fwhm, target_fwhm, pixel_scale=1., **kwargs):
+    """
+    Degrade a datacube with a Gaussian PSF of `fwhm` to a coarser Gaussian
+    PSF of `target_fwhm`.
+
+    Parameters
+    ----------
+    array_in : numpy.ndarray
+               The input datacube array.
+
+    fwhm, target_fwhm : float
+                        Current and wanted PSF FWHM, in the units of
+                        `pixel_scale`.
+
+    pixel_scale : float, optional
+                  Size of a spaxel (default is 1, FWHMs are in spaxels).
+
+    Any other keyword arguments are passed on to `convolve_cube`.
+
+    Returns
+    -------
+    convolved : numpy.ndarray
+                The resolution-matched cube.
+    """
+    if target_fwhm < fwhm:
+        raise ValueError('Cannot sharpen a cube from a FWHM of {} to '
+                         '{}'.format(fwhm, target_fwhm))
+
+    kernel_fwhm = np.sqrt(target_fwhm**2 - fwhm**2) / pixel_scale
+
+    return convolve_cube(array_in, gaussian_kernel(kernel_fwhm), **kwargs)
+
+
+def _convolve_chunk(chunk, kernel_fft, norm, shape, crop, preserve_nan,
+                    dtype):
+    """
+    Convolve a chunk of planes, as one batch of FFTs.
+    """
+    valid = np.isfinite(chunk)
+    data = np.where(valid, chunk, 0.)
+
+    convolved = np.fft.irfft2(np.fft.rfft2(data, s=shape) * kernel_fft,
+                              s=shape)[(Ellipsis,) + crop]
+
+    # Only planes with NaNs need weights of their own
+    weights = np.empty_like(convolved)
+    weights[...] = norm
+    partial = ~np.all(valid, axis=(1, 2))
+
+    if np.any(partial):
+        weights[partial] = np.fft.irfft2(
+            np.fft.rfft2(valid[partial].astype(np.float64), s=shape) *
+            kernel_fft, s=shape)[(Ellipsis,) + crop]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        convolved /= np.where(weights > 1e-8, weights, np.nan)
+
+    if preserve_nan:
+        convolved[~valid] = np.nan
+
+    return convolved.astype(dtype)
+
+
+def _fast_length(n):
+    """
+    The smallest 2, 3, 5-smooth length of at least `n`, which numpy's FFT
+    transforms much faster than lengths with large prime factors.
+    """
+    best = 2**int(np.ceil(np.log2(n)))
+    p5 = 1
+
+    while p5 < best:
+        p35 = p5
+
+        while p35 < best:
+            length = p35
+
+            while length < n:
+                length *= 2
+
+            best = min(best, length)
+            p35 *= 3
+
+        p5 *= 5
+
+    return best
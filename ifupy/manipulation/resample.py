@@ -0,0 +1,517 @@
+# Import necessary modules
+from __future__ import print_function
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from scipy import sparse
+
+from ifupy.core.cache import MemoryCache
+from ifupy.core.data_cube import Cube, header_shape
+from ifupy.core.spectral_axis import SpectralAxis
+
+# Weights of recently used grid pairs, shared by `resample` calls
+resampler_cache = MemoryCache(max_bytes=2**28)
+
+# What the cubes in common extensions hold, see `Resampler.__call__`
+_EXTENSION_KINDS = {'ERR': 'error', 'ERROR': 'error', 'VAR': 'variance',
+                    'STAT': 'variance', 'DQ': 'flags'}
+_KINDS = ('data', 'error', 'variance', 'flags')
+
+# Keywords describing the contents, rather than the grid, of a cube
+_CONTENT_KEYWORDS = ('EXTNAME', 'BUNIT')
+
+
+class Resampler(object):
+    """
+    Sparse interpolation weights taking cubes from one (spatial and
+    spectral) grid to another.
+
+    The weights are computed once, as a spectral (nz_out x nz_in) and a
+    spatial (ny_out * nx_out x ny_in * nx_in) sparse matrix, and can then
+    be applied to any number of cubes on the same grid, such as the SCI,
+    ERR and DQ extensions of a file.
+
+    Parameters
+    ----------
+    source, target : Cube, CubeHandle or astropy.io.fits.Header
+                     The grid cubes are resampled from and onto, described
+                     by the celestial WCS and spectral calibration of their
+                     headers.
+
+    method : {'linear', 'area'}, optional
+             Bilinear (and linear spectral) interpolation, or area
+             weighting, where every output pixel is the average of the
+             input pixels it overlaps, weighted by their overlap, as in
+             drizzling with a pixfrac of 1 (default is 'linear').
+    """
+    def __init__(self, source, target, method='linear'):
+        if method not in ('linear', 'area'):
+            raise ValueError('Unknown resampling method: {}'.format(method))
+
+        source, target = _header(source), _header(target)
+        self.method = method
+        self.in_shape = header_shape(source)
+        self.out_shape = header_shape(target)
+        self.target_header = target
+
+        if len(self.in_shape) == 3:
+            self.spectral = _spectral_weights(
+                SpectralAxis.from_header(source).wavelengths,
+                SpectralAxis.from_header(target).wavelengths, method)
+        else:
+            self.spectral = None
+
+        self.spatial = _spatial_weights(source, target, self.in_shape[-2:],
+                                        self.out_shape[-2:], method)
+
+        # Round-off overlaps would count as contributing pixels for flags
+        for weights in (self.spatial, self.spectral):
+            if weights is not None:
+                _prune(weights)
+
+        # Total weight of every output pixel for inputs without NaNs
+        self._spatial_norm = np.asarray(self.spatial.sum(axis=1)).ravel()
+        self._spatial_squared = None
+
+    @property
+    def nbytes(self):
+        return sum(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes
+                   for m in (self.spatial, self.spectral,
+                             self._spatial_squared) if m is not None)
+
+    def __call__(self, array_in, kind=None, max_memory=2**27):
+        """
+        Resample a cube (or image) on the source grid.
+
+        How values are combined depends on what the cube holds (`kind`):
+
+        - 'data': the weighted mean of the input pixels. NaNs are left out
+          and the output renormalized by the weight of the valid inputs.
+        - 'error': uncertainties of such a mean, propagated in quadrature
+          as sqrt(sum(w**2 * err**2)) / sum(w).
+        - 'variance': likewise, sum(w**2 * var) / sum(w)**2.
+        - 'flags': bitmasks (e.g. DQ), combined with a bitwise OR over
+          every input pixel with a non-zero weight.
+
+        Output pixels outside the source grid are NaN (0 for flags).
+        Output planes are produced in chunks of about `max_memory` bytes,
+        each reading only the input planes it needs.
+
+        A `Cube` is returned as a `Cube` with the target header, keeping
+        its own EXTNAME and BUNIT, and its `kind` defaults to the one
+        matching its EXTNAME (ERR, VAR or STAT, DQ), if any.
+        """
+        cube = array_in if isinstance(array_in, Cube) else None
+
+        if cube is not None:
+            array_in = cube.data
+
+            if kind is None and cube.header is not None:
+                kind = _EXTENSION_KINDS.get(
+                    str(cube.header.get('EXTNAME', '')).strip().upper())
+
+        kind = kind or 'data'
+
+        if kind not in _KINDS:
+            raise ValueError('Unknown kind of cube: {}'.format(kind))
+
+        if tuple(array_in.shape) != tuple(self.in_shape):
+            raise ValueError('Expected an array of shape {}, got '
+                             '{}'.format(self.in_shape, array_in.shape))
+
+        if kind == 'flags':
+            if not np.issubdtype(array_in.dtype, np.integer):
+                raise TypeError('Flags must be integers, got '
+                                '{}'.format(array_in.dtype))
+
+            resample_planes, dtype = self._combine, array_in.dtype
+        else:
+            def resample_planes(array_in, spectral):
+                return self._resample(array_in, spectral, kind)
+
+            dtype = np.result_type(array_in.dtype, np.float32)
+
+        if self.spectral is None:
+            result = resample_planes(array_in[np.newaxis], None)[0]
+        else:
+            result = np.empty(self.out_shape, dtype=dtype)
+            plane_bytes = 4 * max(np.prod(self.in_shape[1:]),
+                                  np.prod(self.out_shape[1:])) * 8
+            n_planes = int(max(1, max_memory // plane_bytes))
+
+            for start in range(0, self.out_shape[0], n_planes):
+                stop = min(start + n_planes, self.out_shape[0])
+                result[start:stop] = resample_planes(
+                    array_in, self.spectral[start:stop])
+
+        if cube is not None:
+            return Cube(name=cube.name, data=result,
+                        header=_output_header(self.target_header,
+                                              cube.header),
+                        copy=False)
+
+        return result
+
+    def _resample(self, array_in, spectral, kind='data'):
+        """
+        Resample the output planes of the rows `spectral` of the spectral
+        weights (or a single image, if None).
+        """
+        spectral, array_in = _used_planes(spectral, array_in)
+
+        if array_in is None:
+            return np.nan
+
+        squared = kind in ('error', 'variance')
+        data = np.array(array_in, dtype=np.float64).reshape(
+            array_in.shape[0], -1)
+        valid = np.isfinite(data)
+        clean = np.all(valid)
+
+        if not clean:
+            data[~valid] = 0.
+
+        if kind == 'error':
+            data **= 2
+
+        resampled = self._apply(data, spectral, squared)
+
+        if clean:
+            norm = self._spatial_norm[np.newaxis]
+
+            if spectral is not None:
+                norm = norm * np.asarray(
+                    spectral.sum(axis=1)).reshape(-1, 1)
+        else:
+            norm = self._apply(valid.astype(np.float64), spectral)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            norm = np.where(norm > 1e-12, norm, np.nan)
+            resampled /= norm**2 if squared else norm
+
+        if kind == 'error':
+            resampled = np.sqrt(resampled)
+
+        return resampled.reshape((-1,) + tuple(self.out_shape[-2:]))
+
+    def _combine(self, array_in, spectral):
+        """
+        Bitwise OR of the input pixels contributing to the output planes
+        of the rows `spectral` of the spectral weights (or a single
+        image, if None).
+        """
+        spectral, array_in = _used_planes(spectral, array_in)
+
+        if array_in is None:
+            return 0
+
+        data = np.asarray(array_in).reshape(array_in.shape[0], -1)
+
+        if spectral is not None:
+            data = _bitwise_or(spectral, data)
+
+        combined = _bitwise_or(self.spatial, data.T).T
+
+        return combined.reshape((-1,) + tuple(self.out_shape[-2:]))
+
+    def _apply(self, data, spectral, squared=False):
+        spatial = self.spatial
+
+        if squared:
+            # Weights of the variances are the squared weights
+            if self._spatial_squared is None:
+                self._spatial_squared = spatial.multiply(spatial).tocsr()
+
+            spatial = self._spatial_squared
+
+            if spectral is not None:
+                spectral = spectral.multiply(spectral).tocsr()
+
+        if spectral is not None:
+            data = spectral.dot(data)
+
+        return spatial.dot(data.T).T
+
+
+def resample(array_in, target, source=None, method='linear', **kwargs):
+    """
+    Resample a cube onto the spatial and spectral grid of another.
+
+    The sparse weights for each pair of grids are kept in
+    `resampler_cache`, so resampling many cubes, or many extensions of
+    one file, onto the same grid only computes them once.
+
+    Parameters
+    ----------
+    array_in : Cube or numpy.ndarray
+               The cube to resample.
+
+    target : Cube, CubeHandle or astropy.io.fits.Header
+             The grid to resample onto.
+
+    source : Cube, CubeHandle or astropy.io.fits.Header, optional
+             The grid of `array_in`; required for arrays, taken from the
+             header of Cubes.
+
+    method : {'linear', 'area'}, optional
+             See `Resampler`.
+
+    Any other keyword arguments (`kind`, `max_memory`) are passed on when
+    applying the `Resampler`.
+
+    Returns
+    -------
+    resampled : Cube or numpy.ndarray
+                The resampled cube, of the same type as `array_in`.
+
+    Example usage:
+
+        1. >> sci, err = [resample(cube, reference, method='area')
+                          for cube in read_data(path)[1]]
+
+        Regrid two extensions onto a reference cube's grid, computing
+        the weights once; the ERR extension is propagated in quadrature.
+    """
+    if source is None:
+        source = array_in
+
+    source, target = _header(source), _header(target)
+    key = (_grid_key(source), _grid_key(target), method)
+    resampler = resampler_cache.get(key)
+
+    if resampler is None:
+        resampler = Resampler(source, target, method)
+        resampler_cache.set(key, resampler)
+
+    return resampler(array_in, **kwargs)
+
+
+def _header(grid):
+    if isinstance(grid, fits.Header):
+        return grid
+
+    if grid.header is None:
+        raise ValueError('A header is needed to describe the grid of '
+                         '{!r}'.format(grid))
+
+    return grid.header
+
+
+def _grid_key(header):
+    """
+    Everything that defines a cube's grid: its shape, full celestial WCS
+    (as normalized by astropy, so rotations, projection parameters and
+    reference frames all count) and spectral calibration.
+    """
+    shape = header_shape(header)
+    celestial = WCS(header, naxis=[1, 2]).to_header_string()
+
+    if len(shape) == 3:
+        axis = SpectralAxis.from_header(header)
+        spectral = (axis.crpix, axis.crval, axis.crdelt, axis.size)
+    else:
+        spectral = None
+
+    return shape, celestial, spectral
+
+
+def _output_header(target, header):
+    """
+    The target header, describing the grid, with the EXTNAME and BUNIT
+    of the resampled cube's `header` (removed if it has none).
+    """
+    output = target.copy()
+
+    for key in _CONTENT_KEYWORDS:
+        if header is not None and key in header:
+            output[key] = header[key]
+        else:
+            output.remove(key, ignore_missing=True)
+
+    return output
+
+
+def _used_planes(spectral, array_in):
+    """
+    The columns of the spectral weights, and the input planes, that the
+    output planes of `spectral` draw on (None for the planes if there are
+    none); images are returned as they are.
+    """
+    if spectral is None:
+        return spectral, array_in
+
+    used = np.nonzero(np.diff(spectral.tocsc().indptr))[0]
+
+    if len(used) == 0:
+        return spectral, None
+
+    z0, z1 = used[0], used[-1] + 1
+
+    return spectral[:, z0:z1], array_in[z0:z1]
+
+
+def _prune(weights, tolerance=1e-9):
+    """
+    Drop weights (in place) that are negligible next to the largest of
+    their row, such as the slivers of overlap left by round-off.
+    """
+    peak = weights.max(axis=1).toarray().ravel()
+    rows = np.repeat(np.arange(weights.shape[0]), np.diff(weights.indptr))
+    weights.data[weights.data <= tolerance * peak[rows]] = 0.
+    weights.eliminate_zeros()
+
+
+def _bitwise_or(weights, values):
+    """
+    Bitwise OR, for every row of the sparse `weights`, of the `values`
+    (rows matching its columns) it has non-zero weights for; 0 for empty
+    rows.
+    """
+    weights = weights.tocsr()
+    combined = np.zeros((weights.shape[0],) + values.shape[1:],
+                        dtype=values.dtype)
+    filled = np.diff(weights.indptr) > 0
+
+    # Rows are contiguous runs of the gathered values, and empty rows
+    # are skipped so that every run starts where the previous one ends
+    if np.any(filled):
+        combined[filled] = np.bitwise_or.reduceat(
+            values[weights.indices], weights.indptr[:-1][filled], axis=0)
+
+    return combined
+
+
+def _spectral_weights(wave_in, wave_out, method):
+    """
+    Sparse (n_out x n_in) weights between two (increasing) wavelength
+    grids.
+    """
+    n_in, n_out = len(wave_in), len(wave_out)
+
+    if method == 'linear':
+        inside = (wave_out >= wave_in[0]) & (wave_out <= wave_in[-1])
+        rows = np.nonzero(inside)[0]
+        i = np.clip(np.searchsorted(wave_in, wave_out[rows]) - 1, 0,
+                    max(n_in - 2, 0))
+        j = np.minimum(i + 1, n_in - 1)
+        step = np.where(j > i, wave_in[j] - wave_in[i], 1.)
+        f = np.clip((wave_out[rows] - wave_in[i]) / step, 0., 1.)
+
+        return sparse.csr_matrix(
+            (np.concatenate([1 - f, f]), (np.tile(rows, 2),
+                                          np.concatenate([i, j]))),
+            shape=(n_out, n_in))
+
+    edges_in, edges_out = _edges(wave_in), _edges(wave_out)
+
+    return _overlap_weights(edges_out[:-1], edges_out[1:], edges_in)
+
+
+def _spatial_weights(source, target, in_shape, out_shape, method):
+    """
+    Sparse (ny_out * nx_out x ny_in * nx_in) weights between the spatial
+    grids of two headers, through their celestial WCS.
+    """
+    ny_in, nx_in = in_shape
+    ny_out, nx_out = out_shape
+    wcs_in, wcs_out = WCS(source, naxis=[1, 2]), WCS(target, naxis=[1, 2])
+
+    def to_input(x, y):
+        world = wcs_out.all_pix2world(x.ravel(), y.ravel(), 0)
+        xi, yi = wcs_in.all_world2pix(world[0], world[1], 0)
+
+        return xi, yi
+
+    y, x = np.mgrid[:ny_out, :nx_out].astype(np.float64)
+    xi, yi = to_input(x, y)
+
+    if method == 'linear':
+        rows, cols, values = [], [], []
+        x0, y0 = np.floor(xi).astype(int), np.floor(yi).astype(int)
+        fx, fy = xi - x0, yi - y0
+        inside = ((xi >= -0.5) & (xi <= nx_in - 0.5) &
+                  (yi >= -0.5) & (yi <= ny_in - 0.5))
+
+        for dy, wy in ((0, 1 - fy), (1, fy)):
+            for dx, wx in ((0, 1 - fx), (1, fx)):
+                xn, yn = x0 + dx, y0 + dy
+                keep = (inside & (xn >= 0) & (xn < nx_in) &
+                        (yn >= 0) & (yn < ny_in) & (wx * wy > 0))
+                rows.append(np.nonzero(keep)[0])
+                cols.append(yn[keep] * nx_in + xn[keep])
+                values.append((wx * wy)[keep])
+
+        return sparse.csr_matrix(
+            (np.concatenate(values),
+             (np.concatenate(rows), np.concatenate(cols))),
+            shape=(ny_out * nx_out, ny_in * nx_in))
+
+    # Footprint of every output pixel on the input grid, approximated as
+    # an axis-aligned box from the local scale along each output axis.
+    half_x = 0.5 * np.hypot(*[a - b for a, b in zip(to_input(x + .5, y),
+                                                       to_input(x - .5, y))])
+    half_y = 0.5 * np.hypot(*[a - b for a, b in zip(to_input(x, y + .5),
+                                                       to_input(x, y - .5))])
+
+    cols_x, values_x = _overlaps(xi - half_x, xi + half_x,
+                                 np.arange(nx_in + 1) - 0.5)
+    cols_y, values_y = _overlaps(yi - half_y, yi + half_y,
+                                 np.arange(ny_in + 1) - 0.5)
+
+    # Overlap areas are products of the overlaps along each axis
+    cols = cols_y[:, np.newaxis] * nx_in + cols_x[np.newaxis]
+    values = values_y[:, np.newaxis] * values_x[np.newaxis]
+    rows = np.broadcast_to(np.arange(ny_out * nx_out), values.shape)
+    keep = values > 0
+
+    return sparse.csr_matrix((values[keep], (rows[keep], cols[keep])),
+                             shape=(ny_out * nx_out, ny_in * nx_in))
+
+
+def _overlap_weights(lower, upper, edges):
+    """
+    Sparse (n_out x n_in) lengths of overlap between the intervals
+    [lower, upper] and the bins between consecutive `edges`.
+    """
+    cols, values = _overlaps(lower, upper, edges)
+    rows = np.broadcast_to(np.arange(len(lower)), values.shape)
+    keep = values > 0
+
+    return sparse.csr_matrix((values[keep], (rows[keep], cols[keep])),
+                             shape=(len(lower), len(edges) - 1))
+
+
+def _overlaps(lower, upper, edges):
+    """
+    Bins (between consecutive `edges`) overlapping each interval [lower,
+    upper], and the lengths of overlap, as (span, n_intervals) arrays;
+    lengths are 0 past the last overlapping bin.
+    """
+    n_in = len(edges) - 1
+    first = np.clip(np.searchsorted(edges, lower, side='right') - 1, 0,
+                    n_in - 1)
+    last = np.clip(np.searchsorted(edges, upper, side='left') - 1, 0,
+                   n_in - 1)
+    span = int(np.max(last - first)) + 1 if len(lower) else 1
+
+    cols = np.minimum(first + np.arange(span)[:, np.newaxis], n_in - 1)
+    values = (np.minimum(upper, edges[cols + 1]) -
+              np.maximum(lower, edges[cols]))
+    values[(first + np.arange(span)[:, np.newaxis] > last) |
+           (values < 0)] = 0.
+
+    return cols, values
+
+
+def _edges(centres):
+    """
+    Bin edges halfway between bin centres, extended at both ends.
+    """
+    if len(centres) == 1:
+        return np.array([centres[0] - 0.5, centres[0] + 0.5])
+
+    middle = (centres[1:] + centres[:-1]) / 2.
+
+    return np.concatenate([[2 * centres[0] - middle[0]], middle,
+                           [2 * centres[-1] - middle[-1]]])
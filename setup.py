@@ -9,6 +9,7 @@ setup(name='IFUpy',
       license='Claus-3 BSD',
       packages=['ifupy'],
       zip_safe=False,
-      install_requires=['numpy>=1.9.0',
+      install_requires=['numpy>=1.13.0',
                         'scipy>=0.14',
-                        'astropy>=0.4.2'])
\ No newline at end of file
+                        'astropy>=0.4.2',
+                        'futures; python_version < "3"'])
\ No newline at end of file
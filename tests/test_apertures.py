@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from ifupy.arithmetic import extract_apertures
+from ifupy.core import (AnnulusAperture, CircularAperture, EllipticalAperture,
+                        PolygonAperture, spaxel_index)
+
+
+@pytest.mark.parametrize('aperture, area', [
+    (CircularAperture(20, 21, 6.), np.pi * 36.),
+    (EllipticalAperture(20, 21, 8., 4., theta=0.5), np.pi * 32.),
+    (AnnulusAperture(20, 21, 4., 8.), np.pi * 48.),
+    (PolygonAperture([(10, 10), (30, 10), (30, 20), (10, 20)]), 200.)])
+def test_area_matches_the_geometry(aperture, area):
+    index = spaxel_index(aperture, (50, 50), subsample=10)
+
+    assert abs(index.area - area) < 0.02 * area
+
+
+def test_spaxels_outside_the_image_are_dropped():
+    index = spaxel_index(CircularAperture(0, 0, 3.), (10, 10))
+
+    assert index.y.min() >= 0 and index.x.min() >= 0
+    # A quarter of the circle, plus the half spaxels along both edges
+    assert abs(index.area - (np.pi * 9. / 4 + 3.25)) < 0.2
+    assert len(spaxel_index(CircularAperture(-20, -20, 3.), (10, 10))) == 0
+
+
+def test_extracted_sum_minus_sky():
+    data = np.ones((5, 40, 40))
+    data[:, 15:26, 15:26] += 2.
+    aperture = CircularAperture(20, 20, 5.)
+
+    _, spectra = extract_apertures(data, [0, 0., 1.], aperture,
+                                   sky=AnnulusAperture(20, 20, 12., 16.))
+    area = spaxel_index(aperture, (40, 40)).area
+
+    np.testing.assert_allclose(spectra[0], 2. * area)
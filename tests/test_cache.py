@@ -0,0 +1,228 @@
+import hashlib
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ifupy.arithmetic import collapse_slice
+from ifupy.core import (Cube, disable_cache, enable_cache, profile,
+                        read_data, write_chunked)
+from ifupy.core import cache_cube
+from ifupy.core.cache import (DiskCache, MemoryCache, _digest, identity,
+                              memoized, token)
+from ifupy.core.cube_cache import cached_hdus
+
+
+@pytest.fixture
+def disk_cache(tmpdir):
+    cache = enable_cache(str(tmpdir.join('cache')))
+    yield cache
+    disable_cache()
+
+
+@pytest.fixture
+def lazy_cube(tmpdir):
+    data = np.random.RandomState(1).rand(10, 6, 7).astype(np.float32)
+    path = str(tmpdir.join('cube.fits'))
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data)]).writeto(path)
+
+    return read_data(path, lazy=True, use_cache=False)[1][0]
+
+
+def test_disk_cache_serves_repeated_calls(disk_cache):
+    data = np.random.RandomState(0).rand(10, 6, 7)
+
+    first = collapse_slice(data, method='sum')
+
+    assert any(name.endswith('.npy')
+               for name in os.listdir(disk_cache.directory))
+    np.testing.assert_array_equal(collapse_slice(data, method='sum'), first)
+
+
+def test_disk_cache_sees_in_place_edits_of_lazy_cubes(disk_cache, lazy_cube):
+    before = np.array(collapse_slice(lazy_cube.data, method='sum'))
+
+    lazy_cube -= 100
+
+    after = collapse_slice(lazy_cube.data, method='sum')
+
+    np.testing.assert_allclose(before - after, 1000., rtol=1e-5)
+
+
+def test_token_keys_read_only_maps_by_file(tmpdir):
+    path = str(tmpdir.join('array.npy'))
+    np.save(path, np.arange(24.).reshape(2, 3, 4))
+
+    readonly = np.load(path, mmap_mode='r')
+    private = np.load(path, mmap_mode='c')
+
+    assert token(readonly)[0] == 'file'
+    assert token(private)[0] == 'array'
+
+    before = token(private)
+    private[0, 0, 0] = -1.
+
+    assert token(private) != before
+
+
+def test_token_never_reads_lazy_cubes(lazy_cube):
+    before = token(lazy_cube)
+
+    assert before[0] == 'file' and before[4] == 1
+    assert not lazy_cube.is_loaded
+
+    lazy_cube[0, 0, 0] = -1.
+
+    assert token(lazy_cube)[0] == 'array'
+
+
+def test_token_summarizes_chunked_stores_by_metadata(tmpdir):
+    data = np.random.RandomState(2).rand(12, 8, 9)
+    path = str(tmpdir.join('cube.ifc'))
+    write_chunked(path, data, chunks=(4, 4, 4))
+    _, (lazy,) = read_data(path, lazy=True)
+    _, (cutout,) = read_data(path, lazy=True, bbox=[1, 5, 2, 6])
+
+    with profile() as trace:
+        first, section = token(lazy), token(cutout)
+
+    assert not [event for event in trace.events
+                if event['name'] == 'decompress']
+    assert not lazy.is_loaded
+    assert first[0] == 'chunked' and section[:-1] == first
+
+    stat = os.stat(os.path.join(path, 'meta.json'))
+    write_chunked(path, data + 1, chunks=(4, 4, 4))
+    os.utime(os.path.join(path, 'meta.json'),
+             (stat.st_atime, stat.st_mtime + 10))
+
+    assert token(read_data(path, lazy=True)[1][0]) != first
+
+
+def test_views_are_hashed_in_blocks():
+    data = np.random.RandomState(3).rand(30, 20, 10)
+    view = data[::2, 3:17, ::3]
+
+    expected = hashlib.sha1(np.ascontiguousarray(view).view(np.uint8))
+
+    assert _digest(view) == expected.hexdigest()
+    assert _digest(view, block_bytes=500) == expected.hexdigest()
+    assert token(view) == token(view.copy())
+
+
+def _counted_total(calls):
+    @memoized(MemoryCache())
+    def total(array_in):
+        calls.append(1)
+
+        return np.asarray(array_in).sum(axis=0)
+
+    return total
+
+
+def test_memoized_sees_edits_made_through_cubes():
+    calls = []
+    total = _counted_total(calls)
+
+    cube = Cube(data=np.zeros((20, 30, 40)))
+    first = total(cube)
+    total(cube)
+
+    assert len(calls) == 1
+
+    cube[3, 0, 1:5] = 1e6
+
+    np.testing.assert_array_equal(total(cube)[0, 1:5], 1e6)
+    assert len(calls) == 2
+    assert first[0, 1] == 0
+
+    # Views see the edits of their parent, and the other way round
+    view = cube[2:6]
+    total(view)
+    cube -= 1.
+
+    assert total(view)[0, 0] == -4.
+
+    view[0] = 0.
+
+    assert total(cube)[0, 0] == -19.
+    assert len(calls) == 5
+
+
+def test_memoized_keys_plain_arrays_on_their_memory(lazy_cube):
+    calls = []
+    total = _counted_total(calls)
+
+    data = np.zeros((20, 30, 40))
+    total(data)
+    total(data[...])
+    total(data.reshape(20, 30, 40))
+
+    assert len(calls) == 1
+
+    total(data.copy())
+    total(data[1:])
+
+    assert len(calls) == 3
+
+    # Keys are built without touching the data
+    total(lazy_cube)
+    total(lazy_cube)
+
+    assert len(calls) == 4
+    assert identity(lazy_cube)[0] == 'cube'
+
+
+def test_disk_cache_evicts_least_recently_used(tmpdir):
+    cache = DiskCache(str(tmpdir), max_bytes=2500)
+    arrays = [np.full(100, i, dtype=np.float64) for i in range(3)]
+
+    for i, array in enumerate(arrays[:2]):
+        cache.set(str(i), array)
+        os.utime(cache._path(str(i)), (i, i))
+
+    # Reading an entry makes it the most recently used
+    cache.get('0')
+    cache.set('2', arrays[2])
+
+    assert cache.get('1') is None
+    np.testing.assert_array_equal(cache.get('0'), arrays[0])
+    np.testing.assert_array_equal(cache.get('2'), arrays[2])
+
+
+def test_memory_cache_is_bounded_by_bytes():
+    cache = MemoryCache(max_bytes=2000)
+    cache.set('a', np.zeros(100))
+    cache.set('b', np.zeros(100))
+    cache.get('a')
+    cache.set('c', np.zeros(100))
+    cache.set('huge', np.zeros(1000))
+
+    assert 'a' in cache and 'c' in cache
+    assert 'b' not in cache and 'huge' not in cache
+    assert cache.nbytes == 1600
+
+
+def test_cube_cache_is_used_while_the_file_is_unchanged(tmpdir):
+    data = np.arange(60, dtype=np.int16).reshape(3, 4, 5)
+    path = str(tmpdir.join('cube.fits'))
+    hdu = fits.ImageHDU(data.copy())
+    hdu.scale('int16', bzero=10)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path)
+
+    directory = str(tmpdir.join('converted'))
+    cache_cube(path, directory=directory)
+    cached = cached_hdus(path, directory=directory)
+
+    assert [entry[0] for entry in cached] == [1]
+    assert 'BZERO' not in cached[0][1]
+    np.testing.assert_array_equal(np.load(cached[0][2]), data)
+
+    # Rewriting the file invalidates its converted copy
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data + 1)]).writeto(
+        path, overwrite=True)
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+    assert cached_hdus(path, directory=directory) is None
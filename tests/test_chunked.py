@@ -0,0 +1,150 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ifupy.arithmetic import collapse_slice, extract_spectra
+from ifupy.core import (ChunkedArray, CircularAperture, Cube, profile,
+                        read_data, spaxel_index, write_chunked)
+from ifupy.core.chunked import CODECS
+
+KEYS = [np.s_[...], np.s_[3], np.s_[-1, 2:30:3, ::-2], np.s_[5:40:7, :, 3],
+        np.s_[::-1], np.s_[10:10], np.s_[:, -5:], np.s_[1:49:20, 1:36:11]]
+
+MASK = np.random.RandomState(1).rand(37, 41) > 0.9
+
+FANCY = [np.s_[:, [3, 20, 3, -1], [0, 40, 7, 5]], np.s_[5, [2, 9], [8, 1]],
+         np.s_[2:30:4, [[1, 2], [3, 4]], 6], np.s_[[0, 49], :, [4, 4]],
+         np.s_[..., [10, 2, 30]], np.s_[:, MASK], np.s_[::-2, 5:1:-1, []],
+         np.s_[[], 3, 4], np.s_[[7], ::3, np.array([-41, 0])]]
+
+
+@pytest.fixture
+def data():
+    data = np.random.RandomState(0).rand(50, 37, 41).astype('>f4')
+    data[3, 4, 5] = np.nan
+
+    return data
+
+
+@pytest.fixture
+def cube(data, tmpdir):
+    header = fits.Header()
+    header['NAXIS'] = 3
+
+    for axis, size in zip((1, 2, 3), data.shape[::-1]):
+        header['NAXIS{}'.format(axis)] = size
+
+    header.update(CRPIX3=1, CRVAL3=6500., CDELT3=1.)
+    path = str(tmpdir.join('cube.ifc'))
+    write_chunked(path, Cube(data=data, header=header), chunks=(16, 10, 12))
+
+    return path
+
+
+def _decompressed(trace):
+    return sum(event['args'].get('chunks', 0) for event in trace.events
+               if event['name'] == 'decompress')
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_round_trip(data, tmpdir, codec):
+    store = write_chunked(str(tmpdir.join('cube.ifc')), data,
+                          chunks=(16, 10, 12), codec=codec)
+
+    np.testing.assert_array_equal(np.asarray(store), data)
+
+
+@pytest.mark.parametrize('key', KEYS)
+def test_indexing_matches_numpy(data, cube, key):
+    np.testing.assert_array_equal(ChunkedArray(cube)[key], data[key])
+
+
+@pytest.mark.parametrize('key', KEYS[:6])
+def test_section_indexing_matches_numpy(data, cube, key):
+    section = ChunkedArray(cube).section(np.s_[5:45, 3:30, 2:40])
+
+    np.testing.assert_array_equal(section[key], data[5:45, 3:30, 2:40][key])
+
+
+@pytest.mark.parametrize('key', FANCY)
+def test_array_indexing_matches_numpy(data, cube, key):
+    store = ChunkedArray(cube)
+    section = store.section(np.s_[:, :, :])
+
+    np.testing.assert_array_equal(store[key], data[key])
+    np.testing.assert_array_equal(section[key], data[key])
+
+
+def test_section_array_indexing_is_offset(data, cube):
+    section = ChunkedArray(cube).section(np.s_[5:45, 3:30, 2:40])
+    key = np.s_[1:-1, [0, 26, -1], [37, 3, 0]]
+
+    np.testing.assert_array_equal(section[key], data[5:45, 3:30, 2:40][key])
+
+
+def test_array_indexing_checks_bounds(cube):
+    store = ChunkedArray(cube)
+
+    for key in np.s_[:, [0, 37], 0], np.s_[:, 0, [-42]], np.s_[:, [0.5]]:
+        with pytest.raises(IndexError):
+            store[key]
+
+
+def test_aperture_index_gathers_from_its_box(data, cube):
+    _, (lazy,) = read_data(cube, lazy=True)
+    index = spaxel_index(CircularAperture(5., 4., 2.5), lazy.shape[1:])
+
+    with profile(verbose=False) as trace:
+        spectra = lazy[:, index.y, index.x]
+
+    # The box lies in the first chunk of the image, in 4 bands
+    assert _decompressed(trace) == 4
+    np.testing.assert_array_equal(spectra, data[:, index.y, index.x])
+    np.testing.assert_allclose(np.dot(spectra, index.weights),
+                               np.dot(data[:, index.y, index.x],
+                                      index.weights), rtol=1e-6)
+
+
+def test_only_touched_chunks_are_decompressed(cube):
+    store = ChunkedArray(cube)
+
+    with profile(verbose=False) as trace:
+        store[20:30, 0:5, 0:5]
+
+    assert _decompressed(trace) == 1
+
+
+def test_lazy_cubes_decompress_only_what_they_use(data, cube):
+    _, (lazy,) = read_data(cube, lazy=True)
+
+    with profile(verbose=False) as trace:
+        _, spectra = extract_spectra(lazy, lazy.spectral_axis,
+                                     spaxels=[[5, 6]])
+
+    # One column of chunks, out of 4 x 4 x 4
+    assert _decompressed(trace) == 4
+    np.testing.assert_array_equal(spectra[0], data[:, 6, 5])
+
+    _, (lazy,) = read_data(cube, lazy=True)
+
+    with profile(verbose=False) as trace:
+        collapsed = collapse_slice(lazy, region=[0, 10], method='sum')
+
+    # The first band of chunks, out of 4
+    assert _decompressed(trace) == 16
+    np.testing.assert_allclose(collapsed, data[0:10].sum(axis=0),
+                               rtol=1e-5)
+    assert not lazy.is_loaded
+
+
+def test_read_data_cutouts(data, cube):
+    expected = data[10:21, 3:9, 2:8]
+
+    for lazy in (False, True):
+        _, (cutout,) = read_data(cube, lazy=lazy, bbox=[2, 8, 3, 9],
+                                 wave_region=[6510., 6520.])
+
+        assert cutout.shape == expected.shape
+        np.testing.assert_array_equal(cutout.data, expected)
@@ -0,0 +1,78 @@
+import warnings
+
+import numpy as np
+import pytest
+from astropy.stats import sigma_clip
+
+from ifupy.arithmetic import collapse_slice
+from ifupy.arithmetic.collapse import _sigmaCollapse
+
+REDUCE = {'sum': np.ma.sum, 'mean': np.ma.mean, 'median': np.ma.median}
+
+
+def _clipped(data, sigma, iters):
+    """
+    `astropy.stats.sigma_clip` along z, under either name of its
+    iteration limit.
+    """
+    data = np.ma.masked_invalid(data)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        try:
+            return sigma_clip(data, sigma=sigma, maxiters=iters, axis=0)
+        except TypeError:
+            return sigma_clip(data, sigma=sigma, iters=iters, axis=0)
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    data = rng.normal(10., 1., size=(60, 7, 8))
+
+    # Outliers of both signs, and NaNs, including a spaxel with no data
+    outliers = rng.choice(data.size, 40, replace=False)
+    data.flat[outliers] += rng.choice([-1., 1.], 40) * rng.uniform(5., 50.,
+                                                                   40)
+    data[rng.rand(*data.shape) < 0.05] = np.nan
+    data[:, 3, 4] = np.nan
+
+    return data
+
+
+@pytest.mark.parametrize('method', ['sum', 'mean', 'median'])
+@pytest.mark.parametrize('sigma, iters', [(3., None), (2., 1), (2.5, 3)])
+def test_sigma_clipping_matches_astropy(data, method, sigma, iters):
+    collapsed, rejected = _sigmaCollapse(data, method, sigma, iters=iters)
+
+    clipped = _clipped(data, sigma, iters)
+    expected = REDUCE[method](clipped, axis=0)
+    expected_rejected = (np.ma.getmaskarray(clipped).sum(axis=0) -
+                         np.isnan(data).sum(axis=0))
+
+    valid = ~np.ma.getmaskarray(expected)
+
+    assert rejected.sum() > 0
+    np.testing.assert_array_equal(rejected, expected_rejected)
+    np.testing.assert_allclose(collapsed[valid],
+                               np.ma.getdata(expected)[valid])
+
+    if method == 'sum':
+        assert collapsed[3, 4] == 0.
+    else:
+        assert np.isnan(collapsed[3, 4])
+
+
+@pytest.mark.parametrize('method', ['mean', 'median'])
+def test_collapse_slice_returns_the_rejected_counts(data, method):
+    collapsed, rejected = collapse_slice(data, method=method, sigma=3.,
+                                         return_rejected=True)
+
+    clipped = _clipped(data, 3., None)
+
+    np.testing.assert_array_equal(rejected,
+                                  np.ma.getmaskarray(clipped).sum(axis=0) -
+                                  np.isnan(data).sum(axis=0))
+    np.testing.assert_allclose(collapsed[:3],
+                               REDUCE[method](clipped, axis=0)[:3])
@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor
+
+import ifupy.core.data_cube as data_cube
+from ifupy.arithmetic import collapse_slice, extract_spectra
+from ifupy.core import CubeCollection, CubeHandle
+
+TARGETS = ['NGC 1068', 'M 82']
+
+
+def _total(cube, scale=1.):
+    return scale * float(np.nansum(cube()))
+
+
+def _write(path, target, seed, calibrated=True):
+    data = np.random.RandomState(seed).rand(20, 6, 7).astype(np.float32)
+    sci = fits.ImageHDU(data, name='SCI')
+    err = fits.ImageHDU(np.full_like(data, 0.1), name='ERR')
+
+    if calibrated:
+        sci.header.update(CRPIX3=1., CRVAL3=6500., CDELT3=2.)
+
+    primary = fits.PrimaryHDU()
+    primary.header.update(OBJECT=target, FILTER='R')
+    fits.HDUList([primary, sci, err]).writeto(path)
+
+    return data
+
+
+@pytest.fixture
+def files(tmpdir):
+    paths = [str(tmpdir.join('cube{}.fits'.format(i))) for i in range(2)]
+    data = [_write(path, target, i)
+            for i, (path, target) in enumerate(zip(paths, TARGETS))]
+
+    return paths, data
+
+
+def test_from_files_selects_extensions(files):
+    paths, _ = files
+
+    everything = CubeCollection.from_files(paths)
+    sci = CubeCollection.from_files(paths, extensions=['SCI'])
+
+    assert len(everything) == 4
+    assert [(h.path, h.extension) for h in sci] == [(p, 1) for p in paths]
+    assert all(isinstance(h, CubeHandle) for h in sci)
+    assert not any(h.is_loaded for h in sci)
+
+
+def test_index_and_select_use_primary_headers(files):
+    paths, _ = files
+    collection = CubeCollection.from_files(paths)
+
+    assert collection.index('target') == {'NGC 1068': [0, 1], 'M 82': [2, 3]}
+    assert collection.index('extension') == {'SCI': [0, 2], 'ERR': [1, 3]}
+
+    selected = collection.select(target='M 82', extension='SCI')
+
+    assert [(h.path, h.extension) for h in selected] == [(paths[1], 1)]
+    assert len(collection.select(target='M 82', filter='V')) == 0
+
+
+def test_collapse_and_extract_match_each_member(files):
+    paths, data = files
+    collection = CubeCollection.from_files(paths, extensions=['SCI'])
+
+    collapsed = collection.collapse(n_workers=1, method='median')
+    spaxels = [[0, 3, 6], [0, 2, 5]]
+    spectra = collection.extract(n_workers=2, spaxels=spaxels,
+                                 region=[2, 12])
+
+    assert collapsed.shape == (2, 6, 7)
+    assert spectra.shape == (2, 3, 10)
+
+    for i, cube in enumerate(data):
+        np.testing.assert_allclose(collapsed[i],
+                                   collapse_slice(cube, method='median'))
+        np.testing.assert_allclose(spectra[i], extract_spectra(
+            cube, [0, 6500., 2.], spaxels=spaxels, region=[2, 12])[1])
+
+
+def test_extract_without_calibration_names_the_file(files, tmpdir):
+    paths, _ = files
+    uncalibrated = str(tmpdir.join('bare.fits'))
+    _write(uncalibrated, 'M 82', 2, calibrated=False)
+
+    collection = CubeCollection.from_files(paths + [uncalibrated],
+                                           extensions=['SCI'])
+
+    with pytest.raises(ValueError) as error:
+        collection.extract(n_workers=1, spaxels=[[1, 2]])
+
+    assert uncalibrated in str(error.value)
+
+    spectra = collection.extract(n_workers=1, spaxels=[[1, 2]],
+                                 cals=[0, 6500., 2.])
+    assert spectra.shape == (3, 1, 20)
+
+
+@pytest.mark.parametrize('max_pending', [1, 3])
+def test_map_bounds_pending_members(files, monkeypatch, max_pending):
+    paths, data = files
+    submitted = []
+
+    class Executor(ProcessPoolExecutor):
+        def submit(self, *args, **kwargs):
+            submitted.append(args[1:3])
+            return ProcessPoolExecutor.submit(self, *args, **kwargs)
+
+    monkeypatch.setattr(data_cube, 'ProcessPoolExecutor', Executor)
+
+    handle = CubeCollection.from_files(paths[:1], extensions=['SCI'])[0]
+    collection = CubeCollection([handle] * 6)
+    results = collection.map(_total, n_workers=2, max_pending=max_pending,
+                             scale=2.)
+
+    first = next(results)
+
+    assert len(submitted) == max_pending
+    assert first == pytest.approx(2. * data[0].sum(), rel=1e-5)
+    assert list(results) == [first] * 5
+    assert len(submitted) == 6
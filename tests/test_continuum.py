@@ -0,0 +1,40 @@
+import numpy as np
+
+from ifupy.arithmetic import fit_continuum, subtract_continuum
+
+CALS = [0, 6500., 1.]
+
+
+def _cube():
+    wave = 6500. + np.arange(60.)
+    slope = np.linspace(0.5, 2., 12).reshape(3, 4)
+    continuum = 10. + slope * (wave[:, None, None] - 6530.)
+    line = 50. * np.exp(-0.5 * ((wave - 6530.) / 1.5)**2)
+
+    return continuum, continuum + line[:, None, None]
+
+
+def test_line_windows_are_left_out_of_the_fit():
+    continuum, data = _cube()
+
+    fitted = fit_continuum(data, line_windows=[[6522., 6538.]], cals=CALS)
+
+    np.testing.assert_allclose(fitted, continuum, atol=1e-6)
+
+
+def test_clipping_rejects_the_line():
+    continuum, data = _cube()
+
+    fitted = fit_continuum(data, sigma=2., iters=10)
+
+    np.testing.assert_allclose(fitted, continuum, atol=1e-3)
+
+
+def test_nans_are_ignored_and_regions_cut():
+    continuum, data = _cube()
+    data[40, 1, 2] = np.nan
+
+    subtracted = subtract_continuum(data, region=[6540., 6559.], cals=CALS)
+
+    assert subtracted.shape == (20, 3, 4)
+    np.testing.assert_allclose(np.nan_to_num(subtracted), 0., atol=1e-6)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from ifupy.manipulation import convolve_cube, gaussian_kernel
+
+
+def test_kernel_is_normalized():
+    kernel = gaussian_kernel(3.)
+
+    assert kernel.shape[0] % 2 == 1
+    assert abs(kernel.sum() - 1.) < 1e-12
+    assert np.unravel_index(kernel.argmax(), kernel.shape) == (
+        kernel.shape[0] // 2, kernel.shape[1] // 2)
+
+
+@pytest.mark.parametrize('options', [{}, {'max_memory': 2**14},
+                                     {'n_workers': 2}])
+def test_point_source_becomes_the_kernel(options):
+    data = np.zeros((4, 31, 33))
+    data[:, 15, 16] = 1.
+    kernel = gaussian_kernel(2.5)
+    half = kernel.shape[0] // 2
+
+    convolved = convolve_cube(data, kernel, **options)
+
+    np.testing.assert_allclose(
+        convolved[:, 15 - half:16 + half, 16 - half:17 + half],
+        np.broadcast_to(kernel, (4,) + kernel.shape), atol=1e-12)
+
+
+def test_constant_images_and_nans_are_preserved():
+    data = np.full((2, 20, 20), 3.)
+    data[0, 5, 5] = np.nan
+
+    convolved = convolve_cube(data, gaussian_kernel(4.))
+
+    assert np.isnan(convolved[0, 5, 5])
+    np.testing.assert_allclose(convolved[~np.isnan(data)], 3.)
+
+    filled = convolve_cube(data, gaussian_kernel(4.), preserve_nan=False)
+
+    np.testing.assert_allclose(filled, 3.)
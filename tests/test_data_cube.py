@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ifupy.analysis import fit_lines
+from ifupy.arithmetic import (collapse_slice, extract_spectra, fit_continuum,
+                              line_maps, moment_maps)
+from ifupy.core import Cube
+
+CALS = [0, 6500., 1.]
+
+
+@pytest.fixture
+def data():
+    x = np.arange(30.)
+    line = 4. * np.exp(-0.5 * ((x - 15.) / 2.)**2)
+
+    return (line[:, None, None] + 1. +
+            np.random.RandomState(0).normal(0, 0.01, (30, 8, 9)))
+
+
+@pytest.fixture
+def cube(data):
+    header = fits.Header()
+    header['NAXIS'] = 3
+
+    for axis, size in zip((1, 2, 3), data.shape[::-1]):
+        header['NAXIS{}'.format(axis)] = size
+
+    header.update(CRPIX3=0, CRVAL3=6500., CDELT3=1.)
+
+    return Cube(data=data, header=header)
+
+
+def test_array_attributes(cube, data):
+    assert cube.shape == data.shape
+    assert cube.ndim == 3
+    assert cube.size == data.size
+    assert cube.nbytes == data.nbytes
+
+
+def test_lazy_shape_comes_from_the_header(cube, data):
+    lazy = Cube(data=lambda: data, header=cube.header)
+
+    assert lazy.shape == data.shape
+    assert not lazy.is_loaded
+
+
+def test_in_place_arithmetic_keeps_the_array(cube, data):
+    array = cube.data
+    cube -= 1.
+
+    assert cube.data is array
+    np.testing.assert_allclose(cube.data, data - 1.)
+
+
+@pytest.mark.parametrize('func', [
+    lambda x: collapse_slice(x, method='median'),
+    lambda x: collapse_slice(x, method='mean', max_memory=2000),
+    lambda x: moment_maps(x, cals=CALS),
+    lambda x: fit_continuum(x, order=1),
+    lambda x: extract_spectra(x, CALS, spaxels=[[1, 2], [3, 4]])[1],
+    lambda x: line_maps(x, [('a', [6510., 6520.],
+                                 [[6500., 6505.], [6525., 6529.]])],
+                        cals=CALS)[1],
+    lambda x: fit_lines(x, CALS, [6505., 6525.], n_workers=1)['flux'],
+])
+def test_cubes_are_accepted_as_arrays(func, cube, data):
+    np.testing.assert_allclose(np.asarray(func(cube)),
+                               np.asarray(func(data)))
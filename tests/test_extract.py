@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from ifupy.arithmetic import extract_spectra, extract_spectrum
+
+CALS = [0, 6500., 1.25]
+
+# Corners, edges and negative indices of a (y=9, x=11) image
+SPAXELS = [[0, 0], [10, 8], [-1, -1], [0, 8], [10, 0], [5, 4], [-11, 3]]
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    frames = np.arange(40.)
+
+    return (rng.normal(size=(40, 9, 11)) +
+            (1. + 0.05 * frames)[:, None, None] * rng.rand(9, 11))
+
+
+def _loop(data, spaxels, region=(0, None), iscontinuum=False):
+    """
+    Spectra extracted one spaxel at a time, as a reference.
+    """
+    begin, end = region
+    wave = 6500. + 1.25 * np.arange(data.shape[0])[begin:end]
+    spectra = []
+
+    for x, y in spaxels:
+        spectrum = data[begin:end, y, x]
+
+        if iscontinuum:
+            spectrum = spectrum - np.polyval(np.polyfit(wave, spectrum, 1),
+                                             wave)
+
+        spectra.append(spectrum)
+
+    return wave, np.array(spectra)
+
+
+@pytest.mark.parametrize('region', [None, [3, 31]])
+@pytest.mark.parametrize('iscontinuum', [False, True])
+def test_batched_spaxels_match_a_loop(data, region, iscontinuum):
+    wave, spectra = extract_spectra(data, CALS, spaxels=SPAXELS,
+                                    region=region, iscontinuum=iscontinuum)
+    expected_wave, expected = _loop(data, SPAXELS, region or (0, None),
+                                    iscontinuum)
+
+    np.testing.assert_allclose(wave, expected_wave)
+    np.testing.assert_allclose(spectra, expected, atol=1e-10)
+
+
+def test_spaxels_may_be_given_as_x_and_y_lists(data):
+    xy = np.transpose(SPAXELS[:3])
+
+    np.testing.assert_array_equal(
+        extract_spectra(data, CALS, spaxels=xy)[1],
+        extract_spectra(data, CALS, spaxels=SPAXELS[:3])[1])
+
+
+def test_mask_extracts_in_row_major_order(data):
+    mask = np.zeros((9, 11), dtype=bool)
+    mask[0, :] = mask[:, -1] = mask[4, 5] = True
+
+    _, spectra = extract_spectra(data, CALS, mask=mask, iscontinuum=True)
+
+    y, x = np.nonzero(mask)
+    expected = _loop(data, zip(x, y), iscontinuum=True)[1]
+
+    np.testing.assert_allclose(spectra, expected, atol=1e-10)
+
+
+def test_weights_sum_each_aperture(data):
+    weights = np.zeros((2, 9, 11))
+    weights[0, :2, :2] = 1.
+    weights[1, -1, 3:] = np.linspace(0., 1., 8)
+    weights[1, 0, 10] = 0.5
+
+    _, spectra = extract_spectra(data, CALS, weights=weights, region=[5, 25])
+    _, single = extract_spectra(data, CALS, weights=weights[1],
+                                region=[5, 25])
+
+    expected = [np.einsum('yx,zyx->z', w, data[5:25]) for w in weights]
+
+    np.testing.assert_allclose(spectra, expected, atol=1e-10)
+    np.testing.assert_allclose(single, expected[1:], atol=1e-10)
+
+
+@pytest.mark.parametrize('iscontinuum', [False, True])
+def test_single_spectrum_keeps_the_frame_layout(data, iscontinuum):
+    spectrum = extract_spectrum(data, [[10, 8]], CALS, region=[2, 30],
+                                iscontinuum=iscontinuum)
+    wave, expected = _loop(data, [[10, 8]], (2, 30), iscontinuum)
+
+    np.testing.assert_allclose(spectrum[0], wave)
+    np.testing.assert_array_equal(spectrum[1], np.arange(2, 30))
+    np.testing.assert_allclose(spectrum[2], expected[0], atol=1e-10)
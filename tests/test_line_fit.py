@@ -0,0 +1,77 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from ifupy.analysis import fit_gaussians, fit_lines
+
+CALS = [0, 6500., 0.5]
+
+
+def _cube(noise=0.01):
+    wave = 6500. + 0.5 * np.arange(80)
+    mean = 6520. + np.linspace(-1., 1., 12).reshape(3, 4)
+    profile = 10. * np.exp(-0.5 * ((wave[:, None, None] - mean) / 1.5)**2)
+
+    return mean, profile + np.random.RandomState(0).normal(0, noise,
+                                                           profile.shape)
+
+
+@pytest.mark.parametrize('n_workers', [None, 2])
+def test_fit_recovers_the_line(n_workers):
+    mean, data = _cube()
+    mask = np.ones(mean.shape, dtype=bool)
+    mask[0, 0] = False
+
+    maps = fit_lines(data, CALS, [6510., 6530.], mask=mask,
+                     n_workers=n_workers)
+
+    assert np.isnan(maps['mean'][0, 0])
+    np.testing.assert_allclose(maps['mean'][mask], mean[mask], atol=0.01)
+    np.testing.assert_allclose(maps['amplitude'][mask], 10., rtol=0.01)
+    np.testing.assert_allclose(maps['stddev'][mask], 1.5, rtol=0.01)
+    np.testing.assert_allclose(maps['flux'][mask],
+                               10. * 1.5 * np.sqrt(2 * np.pi), rtol=0.01)
+    assert np.all(maps['mean_err'][mask] < 0.01)
+
+
+def test_gaussians_fit_together():
+    x = np.linspace(-5., 5., 101)
+    params = np.array([[1., 0., 1.], [3., 1., 0.5]])
+    y = params[:, :1] * np.exp(-0.5 * ((x - params[:, 1:2]) /
+                                       params[:, 2:3])**2)
+
+    fitted, errors = fit_gaussians(x, y)
+
+    np.testing.assert_allclose(fitted[:, :3], params, atol=1e-6)
+
+
+def test_fits_without_a_valid_covariance_fail_explicitly():
+    x = np.linspace(-5., 5., 41)
+    y = np.vstack([np.eye(41)[[0, 20, 40]],
+                   np.random.RandomState(1).normal(size=(200, 41))])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        params, errors = fit_gaussians(x, y)
+
+    failed = np.isnan(params).any(axis=1)
+
+    assert failed.any()
+    assert np.all(np.isnan(errors[failed]))
+    assert np.all(np.isfinite(errors[~failed]))
+    assert np.all(errors[~failed] >= 0)
+
+
+def test_spectra_with_nans_fail_quietly():
+    x = np.linspace(-5., 5., 41)
+    y = np.tile(np.exp(-0.5 * x**2), (3, 1))
+    y[1, 7] = np.nan
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        params, errors = fit_gaussians(x, y)
+
+    assert np.all(np.isnan(params[1])) and np.all(np.isnan(errors[1]))
+    np.testing.assert_allclose(params[[0, 2], :3], [[1., 0., 1.]] * 2,
+                               atol=1e-6)
@@ -0,0 +1,58 @@
+import numpy as np
+
+from ifupy.arithmetic import line_maps
+
+CALS = [0, 6500., 0.5]
+SIDEBANDS = [[6510., 6520.], [6600., 6610.]]
+
+
+def _gaussian(wave, centre, flux, sigma=1.):
+    return (flux / (np.sqrt(2 * np.pi) * sigma) *
+            np.exp(-0.5 * ((wave - centre) / sigma)**2))
+
+
+def test_fluxes_and_ratios():
+    wave = 6500. + 0.5 * np.arange(240)
+    flux = np.arange(1., 7.).reshape(2, 3)
+    data = (5. + 0.01 * (wave - 6500.))[:, None, None] + \
+        _gaussian(wave, 6563., 100.)[:, None, None] * flux + \
+        _gaussian(wave, 6583., 30.)[:, None, None]
+    data[130, 1, 2] = np.nan
+
+    lines = [('Ha', [6555., 6571.], SIDEBANDS),
+             ('NII', [6575., 6591.], SIDEBANDS)]
+    labels, maps = line_maps(data, lines, ratios=[('NII', 'Ha')], cals=CALS)
+
+    assert labels == ['Ha', 'NII', 'NII/Ha']
+
+    expected = 100. * flux
+    expected[1, 2] = np.nan
+    np.testing.assert_allclose(maps[0], expected, rtol=1e-3)
+    np.testing.assert_allclose(maps[2], 30. / expected, rtol=1e-3)
+
+
+def test_streaming_matches_a_single_pass():
+    data = np.random.RandomState(0).rand(50, 4, 5)
+    lines = [('a', [10, 20], [[0, 5], [30, 40]]), ('b', [25, 30], None)]
+
+    single = line_maps(data, lines)[1]
+    streamed = line_maps(data, lines, max_memory=2**10)[1]
+
+    np.testing.assert_allclose(streamed, single)
+
+
+def test_nans_only_spoil_the_lines_that_use_them():
+    data = np.ones((50, 3, 4))
+    data[27, 1, 2] = np.nan
+    data[45, 0, 0] = np.inf
+    lines = [('a', [10, 20], [[0, 5], [30, 40]]), ('b', [25, 30], None)]
+
+    for max_memory in None, 2**8:
+        labels, maps = line_maps(data, lines, ratios=[('a', 'b')],
+                                 max_memory=max_memory)
+
+        assert np.all(np.isfinite(maps[0]))
+        np.testing.assert_allclose(maps[0], 0., atol=1e-12)
+        assert np.isnan(maps[1, 1, 2]) and np.isnan(maps[2, 1, 2])
+        assert np.count_nonzero(np.isnan(maps[1])) == 1
+        np.testing.assert_allclose(maps[1][~np.isnan(maps[1])], 5.)
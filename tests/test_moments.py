@@ -0,0 +1,33 @@
+import numpy as np
+
+from ifupy.arithmetic import moment_maps
+
+
+def _line_cube(mean=20., sigma=3., amplitude=5.):
+    x = np.arange(60.)
+    line = amplitude * np.exp(-0.5 * ((x - mean) / sigma)**2)
+
+    return np.tile(line[:, None, None], (1, 4, 5))
+
+
+def test_moments_of_a_gaussian():
+    flux, mean, width = moment_maps(_line_cube(), cals=[0, 0., 1.])
+
+    np.testing.assert_allclose(flux, 5. * 3. * np.sqrt(2 * np.pi),
+                               rtol=1e-6)
+    np.testing.assert_allclose(mean, 20., rtol=1e-6)
+    np.testing.assert_allclose(width, 3., rtol=1e-4)
+
+
+def test_streaming_matches_a_single_pass():
+    cube = _line_cube() + np.random.RandomState(0).normal(0, 0.1,
+                                                          (60, 4, 5))
+
+    np.testing.assert_allclose(moment_maps(cube, max_memory=500),
+                               moment_maps(cube))
+
+
+def test_empty_window():
+    maps = moment_maps(_line_cube(), region=[10, 10])
+
+    assert maps.shape == (3, 4, 5)
@@ -0,0 +1,119 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from ifupy.arithmetic import collapse_slice
+from ifupy.arithmetic.collapse import _tileShape
+from ifupy.core import set_verbose
+from ifupy.core.parallel import map_chunks, map_tiles
+
+
+class Cancelled(Exception):
+    pass
+
+
+def _sum_planes(tile):
+    return tile.sum(axis=0)
+
+
+def _double(chunk):
+    return 2 * chunk
+
+
+@pytest.fixture
+def data():
+    return np.random.RandomState(0).normal(size=(12, 10, 8))
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_progress_reaches_one(data, n_workers):
+    fractions = []
+
+    map_tiles(_sum_planes, data, tile_shape=(3, 8), n_workers=n_workers,
+              progress=fractions.append)
+    map_chunks(_double, data, 5, n_workers=n_workers,
+               progress=fractions.append)
+
+    assert fractions == [0.25, 0.5, 0.75, 1., 1. / 3, 2. / 3, 1.]
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_raising_from_progress_cancels(data, n_workers):
+    fractions = []
+
+    def cancel(fraction):
+        fractions.append(fraction)
+        raise Cancelled()
+
+    with pytest.raises(Cancelled):
+        map_tiles(_sum_planes, data, tile_shape=(1, 8), n_workers=n_workers,
+                  progress=cancel)
+
+    assert fractions == [0.1]
+
+
+@pytest.mark.parametrize('method', ['sum', 'median'])
+def test_streamed_collapse_reports_progress(data, method):
+    fractions = []
+
+    collapse_slice(data, method=method, max_memory=data.nbytes // 3,
+                   progress=fractions.append)
+
+    assert len(fractions) > 1
+    assert fractions == sorted(fractions)
+    assert fractions[-1] == 1.
+
+
+@pytest.mark.parametrize('method', ['sum', 'mean', 'median'])
+@pytest.mark.parametrize('sigma', [False, 2.])
+@pytest.mark.parametrize('options', [
+    {'max_memory': 2**12}, {'max_memory': 500}, {'n_workers': 2},
+    {'n_workers': 2, 'max_memory': 500}])
+def test_tiled_and_parallel_collapse_match_in_memory(data, method, sigma,
+                                                      options):
+    expected = collapse_slice(data, method=method, sigma=sigma,
+                              return_rejected=True)
+    result = collapse_slice(data, method=method, sigma=sigma,
+                            return_rejected=True, **options)
+
+    np.testing.assert_allclose(result[0], expected[0])
+    np.testing.assert_array_equal(result[1], expected[1])
+
+
+def test_rows_larger_than_the_budget_are_split(data):
+    # One spectrum takes 12 * 8 * 2 bytes, a row 8 times that
+    assert _tileShape(data, False, 500) == (1, 2)
+    assert _tileShape(data, False, 2**12) == (2, 8)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        result = collapse_slice(data, method='median', max_memory=500)
+
+    np.testing.assert_allclose(result, np.median(data, axis=0))
+
+
+def test_spectra_larger_than_the_budget_warn(data):
+    with pytest.warns(RuntimeWarning):
+        collapse_slice(data, method='median', max_memory=100)
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_map_chunks_matches_numpy(data, n_workers):
+    np.testing.assert_allclose(map_chunks(_double, data, 5,
+                                          n_workers=n_workers), 2 * data)
+
+
+@pytest.mark.parametrize('sigma', [False, 2.])
+def test_tiled_collapse_logs_once(data, capsys, sigma):
+    set_verbose(True)
+
+    try:
+        collapse_slice(data, method='mean', sigma=sigma, n_workers=1,
+                       max_memory=500)
+    finally:
+        set_verbose(False)
+
+    lines = capsys.readouterr()[0].splitlines()
+
+    assert len(lines) == len(set(lines))
@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ifupy.core import read_data
+from ifupy.core.parallel import _share, file_view, map_tiles
+
+
+@pytest.fixture
+def fits_file(tmpdir):
+    """
+    A file with float, unsigned (BZERO offset) and scaled extensions.
+    """
+    rng = np.random.RandomState(0)
+    sci = rng.rand(12, 9, 11).astype(np.float32)
+    dq = rng.randint(0, 2**16, size=(12, 9, 11)).astype(np.uint16)
+
+    scaled = fits.ImageHDU((rng.rand(12, 9, 11) * 100).astype(np.float32),
+                           name='FLUX')
+    scaled.scale('int16', bscale=0.01, bzero=50.)
+
+    path = str(tmpdir.join('cube.fits'))
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(sci, name='SCI'),
+                  fits.ImageHDU(dq, name='DQ'), scaled]).writeto(path)
+
+    return path
+
+
+@pytest.mark.parametrize('cutout', [{}, {'region': [2, 7]},
+                                    {'region': [3, 10], 'bbox': [1, 8, 2, 6]}])
+def test_lazy_read_matches_eager(fits_file, cutout):
+    _, eager = read_data(fits_file, use_cache=False, **cutout)
+    _, lazy = read_data(fits_file, lazy=True, use_cache=False, **cutout)
+
+    assert len(lazy) == len(eager) == 3
+
+    for lazy_cube, eager_cube in zip(lazy, eager):
+        # Unscaled lazy data keeps the file's (big-endian) byte order
+        assert (lazy_cube.data.dtype.newbyteorder('=') ==
+                eager_cube.data.dtype.newbyteorder('='))
+        np.testing.assert_array_equal(lazy_cube.data, eager_cube.data)
+        assert 'BZERO' not in lazy_cube.header
+
+
+def test_lazy_cube_is_writable_in_memory_only(fits_file):
+    _, cubes = read_data(fits_file, lazy=True, extensions=['SCI'],
+                         use_cache=False)
+    cube = cubes[0]
+    original = np.array(cube.data)
+
+    cube -= 1.0
+
+    np.testing.assert_allclose(cube.data, original - 1.0)
+    np.testing.assert_array_equal(fits.getdata(fits_file, 'SCI'), original)
+
+
+def _spectrum_sums(tile):
+    return tile.sum(axis=0)
+
+
+def test_lazy_cubes_are_shared_by_file_until_edited(fits_file):
+    _, cubes = read_data(fits_file, lazy=True, extensions=['SCI'],
+                         region=[2, 10], use_cache=False)
+    cube = cubes[0]
+    original = np.array(cube.data)
+
+    assert file_view(cube.data)[0] == fits_file
+    assert _share(cube.data)[1] is None
+    np.testing.assert_allclose(map_tiles(_spectrum_sums, cube,
+                                         tile_shape=(3, 11), n_workers=2),
+                               original.sum(axis=0), rtol=1e-5)
+
+    cube[0, 0, 0] = -1.
+
+    assert file_view(cube.data) is None
+    assert cube.data[0, 0, 0] == -1.
+    np.testing.assert_array_equal(cube.data[1:], original[1:])
+    np.testing.assert_array_equal(fits.getdata(fits_file, 'SCI')[2:10],
+                                  original)
+
+
+def test_views_of_lazy_cubes_follow_edits(fits_file):
+    _, cubes = read_data(fits_file, lazy=True, extensions=['SCI'],
+                         use_cache=False)
+    cube = cubes[0]
+    before, after = cube[:4], cube[:, 1]
+    original = np.array(cube.data)
+
+    cube -= 1.0
+    np.testing.assert_allclose(before.data, original[:4] - 1.0)
+
+    # Writing to a view writes to the cube it was taken from
+    after[...] = 0.
+    np.testing.assert_array_equal(cube.data[:, 1], 0.)
+    np.testing.assert_array_equal(before.data[:, 1], 0.)
+    np.testing.assert_array_equal(fits.getdata(fits_file, 'SCI'), original)
+
+
+def test_unsigned_extension_decodes_to_uint16(fits_file):
+    _, cubes = read_data(fits_file, lazy=True, extensions=['DQ'],
+                         region=[0, 4], use_cache=False)
+
+    assert cubes[0].data.dtype == np.uint16
+    np.testing.assert_array_equal(cubes[0].data,
+                                  fits.getdata(fits_file, 'DQ')[0:4])
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_wave_region_uses_the_sci_calibration(fits_file, lazy):
+    with fits.open(fits_file, mode='update') as hdulist:
+        hdulist['SCI'].header.update(CRPIX3=1., CRVAL3=5000., CDELT3=2.)
+
+    _, cubes = read_data(fits_file, lazy=lazy, wave_region=[5004., 5010.],
+                         use_cache=False)
+
+    for cube in cubes:
+        assert cube.shape[0] == 4
+
+    np.testing.assert_array_equal(cubes[1].data,
+                                  fits.getdata(fits_file, 'DQ')[2:6])
+
+
+def test_wave_region_without_calibration_fails(fits_file):
+    with pytest.raises(ValueError) as error:
+        read_data(fits_file, extensions=['DQ'], wave_region=[5004., 5010.],
+                  use_cache=False)
+
+    assert 'DQ' in str(error.value)
@@ -0,0 +1,98 @@
+import json
+import time
+
+from ifupy.core import Trace, profile
+from ifupy.core.profiling import log, profiled, stage
+
+
+@profiled()
+def _nap():
+    time.sleep(0.01)
+
+
+def _traced():
+    with profile() as trace:
+        with stage('outer', nbytes=100, chunk=3):
+            _nap()
+
+            with stage('inner', nbytes=10):
+                time.sleep(0.01)
+
+            log('test', 'done', 2)
+
+    return trace
+
+
+def test_nested_stages_are_timed_within_their_parent():
+    events = dict((event['name'], event) for event in _traced().events)
+
+    outer, inner, nap = events['outer'], events['inner'], events['_nap']
+
+    for event in inner, nap:
+        assert event['start'] >= outer['start']
+        assert (event['start'] + event['duration'] <=
+                outer['start'] + outer['duration'])
+
+    assert inner['duration'] >= 0.01
+    assert outer['duration'] >= inner['duration'] + nap['duration']
+    assert nap['cat'] == 'call'
+    assert outer['args'] == {'chunk': 3}
+
+
+def test_stages_and_logs_are_not_recorded_outside_a_profile(capsys):
+    trace = _traced()
+
+    with stage('ignored'):
+        log('test', 'ignored')
+
+    assert 'ignored' not in [event['name'] for event in trace.events]
+    assert capsys.readouterr()[0] == ''
+
+
+def test_json_export_holds_events_and_summary(tmpdir):
+    trace = _traced()
+    path = str(tmpdir.join('trace.json'))
+
+    content = json.loads(trace.to_json(path))
+
+    with open(path) as f:
+        assert json.load(f) == content
+
+    assert len(content['events']) == 4
+    assert content['summary']['outer'] == {
+        'calls': 1, 'time': trace.summary()['outer']['time'], 'bytes': 100}
+    assert content['summary']['inner']['bytes'] == 10
+    assert 'done 2' not in content['summary']
+
+
+def test_chrome_export_uses_microsecond_events():
+    trace = _traced()
+    events = dict((event['name'], event)
+                  for event in json.loads(trace.to_chrome())['traceEvents'])
+
+    outer = events['outer']
+    assert outer['ph'] == 'X'
+    assert abs(outer['dur'] - 1e6 * trace.summary()['outer']['time']) < 1e-3
+    assert outer['args']['bytes'] == 100
+    assert outer['args']['chunk'] == 3
+
+    message = events['done 2']
+    assert message['ph'] == 'i'
+    assert 'dur' not in message
+    assert message['args']['source'] == 'test'
+    assert outer['ts'] <= message['ts'] <= outer['ts'] + outer['dur']
+
+
+def test_traces_are_independent():
+    first, second = Trace(), Trace()
+
+    with profile(first):
+        with stage('a'):
+            pass
+
+    with profile(second):
+        with stage('b'):
+            pass
+
+    assert [event['name'] for event in first.events] == ['a']
+    assert [event['name'] for event in second.events] == ['b']
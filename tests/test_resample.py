@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ifupy.core import Cube
+from ifupy.manipulation.resample import _grid_key, resample, resampler_cache
+
+
+def _header(shape, cdelt=1., crpix=1., **keywords):
+    header = fits.Header()
+    header['NAXIS'] = 3
+
+    for axis, size in zip((1, 2, 3), shape[::-1]):
+        header['NAXIS{}'.format(axis)] = size
+
+    header.update(CTYPE1='RA---TAN', CTYPE2='DEC--TAN', CRVAL1=150.,
+                  CRVAL2=2., CRPIX1=crpix, CRPIX2=crpix,
+                  CDELT1=-cdelt / 3600., CDELT2=cdelt / 3600.,
+                  CRPIX3=1., CRVAL3=6500., CDELT3=1.)
+    header.update(keywords)
+
+    return header
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    resampler_cache.clear()
+
+
+@pytest.fixture
+def grids():
+    # 2x2 input pixels fall exactly in every output pixel
+    return _header((3, 8, 8)), _header((3, 4, 4), cdelt=2., crpix=0.75)
+
+
+def test_same_grid_is_unchanged(grids):
+    source = grids[0]
+    data = np.random.RandomState(0).normal(size=(3, 8, 8))
+
+    for method in ('linear', 'area'):
+        np.testing.assert_allclose(
+            resample(data, source, source=source, method=method), data)
+
+
+def test_errors_add_in_quadrature(grids):
+    source, target = grids
+    err = np.full((3, 8, 8), 2.)
+
+    sci = resample(err, target, source=source, method='area')
+    propagated = resample(err, target, source=source, method='area',
+                          kind='error')
+    variance = resample(err**2, target, source=source, method='area',
+                        kind='variance')
+
+    # Mean of 4 equal pixels: err / sqrt(4)
+    np.testing.assert_allclose(sci, 2.)
+    np.testing.assert_allclose(propagated, 1.)
+    np.testing.assert_allclose(variance, 1.)
+
+
+def test_flags_are_combined_bitwise(grids):
+    source, target = grids
+    dq = np.zeros((3, 8, 8), dtype=np.int32)
+    dq[:, 0, 0] = 1
+    dq[:, 1, 1] = 4
+    dq[1, 7, 7] = 2
+
+    combined = resample(dq, target, source=source, method='area',
+                        kind='flags')
+
+    assert combined.dtype == dq.dtype
+    assert np.all(combined[:, 0, 0] == 5)
+    assert combined[1, 3, 3] == 2
+    assert combined.sum() == 3 * 5 + 2
+
+
+def test_kind_and_header_follow_the_extension(grids):
+    source, target = grids
+    target = target.copy()
+    target.update(EXTNAME='SCI', BUNIT='erg/s/cm2/A')
+    header = source.copy()
+    header.update(EXTNAME='DQ')
+    dq = Cube(data=np.ones((3, 8, 8), dtype=np.int16), header=header)
+
+    result = resample(dq, target, method='area')
+
+    assert result.header['EXTNAME'] == 'DQ'
+    assert 'BUNIT' not in result.header
+    assert result.data.dtype == np.int16
+    assert np.all(result.data == 1)
+
+
+@pytest.mark.parametrize('keywords', [
+    {'CROTA2': 30.}, {'PC1_2': 0.5}, {'LONPOLE': 170.},
+    {'RADESYS': 'FK5', 'EQUINOX': 1950.}])
+def test_grid_key_covers_the_full_wcs(grids, keywords):
+    source = grids[0]
+    other = source.copy()
+    other.update(keywords)
+
+    assert _grid_key(source) != _grid_key(other)
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from ifupy.core import SpectralAxis
+
+AXES = [SpectralAxis(crpix=3., crval=6500., crdelt=1.25, size=40),
+        SpectralAxis(crpix=-2.5, crval=1.9, crdelt=-0.0005, size=33),
+        SpectralAxis(wavelengths=6500. + np.linspace(0., 60., 40)**1.5)]
+
+
+def _frame_convert(frame, cals):
+    """
+    The wavelength of a frame as `frame_convert` computed it before
+    spectral axes, where `cals` held the 1-based FITS reference pixel.
+    """
+    return (frame - cals[0]) * cals[2] + cals[1]
+
+
+def _header(**keywords):
+    header = fits.Header()
+    header.update(NAXIS=3, NAXIS1=4, NAXIS2=5, NAXIS3=40, CTYPE3='WAVE',
+                  **keywords)
+
+    return header
+
+
+@pytest.mark.parametrize('axis', AXES)
+def test_frames_round_trip(axis):
+    frames = np.arange(axis.size)
+
+    np.testing.assert_allclose(axis.to_frame(axis.to_wave(frames)), frames,
+                               atol=1e-8)
+    np.testing.assert_array_equal(axis.to_index(axis.wavelengths), frames)
+    np.testing.assert_array_equal(
+        axis.to_index(axis.to_wave(frames + 0.3)), frames)
+    assert axis.to_index(axis.wavelengths[7]) == 7
+    assert isinstance(axis.to_index(axis.wavelengths[7]), int)
+
+
+@pytest.mark.parametrize('axis', AXES)
+def test_region_to_frames_covers_both_ends(axis):
+    wave = axis.wavelengths
+    last = axis.size - 1
+
+    assert axis.region_to_frames([wave[5], wave[12]]) == [5, 13]
+    assert axis.region_to_frames([wave[12], wave[5]]) == [5, 13]
+    assert axis.region_to_frames([wave[0], wave[last]]) == [0, axis.size]
+
+    # Regions reaching past the ends are clipped to the cube
+    before, after = 2 * wave[0] - wave[3], 2 * wave[last] - wave[last - 3]
+    begin, end = axis.region_to_frames([before, after])
+
+    assert begin == 0
+    assert len(range(axis.size)[begin:end]) == axis.size
+
+
+@pytest.mark.parametrize('axis', AXES)
+@pytest.mark.parametrize('item', [np.s_[5:], np.s_[3:30], np.s_[2:38:3],
+                                  np.s_[::-1], np.s_[-10:]])
+def test_slices_shift_the_reference_pixel(axis, item):
+    sliced = axis[item]
+
+    assert sliced.size == len(range(axis.size)[item])
+    np.testing.assert_allclose(sliced.wavelengths, axis.wavelengths[item])
+
+    if axis.is_linear:
+        start = item.indices(axis.size)[0]
+        assert sliced.to_wave(0) == pytest.approx(axis.to_wave(start))
+
+
+def test_only_slices_are_accepted():
+    with pytest.raises(TypeError):
+        AXES[0][3]
+
+
+@pytest.mark.filterwarnings('ignore::astropy.wcs.FITSFixedWarning')
+@pytest.mark.parametrize('keywords', [
+    {'CRPIX3': 1., 'CRVAL3': 6500., 'CDELT3': 1.25},
+    {'CRPIX3': 12.5, 'CRVAL3': 4.6, 'CDELT3': -0.002},
+    {'CRPIX3': 0., 'CRVAL3': 6500., 'CD3_3': 0.75}])
+def test_from_header_matches_one_based_frames(keywords):
+    header = _header(**keywords)
+    axis = SpectralAxis.from_header(header)
+    frames = np.arange(40)
+
+    cals = (header['CRPIX3'], header['CRVAL3'],
+            header.get('CDELT3', header.get('CD3_3')))
+
+    assert axis.size == 40
+    np.testing.assert_allclose(axis.wavelengths,
+                               _frame_convert(frames + 1, cals))
+    np.testing.assert_allclose(
+        axis.wavelengths, WCS(header).sub([3]).wcs_pix2world(frames, 0)[0])